@@ -0,0 +1,73 @@
+"""
+bench_common.py
+Project Echo - ベンチマーク共通処理（パーセンタイル・メタデータ・結果の保存）
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+
+def percentile(values, p):
+    """線形補間のパーセンタイル（values が空なら None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(values):
+    """レイテンシ列（秒）の要約"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def git_revision():
+    try:
+        rev = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.call(
+            ["git", "diff", "--quiet", "HEAD", "--", "."], cwd=SRC_DIR, stderr=subprocess.DEVNULL
+        ) != 0
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def metadata():
+    return {
+        "git": git_revision(),
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_result(kind, result, out=None):
+    """結果を JSON で保存してパスを返す（out 未指定なら results/<kind>-<git>.json）"""
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{kind}-{result['meta']['git']}.json")
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2, sort_keys=True)
+    return out
@@ -0,0 +1,154 @@
+"""
+bench_micro.py
+Project Echo - ホットパスのマイクロベンチマーク
+
+    - extract_json:         モデル出力（コードフェンス付き / 素の JSON）から JSON 部分を取り出す
+    - parse_json:           崩れた JSON（末尾の文章・スマートクォート・途中切れ）の修復とパース
+    - JsonFieldStreamer:    ストリーミング中の narrative 抽出
+    - build_phase_prompt:   語り手プロンプトの組み立て（物語が進んだ状態）
+    - /status のシリアライズ: build_status() + Flask の JSON エンコード（全体 / ?since= の差分）
+
+使い方（src ディレクトリで実行）:
+    python benchmarks/bench_micro.py
+    python benchmarks/bench_micro.py --only extract_json --out /tmp/micro.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from bench_common import SRC_DIR, metadata, write_result
+
+# アプリを読み込んでもネットワークに出ないように偽バックエンドを使う
+os.environ.setdefault('ECHO_BACKEND', 'fake')
+sys.path.insert(0, SRC_DIR)
+
+import web_echo_interactive as app_module  # noqa: E402
+from echo_json import JsonFieldStreamer, extract_json, parse_json  # noqa: E402
+
+NARRATIVE = (
+    "その日、カフェの中でタクミとアヤカは偶然同じテーブルに座った。"
+    "窓の外では小雨が降り続き、店内には静かな音楽が流れていた。"
+    "「予算のことなんだけど……」タクミは何かを言いかけて、カップを持つ手を止めた。"
+    "アヤカは微笑みながらも、視線だけは相手から外さなかった。"
+    "沈黙の中で、二人はそれぞれの思惑を胸に秘めていた。"
+) * 2
+
+
+def sample_session():
+    """4フェーズまで進んだセッション"""
+    characters = [
+        {"name": "タクミ", "age": 17, "public_persona": "明るく面倒見がいい", "secret_goal": "実行委員長の座を守りたい",
+         "speech_style": "砕けた口調"},
+        {"name": "アヤカ", "age": 17, "public_persona": "冷静で成績優秀", "secret_goal": "予算を自分の企画に回したい",
+         "speech_style": "丁寧語"},
+    ]
+    conversation = [{
+        "speaker": "タクミ・アヤカ",
+        "narrative": NARRATIVE,
+        "inner_thought": "二人の思惑が静かにぶつかり合う。",
+        "phase": phase,
+        "all_inner_thoughts": [
+            {"character": "タクミ", "thought": "ここで引いたら負けだ。"},
+            {"character": "アヤカ", "thought": "あと一押しで予算は私のもの。"},
+        ],
+    } for phase in ('ki', 'sho', 'ten', 'ketsu')]
+    return {
+        "version": 20,
+        "theme": "学園祭",
+        "status": "complete",
+        "current_phase": "complete",
+        "characters": characters,
+        "initial_situation": "学園祭の予算会議の後、二人だけが会議室に残った。",
+        "story_title": "秘密の放課後",
+        "conversation": conversation,
+        "progress": "",
+        "narrator": {
+            "instruction": "あなたは小説の語り手です。" * 20,
+            "char_names": ["タクミ", "アヤカ"],
+            "char_profiles": "",
+        },
+        "comic_status": "complete",
+        "comic_images": [{"phase": "story", "image_url": "/static/images/1_story.png", "prompt": "anime"}],
+    }
+
+
+def bench(fn, min_time=0.2, repeat=5):
+    """fn を min_time 秒以上かかる回数ずつ repeat 回実行し、1回あたりのナノ秒を返す"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+    runs = [elapsed]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        runs.append(time.perf_counter() - started)
+    per_op = sorted(r / loops * 1e9 for r in runs)
+    return {"loops": loops, "min_ns": per_op[0], "median_ns": per_op[len(per_op) // 2]}
+
+
+def cases():
+    session = sample_session()
+    fenced = "```json\n" + json.dumps(
+        {"narrative": NARRATIVE, "inner_thought": "雰囲気"}, ensure_ascii=False, indent=2) + "\n```"
+    plain = json.dumps({"narrative": NARRATIVE, "inner_thought": "雰囲気"}, ensure_ascii=False)
+    trailing = plain + "\n\n以上が場面の描写です。"
+    truncated = plain[:len(plain) * 2 // 3]
+    chunks = [fenced[i:i + 16] for i in range(0, len(fenced), 16)]
+    conversation = session['conversation'][:3]
+
+    def stream():
+        streamer = JsonFieldStreamer('narrative')
+        for chunk in chunks:
+            streamer.feed(chunk)
+
+    def status_json():
+        return app_module.app.json.dumps(app_module.build_status(session))
+
+    def status_delta_json():
+        return app_module.app.json.dumps(app_module.build_status(session, since=len(session['conversation'])))
+
+    return {
+        "extract_json_fenced": lambda: json.loads(extract_json(fenced)),
+        "extract_json_plain": lambda: json.loads(extract_json(plain)),
+        "parse_json_valid": lambda: parse_json(plain),
+        "parse_json_trailing_text": lambda: parse_json(trailing),
+        "parse_json_truncated": lambda: parse_json(truncated),
+        "json_field_streamer": stream,
+        "build_phase_prompt": lambda: app_module.build_phase_prompt(
+            session['narrator'], session['initial_situation'], conversation, 'ketsu', "意外な結末に"),
+        "status_serialization": status_json,
+        "status_serialization_delta": status_delta_json,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', action='append', help='実行するケース名（複数指定可）')
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', help='結果 JSON の出力先（既定: benchmarks/results/micro-<git>.json）')
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in cases().items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = bench(fn, args.min_time, args.repeat)
+        print(f"{name:<24}{results[name]['median_ns'] / 1000:>10.2f} µs/op")
+
+    result = {"kind": "micro", "meta": metadata(), "micro": results}
+    print(f"[INFO] 結果を保存: {write_result('micro', result, args.out)}")
+
+
+if __name__ == '__main__':
+    main()
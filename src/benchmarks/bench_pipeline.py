@@ -0,0 +1,330 @@
+"""
+bench_pipeline.py
+Project Echo - ストーリー生成パイプラインのエンドツーエンド・ベンチマーク
+
+偽バックエンド（ECHO_BACKEND=fake）でサーバーを子プロセスとして起動し、
+N人の同時ユーザーが /start → /status → /continue ×4 → /result → /comic を実行する。
+
+計測項目:
+    - 完了セッション数 / 分
+    - フェーズごと（start / ki / sho / ten / ketsu / result / comic / セッション全体）の p50 / p95 / p99
+    - エンドポイントごとの HTTP レイテンシ
+    - サーバーの CPU 時間（1セッションあたり）とピーク RSS
+
+使い方（src ディレクトリで実行）:
+    python benchmarks/bench_pipeline.py --users 20 --sessions 2
+    python benchmarks/bench_pipeline.py --users 50 --text-latency lognormal:0:0.5 --rate-429 0.05
+    python benchmarks/compare.py benchmarks/results/pipeline-abc1234.json benchmarks/results/pipeline-def5678.json
+
+--url で起動済みのサーバーを対象にもできる（その場合 CPU / RSS は計測しない）。
+"""
+
+import argparse
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bench_common import SRC_DIR, metadata, summarize, write_result
+
+PHASES = ['ki', 'sho', 'ten', 'ketsu']
+THEMES = ['学園祭', 'カフェでの出会い', '雪山の山小屋', '深夜のコンビニ', '宇宙船の食堂']
+
+
+class BenchError(Exception):
+    pass
+
+
+# ========================================
+# HTTP クライアント
+# ========================================
+class Client:
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+
+    def request(self, method, path, body=None, label=None, timeout=120):
+        """(ステータスコード, JSON) を返す。304 は (304, None)"""
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as res:
+                status, payload = res.status, res.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        self.recorder.record(label or f"{method} {path.split('/')[1]}", time.perf_counter() - started)
+        if status == 304 or not payload:
+            return status, None
+        return status, json.loads(payload)
+
+
+class Recorder:
+    """スレッドから集めたレイテンシ（秒）を種類ごとに保持する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+
+# ========================================
+# 1ユーザー分のシナリオ
+# ========================================
+def wait_status(client, session_id, done, version=0, poll_timeout=20):
+    """/status のロングポーリングで status が done のいずれかになるまで待つ"""
+    while True:
+        status, data = client.request(
+            'GET', f"/status/{session_id}?since_version={version}&timeout={poll_timeout}",
+            label='GET /status')
+        if status == 304:
+            continue
+        if status != 200:
+            raise BenchError(f"/status が {status} を返しました")
+        version = data.get('version', version)
+        if data['status'] == 'error':
+            raise BenchError(f"生成エラー: {data.get('error')}")
+        if data['status'] in done:
+            return data
+
+
+def run_session(client, theme, args, phases):
+    started = time.perf_counter()
+
+    t = time.perf_counter()
+    status, data = client.request('POST', '/start', {'theme': theme}, label='POST /start')
+    if status != 200:
+        raise BenchError(f"/start が {status} を返しました")
+    session_id = data['session_id']
+    wait_status(client, session_id, ('ready',))
+    phases.record('start', time.perf_counter() - t)
+
+    for phase in PHASES:
+        time.sleep(args.think)
+        t = time.perf_counter()
+        status, _ = client.request('POST', '/continue', {'session_id': session_id, 'direction': ''},
+                                   label='POST /continue')
+        if status != 200:
+            raise BenchError(f"/continue が {status} を返しました")
+        wait_status(client, session_id, ('continue', 'complete'))
+        phases.record(phase, time.perf_counter() - t)
+    story_done = time.perf_counter()
+
+    t = time.perf_counter()
+    status, _ = client.request('GET', f"/result/{session_id}", label='GET /result')
+    if status != 200:
+        raise BenchError(f"/result が {status} を返しました")
+    phases.record('result', time.perf_counter() - t)
+
+    while True:
+        status, data = client.request('GET', f"/comic/{session_id}", label='GET /comic')
+        if status != 200:
+            raise BenchError(f"/comic が {status} を返しました")
+        if data['comic_status'] in ('complete', 'error'):
+            break
+        time.sleep(args.poll_interval)
+    if data['comic_status'] == 'error' or not data['comic_images']:
+        raise BenchError("漫画の生成に失敗しました")
+    # 漫画は結フェーズの完了から生成が始まる
+    phases.record('comic', time.perf_counter() - story_done)
+    phases.record('session', time.perf_counter() - started)
+
+
+# ========================================
+# サーバー
+# ========================================
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args):
+    port = free_port()
+    env = dict(
+        os.environ,
+        ECHO_BACKEND='fake',
+        ECHO_RPM=str(args.rpm),
+        ECHO_FAKE_TEXT_LATENCY=args.text_latency,
+        ECHO_FAKE_IMAGE_LATENCY=args.image_latency,
+        ECHO_FAKE_429_RATE=str(args.rate_429),
+        ECHO_FAKE_TIMEOUT_RATE=str(args.timeout_rate),
+        PYTHONUNBUFFERED='1',
+    )
+    if args.seed is not None:
+        env['ECHO_FAKE_SEED'] = str(args.seed)
+    if args.server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers), '--threads', str(args.threads),
+               '--timeout', '0', 'web_echo_interactive:app']
+    else:
+        cmd = [sys.executable, '-c',
+               f"import web_echo_interactive as w; w.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=SRC_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise BenchError(f"サーバーが起動しませんでした（終了コード {proc.returncode}）")
+        try:
+            urllib.request.urlopen(base_url + '/stats', timeout=1).read()
+            return proc, base_url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise BenchError("サーバーの起動待ちがタイムアウトしました")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def child_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss は Linux では KB、macOS ではバイト
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return usage.ru_utime + usage.ru_stime, rss_mb
+
+
+# ========================================
+# 実行
+# ========================================
+def run(args):
+    phases = Recorder()
+    http = Recorder()
+    errors = []
+    proc = None
+    if args.url:
+        base_url = args.url
+    else:
+        cpu_before, _ = child_usage()
+        proc, base_url = start_server(args)
+
+    def user(index):
+        client = Client(base_url, http)
+        for n in range(args.sessions):
+            theme = THEMES[(index + n) % len(THEMES)]
+            try:
+                run_session(client, theme, args, phases)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    print(f"[INFO] ベンチマーク開始: users={args.users} sessions/user={args.sessions} url={base_url}")
+    started = time.perf_counter()
+    threads = []
+    for i in range(args.users):
+        thread = threading.Thread(target=user, args=(i,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.ramp / max(1, args.users))
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    server_stats = None
+    try:
+        server_stats = json.loads(urllib.request.urlopen(base_url + '/stats', timeout=5).read())
+    except OSError:
+        pass
+
+    completed = len(phases.samples.get('session', []))
+    server = {"cpu_seconds": None, "cpu_seconds_per_session": None, "peak_rss_mb": None}
+    if proc is not None:
+        stop_server(proc)
+        cpu_after, rss_mb = child_usage()
+        cpu = cpu_after - cpu_before
+        server = {
+            "cpu_seconds": cpu,
+            "cpu_seconds_per_session": cpu / completed if completed else None,
+            "peak_rss_mb": rss_mb,
+        }
+
+    return {
+        "kind": "pipeline",
+        "meta": metadata(),
+        "params": {
+            "users": args.users, "sessions_per_user": args.sessions, "server": args.server,
+            "workers": args.workers, "threads": args.threads, "rpm": args.rpm,
+            "text_latency": args.text_latency, "image_latency": args.image_latency,
+            "rate_429": args.rate_429, "timeout_rate": args.timeout_rate,
+            "think": args.think, "url": args.url,
+        },
+        "sessions": {"started": args.users * args.sessions, "completed": completed, "failed": len(errors)},
+        "errors": errors[:20],
+        "wall_seconds": wall,
+        "sessions_per_min": completed / wall * 60 if wall else 0,
+        "phases": {name: summarize(values) for name, values in phases.samples.items()},
+        "http": {name: summarize(values) for name, values in http.samples.items()},
+        "server": server,
+        "server_stats": server_stats,
+    }
+
+
+def print_report(result):
+    print(f"\n完了 {result['sessions']['completed']}/{result['sessions']['started']} セッション "
+          f"（失敗 {result['sessions']['failed']}） {result['wall_seconds']:.1f}秒 "
+          f"→ {result['sessions_per_min']:.1f} セッション/分")
+    print(f"{'フェーズ':<16}{'件数':>6}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name in ['start'] + PHASES + ['result', 'comic', 'session']:
+        s = result['phases'].get(name)
+        if s and s['count']:
+            print(f"{name:<16}{s['count']:>6}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['p99']:>9.3f}")
+    for name, s in sorted(result['http'].items()):
+        print(f"{name:<16}{s['count']:>6}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['p99']:>9.3f}")
+    server = result['server']
+    if server['cpu_seconds'] is not None:
+        line = f"サーバー CPU {server['cpu_seconds']:.2f}秒"
+        if server['cpu_seconds_per_session'] is not None:
+            line += f"（1セッションあたり {server['cpu_seconds_per_session']:.3f}秒）"
+        print(f"{line} / ピーク RSS {server['peak_rss_mb']:.1f} MB")
+    for error in result['errors'][:5]:
+        print(f"[ERROR] {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='同時ユーザー数')
+    parser.add_argument('--sessions', type=int, default=1, help='ユーザーあたりのセッション数')
+    parser.add_argument('--ramp', type=float, default=1.0, help='全ユーザーが開始するまでの秒数')
+    parser.add_argument('--think', type=float, default=0.0, help='フェーズ間のユーザーの待ち時間（秒）')
+    parser.add_argument('--poll-interval', type=float, default=0.25, help='/comic のポーリング間隔（秒）')
+    parser.add_argument('--url', help='起動済みサーバーの URL（指定しなければ子プロセスで起動）')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--rpm', type=int, default=0, help='サーバーの ECHO_RPM（0 でレート制限なし）')
+    parser.add_argument('--text-latency', default='lognormal:-0.7:0.4')
+    parser.add_argument('--image-latency', default='uniform:3:6')
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--server-log', help='サーバーの出力を保存するファイル')
+    parser.add_argument('--out', help='結果 JSON の出力先（既定: benchmarks/results/pipeline-<git>.json）')
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+    print(f"[INFO] 結果を保存: {write_result('pipeline', result, args.out)}")
+
+
+if __name__ == '__main__':
+    main()
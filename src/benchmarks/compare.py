@@ -0,0 +1,71 @@
+"""
+compare.py
+Project Echo - ベンチマーク結果（bench_pipeline / bench_micro の JSON）の比較
+
+    python benchmarks/compare.py 変更前.json 変更後.json [--threshold 10]
+
+悪化が閾値（%）を超えた項目があれば終了コード 1 を返す（デプロイ前のチェック用）。
+"""
+
+import argparse
+import json
+import sys
+
+
+def metrics(result):
+    """比較する指標を (名前, 値, 大きいほど良いか) で列挙する"""
+    if result.get('kind') == 'micro':
+        for name, m in sorted(result['micro'].items()):
+            yield f"micro.{name}.median_ns", m['median_ns'], False
+        return
+
+    yield "sessions_per_min", result['sessions_per_min'], True
+    yield "sessions.failed", result['sessions']['failed'], False
+    for group in ('phases', 'http'):
+        for name, s in sorted(result[group].items()):
+            for p in ('p50', 'p95', 'p99'):
+                if s.get(p) is not None:
+                    yield f"{group}.{name}.{p}", s[p], False
+    for name in ('cpu_seconds_per_session', 'peak_rss_mb'):
+        if result['server'].get(name) is not None:
+            yield f"server.{name}", result['server'][name], False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='悪化とみなす変化率（%%）')
+    args = parser.parse_args()
+
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+    if before.get('kind') != after.get('kind'):
+        sys.exit(f"[ERROR] 種類の違う結果は比較できません: {before.get('kind')} / {after.get('kind')}")
+
+    print(f"{before['meta']['git']} → {after['meta']['git']}")
+    old = {name: (value, higher) for name, value, higher in metrics(before)}
+    regressions = []
+    for name, value, higher_is_better in metrics(after):
+        if name not in old:
+            continue
+        prev = old[name][0]
+        change = (value - prev) / prev * 100 if prev else (0.0 if value == prev else float('inf'))
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > args.threshold:
+            mark = "  ← 悪化"
+            regressions.append(name)
+        elif worse < -args.threshold:
+            mark = "  ← 改善"
+        print(f"{name:<40}{prev:>12.4g}{value:>12.4g}{change:>+9.1f}%{mark}")
+
+    if regressions:
+        print(f"\n[WARN] {len(regressions)}項目が {args.threshold:.0f}% 以上悪化しました")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
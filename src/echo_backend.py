@@ -0,0 +1,405 @@
+"""
+echo_backend.py
+Project Echo - テキスト生成・画像生成のバックエンド
+
+アプリは Vertex AI を直接呼ばず、ここのバックエンド経由で呼び出す。
+    backend = backend_from_env(project=PROJECT_ID, location=LOCATION)
+    model = backend.text_model("gemini-2.0-flash-001")
+    text = call_with_retry(model, prompt)                         # echo_retry 経由
+    png = backend.image_model("imagen-3.0-generate-001").generate_image(prompt)
+
+- VertexBackend: Gemini / Imagen（vertexai は最初の呼び出し時に import・初期化する）
+- FakeBackend:   ネットワーク不要の負荷試験用。スキーマどおりの JSON と PNG を返し、
+                 レイテンシ分布・429・タイムアウトを設定どおりに発生させる
+
+generation_config はバックエンド共通の dict で渡す
+    {"response_mime_type": "application/json", "response_schema": {...}}
+
+環境変数:
+    ECHO_BACKEND               "vertex"（既定）または "fake"
+    ECHO_FAKE_TEXT_LATENCY     テキスト1回のレイテンシ分布（既定: "lognormal:-0.7:0.4"）
+    ECHO_FAKE_IMAGE_LATENCY    画像1枚のレイテンシ分布（既定: "uniform:3:6"）
+    ECHO_FAKE_429_RATE         429 を返す確率（既定: 0）
+    ECHO_FAKE_TIMEOUT_RATE     応答せずに止まる確率（既定: 0）
+    ECHO_FAKE_TIMEOUT_SECONDS  止まったときに 504 を返すまでの秒数（既定: 90）
+    ECHO_FAKE_IMAGE_SIZE       生成する PNG の一辺（既定: 256）
+    ECHO_FAKE_SEED             乱数シード（指定するとレイテンシ・障害の発生順も再現できる）
+
+レイテンシ分布の書式:
+    "const:0.5" / "uniform:0.2:1.0" / "normal:0.8:0.2" / "lognormal:-0.7:0.4" / "exp:0.5"（平均）
+"""
+
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+from echo_logging import get_logger
+
+log = get_logger(__name__)
+
+
+class ModelBackend:
+    """バックエンドのインターフェース"""
+
+    name = "base"
+
+    def generate_text(self, model_name, prompt, generation_config=None):
+        """テキストを1回生成して返す"""
+        raise NotImplementedError
+
+    def stream_text(self, model_name, prompt, generation_config=None):
+        """生成されたテキストをチャンクごとに yield する"""
+        raise NotImplementedError
+
+    def generate_image(self, model_name, prompt, **options):
+        """画像を1枚生成して PNG のバイト列を返す"""
+        raise NotImplementedError
+
+    def text_model(self, model_name):
+        return TextModel(self, model_name)
+
+    def image_model(self, model_name):
+        return ImageModel(self, model_name)
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class TextModel:
+    """モデル名を束ねたハンドル（echo_retry.model_name_of() は _model_name を見る）"""
+
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self._model_name = model_name
+
+    def generate_text(self, prompt, generation_config=None):
+        return self.backend.generate_text(self._model_name, prompt, generation_config)
+
+    def stream_text(self, prompt, generation_config=None):
+        return self.backend.stream_text(self._model_name, prompt, generation_config)
+
+
+class ImageModel:
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self._model_name = model_name
+
+    def generate_image(self, prompt, **options):
+        return self.backend.generate_image(self._model_name, prompt, **options)
+
+
+# ========================================
+# Vertex AI
+# ========================================
+class VertexBackend(ModelBackend):
+    """Gemini / Imagen を呼ぶ本番用バックエンド"""
+
+    name = "vertex"
+
+    def __init__(self, project=None, location="us-central1"):
+        self.project = project
+        self.location = location
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._image_models = {}
+
+    def _init(self):
+        if self._initialized:
+            return
+        with self._lock:
+            if self._initialized:
+                return
+            import vertexai
+            try:
+                vertexai.init(project=self.project, location=self.location)
+                log.info("Vertex AI 初期化完了: project=%s, location=%s", self.project, self.location)
+            except Exception as e:
+                log.warning("Vertex AI 初期化エラー: %s", e)
+                log.warning("Google Cloud認証が必要かもしれません: gcloud auth application-default login")
+            self._initialized = True
+
+    def _model(self, model_name):
+        self._init()
+        from vertexai.preview.generative_models import GenerativeModel
+        return GenerativeModel(model_name)
+
+    @staticmethod
+    def _config(generation_config):
+        if generation_config is None or not isinstance(generation_config, dict):
+            return generation_config
+        from vertexai.preview.generative_models import GenerationConfig
+        return GenerationConfig(**generation_config)
+
+    def generate_text(self, model_name, prompt, generation_config=None):
+        response = self._model(model_name).generate_content(
+            prompt, generation_config=self._config(generation_config))
+        return response.text
+
+    def stream_text(self, model_name, prompt, generation_config=None):
+        responses = self._model(model_name).generate_content(
+            prompt, generation_config=self._config(generation_config), stream=True)
+        for chunk in responses:
+            yield chunk.text
+
+    def generate_image(self, model_name, prompt, **options):
+        self._init()
+        with self._lock:
+            imagen = self._image_models.get(model_name)
+            if imagen is None:
+                from vertexai.preview.vision_models import ImageGenerationModel
+                imagen = self._image_models[model_name] = ImageGenerationModel.from_pretrained(model_name)
+        images = imagen.generate_images(prompt=prompt, number_of_images=1, **options)
+        if not images:
+            raise Exception("画像生成APIが空のレスポンスを返しました")
+        return images[0]._image_bytes
+
+
+# ========================================
+# 負荷試験用の偽バックエンド
+# ========================================
+class ResourceExhausted(Exception):
+    """偽の 429（echo_retry.classify_error は rate_limit と判定する）"""
+
+
+class GatewayTimeout(Exception):
+    """偽の 504（echo_retry.classify_error は unavailable と判定する）"""
+
+
+class LatencyDistribution:
+    """"lognormal:-0.7:0.4" のような書式のレイテンシ分布（秒）"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, *params = spec.split(":")
+        self.kind = kind.strip().lower()
+        self.params = [float(p) for p in params]
+        if self.kind not in ("const", "uniform", "normal", "lognormal", "exp"):
+            raise ValueError(f"未知のレイテンシ分布: {spec}")
+
+    def sample(self, rng):
+        p = self.params
+        if self.kind == "const":
+            value = p[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            value = rng.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(p[0], p[1])
+        else:
+            value = rng.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+        return max(0.0, value)
+
+    def __repr__(self):
+        return self.spec
+
+
+_FAKE_NAMES = ["タクミ", "アヤカ", "ハルト", "ミサキ", "ソウタ", "ユイナ", "レン", "ヒナタ"]
+_FAKE_TITLES = ["雨上がりの約束", "秘密の放課後", "最後の一杯", "星降る交差点", "忘れ物の行方"]
+_FAKE_SENTENCES = [
+    "その日、カフェの中で二人は偶然同じテーブルに座った。",
+    "窓の外では小雨が降り続き、店内には静かな音楽が流れていた。",
+    "彼は何かを言いかけて、カップを持つ手を止めた。",
+    "彼女は微笑みながらも、視線だけは相手から外さなかった。",
+    "沈黙の中で、二人はそれぞれの思惑を胸に秘めていた。",
+    "思いがけない一言が、張り詰めた空気を和らげた。",
+    "遠くで鐘の音が鳴り、約束の時間が近づいていることを告げた。",
+    "ふと目が合い、二人は同時に小さく笑った。",
+]
+_FAKE_ENGLISH = [
+    "two friends talking in a cozy cafe on a rainy afternoon, warm light, gentle smiles",
+    "a boy and a girl standing at a crossroads under the evening sky, hopeful expressions",
+    "two students sharing a secret in an empty classroom, sunset through the windows",
+]
+
+
+def _png_bytes(width, height, rgb):
+    """単色の PNG（依存ライブラリなし）"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height, 6))
+            + chunk(b"IEND", b""))
+
+
+class FakeBackend(ModelBackend):
+    """
+    ネットワークもクォータも使わない決定的なバックエンド
+
+    応答内容はプロンプトのハッシュから決まる（同じプロンプトには同じ応答）。
+    response_schema があればスキーマどおりの JSON を、無ければプロンプト中の
+    出力形式の例（"narrative" / "inner_thought" / "suggestions" など）に合わせた JSON を返す。
+    """
+
+    name = "fake"
+
+    def __init__(self, text_latency="lognormal:-0.7:0.4", image_latency="uniform:3:6",
+                 rate_limit_rate=0.0, timeout_rate=0.0, timeout_seconds=90.0,
+                 image_size=256, seed=None):
+        self.text_latency = LatencyDistribution(text_latency)
+        self.image_latency = LatencyDistribution(image_latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.image_size = image_size
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"text": 0, "stream": 0, "image": 0, "rate_limited": 0, "timeouts": 0}
+
+    @classmethod
+    def from_env(cls):
+        seed = os.environ.get("ECHO_FAKE_SEED")
+        return cls(
+            text_latency=os.environ.get("ECHO_FAKE_TEXT_LATENCY", "lognormal:-0.7:0.4"),
+            image_latency=os.environ.get("ECHO_FAKE_IMAGE_LATENCY", "uniform:3:6"),
+            rate_limit_rate=float(os.environ.get("ECHO_FAKE_429_RATE", "0")),
+            timeout_rate=float(os.environ.get("ECHO_FAKE_TIMEOUT_RATE", "0")),
+            timeout_seconds=float(os.environ.get("ECHO_FAKE_TIMEOUT_SECONDS", "90")),
+            image_size=int(os.environ.get("ECHO_FAKE_IMAGE_SIZE", "256")),
+            seed=int(seed) if seed else None,
+        )
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, **self._stats}
+
+    # ---------- 遅延と障害 ----------
+    def _begin(self, kind, latency):
+        """呼び出し1回分の遅延を決め、429 / タイムアウトを注入する"""
+        with self._lock:
+            self._stats[kind] += 1
+            roll = self._rng.random()
+            delay = latency.sample(self._rng)
+            if roll < self.rate_limit_rate:
+                self._stats["rate_limited"] += 1
+                fault = 'rate_limit'
+            elif roll < self.rate_limit_rate + self.timeout_rate:
+                self._stats["timeouts"] += 1
+                fault = 'timeout'
+            else:
+                fault = None
+
+        if fault == 'rate_limit':
+            time.sleep(min(delay, 0.05))
+            raise ResourceExhausted("429 Resource exhausted (fake backend). Please retry in 1s")
+        if fault == 'timeout':
+            time.sleep(self.timeout_seconds)
+            raise GatewayTimeout("504 Deadline exceeded (fake backend)")
+        return delay
+
+    # ---------- 応答内容 ----------
+    @staticmethod
+    def _seeded(model_name, prompt):
+        digest = hashlib.sha256(f"{model_name}\n{prompt}".encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def _from_schema(self, schema, rng, field=None, index=0):
+        kind = str(schema.get("type", "string")).lower()
+        if kind == "object":
+            return {
+                key: self._from_schema(sub, rng, key, index)
+                for key, sub in schema.get("properties", {}).items()
+            }
+        if kind == "array":
+            count = schema.get("min_items") or schema.get("minItems") or (3 if field == "suggestions" else 2)
+            return [self._from_schema(schema.get("items", {}), rng, field, i) for i in range(count)]
+        if kind == "integer":
+            return rng.randint(16, 40) if field == "age" else rng.randint(1, 10)
+        if kind == "number":
+            return round(rng.uniform(0, 1), 3)
+        if kind == "boolean":
+            return rng.random() < 0.5
+        return self._string(field, rng, index)
+
+    @staticmethod
+    def _string(field, rng, index=0):
+        if field == "name":
+            # 配列の何番目かで名前の範囲を分け、同じ応答内で名前が重複しないようにする
+            return _FAKE_NAMES[(index * 3 + rng.randrange(3)) % len(_FAKE_NAMES)]
+        if field in ("story_title", "title"):
+            return rng.choice(_FAKE_TITLES)
+        if field == "narrative":
+            return "".join(rng.sample(_FAKE_SENTENCES, 4))
+        if field == "speech_style":
+            return rng.choice(["丁寧語", "砕けた口調", "関西弁", "ぶっきらぼう"])
+        if field in ("image_prompt", "prompt", "appearance"):
+            return rng.choice(_FAKE_ENGLISH)
+        return rng.choice(_FAKE_SENTENCES)
+
+    def _from_prompt(self, prompt, rng):
+        """スキーマ指定の無い呼び出し: プロンプト中の出力形式の例から応答を組み立てる"""
+        if '"secret_goal"' in prompt:
+            base = rng.randrange(len(_FAKE_NAMES))
+            data = [{
+                "name": _FAKE_NAMES[(base + i) % len(_FAKE_NAMES)],
+                "age": rng.randint(16, 40),
+                "public_persona": rng.choice(_FAKE_SENTENCES),
+                "secret_goal": rng.choice(_FAKE_SENTENCES),
+                "speech_style": self._string("speech_style", rng),
+            } for i in range(2)]
+        elif '"narrative"' in prompt:
+            data = {"narrative": self._string("narrative", rng), "inner_thought": rng.choice(_FAKE_SENTENCES)}
+        elif '"dialogue"' in prompt:
+            data = {"dialogue": rng.choice(_FAKE_SENTENCES), "inner_thought": rng.choice(_FAKE_SENTENCES)}
+        elif '"suggestions"' in prompt:
+            data = {"suggestions": rng.sample(_FAKE_SENTENCES, 3)}
+        elif '"inner_thought"' in prompt:
+            data = {"inner_thought": rng.choice(_FAKE_SENTENCES)}
+        elif "英語" in prompt:
+            return rng.choice(_FAKE_ENGLISH)
+        elif "題名" in prompt:
+            return rng.choice(_FAKE_TITLES)
+        else:
+            return "".join(rng.sample(_FAKE_SENTENCES, 2))
+        # JSON モードでない Gemini はコードフェンス付きで返すことが多い
+        return "```json\n" + json.dumps(data, ensure_ascii=False, indent=2) + "\n```"
+
+    def _text(self, model_name, prompt, generation_config):
+        rng = self._seeded(model_name, prompt)
+        schema = (generation_config or {}).get("response_schema") \
+            if isinstance(generation_config, dict) else None
+        if schema:
+            return json.dumps(self._from_schema(schema, rng), ensure_ascii=False)
+        return self._from_prompt(prompt, rng)
+
+    # ---------- 公開 API ----------
+    def generate_text(self, model_name, prompt, generation_config=None):
+        delay = self._begin("text", self.text_latency)
+        time.sleep(delay)
+        return self._text(model_name, prompt, generation_config)
+
+    def stream_text(self, model_name, prompt, generation_config=None):
+        delay = self._begin("stream", self.text_latency)
+        text = self._text(model_name, prompt, generation_config)
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+        # 最初のチャンクまでに3割、残りをチャンク間に均等に配分
+        time.sleep(delay * 0.3)
+        for chunk in chunks:
+            yield chunk
+            time.sleep(delay * 0.7 / len(chunks))
+
+    def generate_image(self, model_name, prompt, **options):
+        delay = self._begin("image", self.image_latency)
+        time.sleep(delay)
+        rgb = hashlib.sha256(prompt.encode('utf-8')).digest()[:3]
+        return _png_bytes(self.image_size, self.image_size, rgb)
+
+
+def backend_from_env(project=None, location="us-central1"):
+    name = os.environ.get("ECHO_BACKEND", "vertex").lower()
+    if name == "fake":
+        backend = FakeBackend.from_env()
+        log.info("偽バックエンドを使用: text=%s image=%s 429=%s timeout=%s",
+                 backend.text_latency, backend.image_latency, backend.rate_limit_rate, backend.timeout_rate)
+        return backend
+    if name != "vertex":
+        raise ValueError(f"未知のバックエンド: {name}")
+    return VertexBackend(project=project, location=location)
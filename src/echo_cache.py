@@ -0,0 +1,260 @@
+"""
+echo_cache.py
+Project Echo - LLM レスポンスキャッシュ（オプトイン）
+
+キー = (モデル名, プロンプトの SHA-256, 生成設定) のハッシュ。
+- メモリ層: 件数上限付き LRU
+- ディスク層: ECHO_CACHE_DIR 配下に1キー1ファイルの JSON（再起動後も有効）
+- 種類（kind）ごとの TTL。TTL が設定された kind だけをキャッシュする
+- バリエーションモード: 1キーにつき最大 K 件の応答を貯め、K 件たまったら
+  その中からランダムに返す（同じテーマでも毎回同じ物語にならないように）
+- validate を渡すと、検証に通った応答だけを保存する（壊れた JSON などを貯めない）。
+  キャッシュから返す応答も検証し直し、通らなければ捨ててモデルを呼び直す
+
+環境変数:
+    ECHO_CACHE              "1" で有効化（既定: 無効）
+    ECHO_CACHE_DIR          ディスク層のディレクトリ（既定: /tmp/echo_cache、空文字でディスク層なし）
+    ECHO_CACHE_MAX_ENTRIES  メモリ層の最大キー数（既定: 1000）
+    ECHO_CACHE_VARIANTS     1キーあたりのバリエーション数 K（既定: 1）
+    ECHO_CACHE_TTLS         kind ごとの TTL 秒 例: "characters=86400,title=86400"
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from echo_logging import get_logger
+from echo_retry import call_with_retry, model_name_of
+
+log = get_logger(__name__)
+
+# kind ごとの既定 TTL（秒）。ここに無い kind（語り手・内心など物語固有のもの）はキャッシュしない
+DEFAULT_TTLS = {
+    'setup': 7 * 86400,
+    'characters': 7 * 86400,
+    'situation': 7 * 86400,
+    'title': 7 * 86400,
+    'suggestions': 86400,
+}
+
+# kind ごとの統計（invalid: 検証に通らず保存しなかった応答 / discarded: 検証に通らず捨てたキャッシュ）
+_COUNTERS = ('hits', 'disk_hits', 'misses', 'stores', 'evictions', 'invalid', 'discarded')
+
+
+def _config_repr(generation_config):
+    if generation_config is None:
+        return None
+    if hasattr(generation_config, 'to_dict'):
+        return generation_config.to_dict()
+    if isinstance(generation_config, dict):
+        return generation_config
+    return repr(generation_config)
+
+
+def cache_key(model_name, prompt, generation_config=None):
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    material = json.dumps(
+        [model_name, prompt_hash, _config_repr(generation_config)],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class InvalidResponse(ValueError):
+    """モデルの応答が validate に通らなかった（キャッシュには保存していない）。text は元の応答"""
+
+    def __init__(self, message, text):
+        super().__init__(message)
+        self.text = text
+
+
+class ResponseCache:
+    def __init__(self, enabled=False, cache_dir=None, max_entries=1000, variants=1, ttls=None):
+        self.enabled = enabled
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.variants = max(1, variants)
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()   # key -> {"kind", "expires_at", "variants": [...]}
+        self._stats = {}
+        if enabled and cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        ttls = dict(DEFAULT_TTLS)
+        for item in os.environ.get("ECHO_CACHE_TTLS", "").split(","):
+            if "=" in item:
+                kind, ttl = item.split("=", 1)
+                ttls[kind.strip()] = float(ttl)
+        return cls(
+            enabled=os.environ.get("ECHO_CACHE", "") == "1",
+            cache_dir=os.environ.get("ECHO_CACHE_DIR", "/tmp/echo_cache") or None,
+            max_entries=int(os.environ.get("ECHO_CACHE_MAX_ENTRIES", "1000")),
+            variants=int(os.environ.get("ECHO_CACHE_VARIANTS", "1")),
+            ttls=ttls,
+        )
+
+    def enabled_for(self, kind):
+        return self.enabled and self.ttls.get(kind, 0) > 0
+
+    # ---------- 統計 ----------
+    def _count(self, kind, name):
+        with self._lock:
+            self._stats.setdefault(kind, dict.fromkeys(_COUNTERS, 0))[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._memory),
+                "variants": self.variants,
+                "kinds": {kind: dict(c) for kind, c in self._stats.items()},
+            }
+
+    # ---------- 各層 ----------
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load(self, key):
+        """メモリ → ディスクの順に探す。期限切れは削除して None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry['expires_at'] > now:
+                    self._memory.move_to_end(key)
+                    return entry, 'memory'
+                del self._memory[key]
+
+        if not self.cache_dir:
+            return None, None
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        if entry.get('expires_at', 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, None
+        self._remember(key, entry)
+        return entry, 'disk'
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                _, evicted = self._memory.popitem(last=False)
+                self._stats.setdefault(evicted['kind'], dict.fromkeys(_COUNTERS, 0))['evictions'] += 1
+
+    def _write(self, key, entry):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("キャッシュ書き込み失敗: %s", e)
+
+    def _store(self, key, kind, text):
+        entry, _ = self._load(key)
+        if entry is None:
+            entry = {"kind": kind, "expires_at": time.time() + self.ttls[kind], "variants": []}
+        else:
+            entry = dict(entry, variants=list(entry['variants']))
+        if len(entry['variants']) < self.variants:
+            entry['variants'].append(text)
+        self._remember(key, entry)
+        self._count(kind, 'stores')
+        self._write(key, entry)
+
+    def _discard(self, key, kind, text):
+        """検証に通らなくなった応答を1件捨てる（残りが無ければキーごと消す）"""
+        entry, _ = self._load(key)
+        if entry is None or text not in entry['variants']:
+            return
+        variants = [v for v in entry['variants'] if v != text]
+        self._count(kind, 'discarded')
+        if variants:
+            entry = dict(entry, variants=variants)
+            self._remember(key, entry)
+            self._write(key, entry)
+            return
+        with self._lock:
+            self._memory.pop(key, None)
+        if self.cache_dir:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    # ---------- 公開 API ----------
+    def get_or_call(self, kind, model_name, prompt, call, generation_config=None, validate=None):
+        """
+        キャッシュにあれば返し、無ければ call() を実行して保存する。
+        バリエーションモードでは K 件たまるまでは毎回 call() して候補を増やす。
+
+        validate(text) を渡すと、その戻り値を返す。validate が ValueError を送出した応答は
+        保存せず InvalidResponse（元の応答を text に持つ）を送出する。
+        """
+        check = validate or (lambda text: text)
+        if not self.enabled_for(kind):
+            text = call()
+            try:
+                return check(text)
+            except ValueError as e:
+                raise InvalidResponse(str(e), text) from e
+
+        key = cache_key(model_name, prompt, generation_config)
+        entry, tier = self._load(key)
+        if entry is not None and len(entry['variants']) >= self.variants:
+            text = random.choice(entry['variants'])
+            try:
+                value = check(text)
+            except ValueError as e:
+                # 検証の条件が変わった古い応答など。捨ててモデルを呼び直す
+                log.warning("キャッシュの応答が検証に通らないため破棄 (%s): %s", kind, e)
+                self._discard(key, kind, text)
+            else:
+                self._count(kind, 'disk_hits' if tier == 'disk' else 'hits')
+                return value
+
+        self._count(kind, 'misses')
+        text = call()
+        try:
+            value = check(text)
+        except ValueError as e:
+            self._count(kind, 'invalid')
+            raise InvalidResponse(str(e), text) from e
+        self._store(key, kind, text)
+        return value
+
+
+response_cache = ResponseCache.from_env()
+
+
+def cached_call_with_retry(kind, model, prompt, validate=None, **kwargs):
+    """
+    call_with_retry の前段にキャッシュを挟む（kind に TTL が無ければそのまま呼び出す）。
+    validate を渡すと検証済みの値を返し、検証に通った応答だけをキャッシュする
+    """
+    return response_cache.get_or_call(
+        kind, model_name_of(model), prompt,
+        lambda: call_with_retry(model, prompt, kind=kind, **kwargs),
+        kwargs.get('generation_config'),
+        validate=validate,
+    )
@@ -0,0 +1,32 @@
+"""
+echo_image_jobs.py
+Project Echo - 画像生成ジョブキュー
+
+セッションが完了するたびにスレッドを立てる代わりに、スケジューラ（echo_scheduler）の
+'image' キューと固定数のワーカースレッドで画像生成（プロンプト生成 + Imagen）を処理する。
+- 1ジョブ = 1パネル。複数セッション・複数パネルがワーカー数まで並行に進む
+- Imagen のクォータは各ジョブ内の retry_call（共有レートリミッタ）で守る
+- 完了が集中してもキューに積まれるだけで、スレッドは増えない
+- キューが一杯のまま空かなければ submit() が ImageQueueFull を送出する
+
+    future = image_jobs.submit(generate_panel, session_id, index, label="ki")
+    future.add_done_callback(on_panel_done)
+
+環境変数:
+    ECHO_IMAGE_WORKERS     ワーカースレッド数（既定: 4）
+    ECHO_IMAGE_QUEUE_SIZE  待機できるジョブ数の上限（既定: 200）
+    ECHO_IMAGE_QUEUE_WAIT  キューが一杯のときに空きを待つ秒数（既定: 5）
+"""
+
+import os
+
+from echo_scheduler import scheduler, QueueFull
+
+ImageQueueFull = QueueFull
+
+image_jobs = scheduler.queue(
+    'image',
+    workers=int(os.environ.get("ECHO_IMAGE_WORKERS", "4")),
+    max_queued=int(os.environ.get("ECHO_IMAGE_QUEUE_SIZE", "200")),
+    put_timeout=float(os.environ.get("ECHO_IMAGE_QUEUE_WAIT", "5")),
+)
@@ -0,0 +1,390 @@
+"""
+echo_image_store.py
+Project Echo - 生成画像のコンテンツアドレス型ストア
+
+画像は内容の SHA-256 をファイル名にして保存する（同じ画像は1回だけ保存される）。
+保存時に一度だけ派生画像を作る（Pillow がある場合のみ。無ければ PNG だけ）:
+    <hash>.png         元画像
+    <hash>.webp        WebP（同じ解像度）
+    <hash>_thumb.webp  サムネイル（長辺 ECHO_IMAGE_THUMB_SIZE）
+    <hash>.sessions    この画像を使っているセッション ID（1行1件）
+ファイル名が内容で決まるので、配信時は immutable な長期キャッシュと ETag を付けられる。
+
+同じモデル・同じプロンプトで生成済みの画像は lookup() で再利用できる
+（prompts/<プロンプトのハッシュ> に画像のハッシュを記録する）。
+
+保持期間（Cloud Run では画像ディレクトリがメモリ上の tmpfs なので、放置すると OOM になる）:
+- release_session(): セッションが期限切れになったら、そのセッションだけが使っていた画像を削除
+- collect(): 最終アクセスから ECHO_IMAGE_MAX_AGE 秒を過ぎた画像を削除し、
+  合計が ECHO_IMAGE_BUDGET_MB を超えていれば最終アクセスの古い順（LRU）に削除
+- 最終アクセス時刻は PNG の mtime にも書き戻すので、起動時の scan() で
+  ディレクトリから索引（サイズ・最終アクセス・使用セッション）を作り直せる
+- start_collector() のスレッドが定期的に scan() + collect() する
+  （同じディレクトリを使う他のワーカープロセスが保存・削除した画像も取り込む）
+
+環境変数:
+    ECHO_IMAGE_DIR          保存先ディレクトリ（既定: アプリの static/images）
+    ECHO_IMAGE_URL_PREFIX   配信 URL の接頭辞（既定: /images）
+    ECHO_IMAGE_WEBP_QUALITY WebP の品質（既定: 80）
+    ECHO_IMAGE_THUMB_SIZE   サムネイルの長辺ピクセル（既定: 384）
+    ECHO_IMAGE_BUDGET_MB    画像ディレクトリの上限（MB、既定: 256。0 で無制限）
+    ECHO_IMAGE_MAX_AGE      最終アクセスからの保持秒数（既定: 21600。0 で無制限）
+    ECHO_IMAGE_GC_INTERVAL  定期スキャン・削除の間隔（秒、既定: 60）
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:     # Pillow が無ければ派生画像は作らない
+    Image = None
+
+from echo_logging import get_logger
+
+log = get_logger(__name__)
+
+_NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(_thumb)?\.(png|webp)$')
+_FILE_PATTERN = re.compile(r'^([0-9a-f]{64})(?:\.png|\.webp|_thumb\.webp|\.sessions)$')
+_MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+_SUFFIXES = ('.png', '.webp', '_thumb.webp', '.sessions')
+
+# 最終アクセス時刻を PNG の mtime に書き戻す最短間隔（秒）。配信のたびに utime しない
+TOUCH_INTERVAL = 60
+# 書きかけの一時ファイルを削除するまでの秒数
+STALE_TMP_SECONDS = 3600
+
+
+def _new_record(last_access):
+    return {"bytes": 0, "last_access": last_access, "touched": 0.0, "sessions": set(), "prompts": set()}
+
+
+class ImageStore:
+    def __init__(self, root, url_prefix='/images', webp_quality=80, thumb_size=384,
+                 budget_bytes=256 * 1024 * 1024, max_age=21600):
+        self.root = root
+        self.url_prefix = url_prefix.rstrip('/')
+        self.webp_quality = webp_quality
+        self.thumb_size = thumb_size
+        self.budget_bytes = budget_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._index = {}    # digest -> {bytes, last_access, touched, sessions, prompts}
+        self._collector = None
+        self._stats = {"saved": 0, "reused": 0, "evicted_lru": 0, "evicted_age": 0,
+                       "evicted_session": 0, "evicted_bytes": 0}
+        os.makedirs(os.path.join(root, 'prompts'), exist_ok=True)
+        self.scan()
+
+    @classmethod
+    def from_env(cls, default_root):
+        return cls(
+            root=os.environ.get("ECHO_IMAGE_DIR") or default_root,
+            url_prefix=os.environ.get("ECHO_IMAGE_URL_PREFIX", "/images"),
+            webp_quality=int(os.environ.get("ECHO_IMAGE_WEBP_QUALITY", "80")),
+            thumb_size=int(os.environ.get("ECHO_IMAGE_THUMB_SIZE", "384")),
+            budget_bytes=int(float(os.environ.get("ECHO_IMAGE_BUDGET_MB", "256")) * 1024 * 1024),
+            max_age=float(os.environ.get("ECHO_IMAGE_MAX_AGE", "21600")),
+        )
+
+    # ---------- パス ----------
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _write(self, name, data):
+        """一時ファイルに書いてから置き換える（途中の状態を配信しない）"""
+        path = self._path(name)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def resolve(self, name):
+        """
+        配信用に (パス, MIME タイプ, ETag) を返す。無効な名前・存在しないファイルは None。
+        ETag はファイル名（内容のハッシュ + 種類）そのもの。
+        """
+        m = _NAME_PATTERN.match(name)
+        if not m:
+            return None
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        self._touch(m.group(1))
+        return path, _MIMETYPES[m.group(3)], name
+
+    # ---------- 保存 ----------
+    @staticmethod
+    def prompt_key(model_name, prompt, **options):
+        material = json.dumps([model_name, prompt, options], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _variants(self, png_bytes):
+        """(webp, サムネイル webp) のバイト列。Pillow が無い・変換できない場合は (None, None)"""
+        if Image is None:
+            return None, None
+        try:
+            with Image.open(io.BytesIO(png_bytes)) as im:
+                im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+                full = io.BytesIO()
+                im.save(full, 'WEBP', quality=self.webp_quality, method=4)
+                im.thumbnail((self.thumb_size, self.thumb_size))
+                thumb = io.BytesIO()
+                im.save(thumb, 'WEBP', quality=self.webp_quality, method=4)
+            return full.getvalue(), thumb.getvalue()
+        except Exception as e:
+            log.warning("画像の派生ファイル作成に失敗: %s", e)
+            return None, None
+
+    def save(self, png_bytes, prompt_key=None, session_id=None):
+        """
+        画像を保存して entry（URL 一式）を返す。同じ内容の画像があれば書き込まない。
+        session_id を渡すと、そのセッションが期限切れになるまで残す対象に加える
+        """
+        digest = hashlib.sha256(png_bytes).hexdigest()
+        size = 0
+        if not os.path.exists(self._path(f"{digest}.png")):
+            webp, thumb = self._variants(png_bytes)
+            if webp is not None:
+                self._write(f"{digest}.webp", webp)
+                self._write(f"{digest}_thumb.webp", thumb)
+                size += len(webp) + len(thumb)
+            # PNG を最後に書く（PNG があれば派生画像もそろっている）
+            self._write(f"{digest}.png", png_bytes)
+            size += len(png_bytes)
+        if prompt_key:
+            self._write(os.path.join('prompts', prompt_key), digest.encode('ascii'))
+
+        now = time.time()
+        with self._lock:
+            record = self._index.setdefault(digest, _new_record(now))
+            record['bytes'] += size
+            record['last_access'] = record['touched'] = now
+            if prompt_key:
+                record['prompts'].add(prompt_key)
+            self._stats['saved'] += 1
+        if session_id:
+            self._attach(digest, session_id)
+        if self.budget_bytes and self.total_bytes() > self.budget_bytes:
+            self.collect(keep=digest)
+        return self.entry(digest)
+
+    def lookup(self, prompt_key, session_id=None):
+        """同じプロンプトで生成済みの画像の entry（無ければ None）"""
+        try:
+            with open(self._path(os.path.join('prompts', prompt_key)), encoding='ascii') as f:
+                digest = f.read().strip()
+        except OSError:
+            return None
+        if not os.path.exists(self._path(f"{digest}.png")):
+            return None
+        with self._lock:
+            self._index.setdefault(digest, _new_record(time.time()))['prompts'].add(prompt_key)
+            self._stats['reused'] += 1
+        self._touch(digest)
+        if session_id:
+            self._attach(digest, session_id)
+        return self.entry(digest)
+
+    def entry(self, digest):
+        """
+        クライアントに返す URL 一式
+            image_url: 表示用（WebP があれば WebP）/ png_url: 元画像 / thumb_url: サムネイル（無ければ None）
+        """
+        has_webp = os.path.exists(self._path(f"{digest}.webp"))
+        png_url = f"{self.url_prefix}/{digest}.png"
+        return {
+            "hash": digest,
+            "image_url": f"{self.url_prefix}/{digest}.webp" if has_webp else png_url,
+            "png_url": png_url,
+            "thumb_url": f"{self.url_prefix}/{digest}_thumb.webp" if has_webp else None,
+        }
+
+    # ---------- 索引 ----------
+    def total_bytes(self):
+        with self._lock:
+            return sum(r['bytes'] for r in self._index.values())
+
+    def _touch(self, digest):
+        """最終アクセスを記録する。PNG の mtime への書き戻しは TOUCH_INTERVAL ごと"""
+        now = time.time()
+        with self._lock:
+            record = self._index.get(digest)
+            if record is None:
+                return
+            record['last_access'] = now
+            if now - record['touched'] < TOUCH_INTERVAL:
+                return
+            record['touched'] = now
+        try:
+            os.utime(self._path(f"{digest}.png"), (now, now))
+        except OSError:
+            pass
+
+    def _attach(self, digest, session_id):
+        with self._lock:
+            sessions = self._index.setdefault(digest, _new_record(time.time()))['sessions']
+            if session_id in sessions:
+                return
+            sessions.add(session_id)
+            data = "\n".join(sorted(sessions)).encode('utf-8')
+        self._write(f"{digest}.sessions", data)
+
+    def scan(self):
+        """
+        ディレクトリを走査して索引を作り直す（起動時と定期実行）。
+        他のプロセスが保存した画像を取り込み、消された画像を索引から外す。画像の枚数を返す
+        """
+        found = {}
+        now = time.time()
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TMP_SECONDS:
+                        self._remove(entry.name)
+                    continue
+                m = _FILE_PATTERN.match(entry.name)
+                if not m:
+                    continue
+                record = found.setdefault(m.group(1), _new_record(0.0))
+                record['last_access'] = record['touched'] = max(record['last_access'], stat.st_mtime)
+                if entry.name.endswith('.sessions'):
+                    try:
+                        with open(entry.path, encoding='utf-8') as f:
+                            record['sessions'].update(f.read().split())
+                    except OSError:
+                        pass
+                else:
+                    record['bytes'] += stat.st_size
+
+        with os.scandir(self._path('prompts')) as entries:
+            for entry in entries:
+                try:
+                    with open(entry.path, encoding='ascii') as f:
+                        digest = f.read().strip()
+                except OSError:
+                    continue
+                if digest in found:
+                    found[digest]['prompts'].add(entry.name)
+                elif not entry.name.endswith('.tmp'):
+                    self._remove(os.path.join('prompts', entry.name))
+
+        with self._lock:
+            for digest, current in self._index.items():
+                record = found.get(digest)
+                if record is None:
+                    # 走査の後に保存された画像は残す（消されたものだけ外す）
+                    if os.path.exists(self._path(f"{digest}.png")):
+                        found[digest] = current
+                    continue
+                record['last_access'] = max(record['last_access'], current['last_access'])
+                record['touched'] = max(record['touched'], current['touched'])
+                record['sessions'] |= current['sessions']
+                record['prompts'] |= current['prompts']
+            self._index = found
+            return len(found)
+
+    # ---------- 削除 ----------
+    def _delete(self, digest, reason):
+        """画像と派生ファイル・プロンプト索引を削除する。self._lock を持って呼ぶ"""
+        record = self._index.pop(digest, None)
+        if record is None:
+            return
+        for suffix in _SUFFIXES:
+            self._remove(f"{digest}{suffix}")
+        for prompt_key in record['prompts']:
+            self._remove(os.path.join('prompts', prompt_key))
+        self._stats[f"evicted_{reason}"] += 1
+        self._stats['evicted_bytes'] += record['bytes']
+
+    def release_session(self, session_id):
+        """セッションの期限切れ時に呼ぶ。他のセッションが使っていない画像を削除し、枚数を返す"""
+        removed = 0
+        rewrite = []
+        with self._lock:
+            for digest, record in list(self._index.items()):
+                if session_id not in record['sessions']:
+                    continue
+                record['sessions'].discard(session_id)
+                if record['sessions']:
+                    rewrite.append((digest, "\n".join(sorted(record['sessions'])).encode('utf-8')))
+                else:
+                    self._delete(digest, 'session')
+                    removed += 1
+        for digest, data in rewrite:
+            self._write(f"{digest}.sessions", data)
+        if removed:
+            log.info("期限切れセッションの画像を削除: %s (%s枚)", session_id, removed)
+        return removed
+
+    def collect(self, now=None, keep=None):
+        """
+        保持期間を過ぎた画像を削除し、上限を超えていれば最終アクセスの古い順に削除する。
+        keep の画像（保存した直後のもの）は消さない。削除した枚数を返す
+        """
+        now = now or time.time()
+        removed = 0
+        with self._lock:
+            if self.max_age:
+                for digest, record in list(self._index.items()):
+                    if digest != keep and now - record['last_access'] > self.max_age:
+                        self._delete(digest, 'age')
+                        removed += 1
+            if self.budget_bytes:
+                total = sum(r['bytes'] for r in self._index.values())
+                for digest, record in sorted(self._index.items(), key=lambda item: item[1]['last_access']):
+                    if total <= self.budget_bytes:
+                        break
+                    if digest == keep:
+                        continue
+                    total -= record['bytes']
+                    self._delete(digest, 'lru')
+                    removed += 1
+        if removed:
+            log.info("画像を削除: %s枚（上限 %sMB / 保持 %.0f秒）",
+                     removed, self.budget_bytes // (1024 * 1024), self.max_age)
+        return removed
+
+    def start_collector(self, interval=60):
+        """定期的に scan() + collect() するデーモンスレッドを起動する"""
+        if self._collector is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.scan()
+                    self.collect()
+                except Exception as e:
+                    log.warning("画像の掃除エラー: %s", e)
+
+        self._collector = threading.Thread(target=run, daemon=True, name="image-collector")
+        self._collector.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": len(self._index),
+                "bytes": sum(r['bytes'] for r in self._index.values()),
+                "budget_bytes": self.budget_bytes,
+                "max_age_seconds": self.max_age,
+                **self._stats,
+            }
@@ -0,0 +1,280 @@
+"""
+echo_json.py
+Project Echo - モデル出力の JSON 処理
+
+JsonFieldStreamer: ストリーミング中の不完全な JSON から、指定したトップレベル
+文字列フィールド（例: "narrative"）の値を届いた分だけ取り出す。
+    {"narrative": "その日、カフェの中で...   ← オブジェクトが閉じる前でも表示できる
+
+parse_json: モデル出力によくある崩れを直してからパースする。
+    - コードフェンスや前後の説明文（JSON の後ろに続く文章など）
+    - 区切りに使われたスマートクォート（“ ”）
+    - 文字列中の生の改行・末尾のカンマ
+    - 途中で切れた出力（閉じていない文字列・括弧を閉じ、壊れた末尾の要素は捨てる）
+
+check_schema: response_schema と同じ形式の dict で、型・必須キー・配列の要素数だけを検査する。
+"""
+
+import json
+
+_ESCAPES = {
+    '"': '"', '\\': '\\', '/': '/',
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+}
+
+
+_SMART_OPEN = '“„‟'
+_SMART_CLOSE = '”'
+# 文字列の外に現れてよい文字（数値・true / false / null・区切り・空白）
+_BARE_CHARS = frozenset('0123456789+-.eEtruefalsn: \t\r\n')
+
+
+def extract_json(text):
+    """コードフェンス（```json ... ```）があれば中身を取り出す"""
+    if "```json" in text:
+        text = text.split("```json")[1].split("```")[0].strip()
+    elif "```" in text:
+        text = text.split("```")[1].split("```")[0].strip()
+    return text
+
+
+def _close(out, stack):
+    """out の末尾を整えて、開いたままの括弧を閉じた文字列を返す"""
+    text = ''.join(out).rstrip()
+    while text.endswith(','):
+        text = text[:-1].rstrip()
+    if text.endswith(':'):
+        text += 'null'
+    return text + ''.join(reversed(stack))
+
+
+def repair_json(text):
+    """
+    崩れた JSON を修復した文字列を返す（json.loads できることを確認済み）。
+    修復できなければ ValueError。
+    """
+    body = extract_json(text)
+    starts = [i for i in (body.find('{'), body.find('[')) if i >= 0]
+    if not starts:
+        raise ValueError("JSON が見つかりません")
+
+    out = []
+    stack = []
+    commas = []             # 構造上のカンマの位置と、その時点で開いている括弧
+    in_string = False
+    closer = '"'
+    escape = False
+    complete = False
+    for c in body[min(starts):]:
+        if in_string:
+            if escape:
+                escape = False
+                out.append(c)
+            elif c == '\\':
+                escape = True
+                out.append(c)
+            elif c == closer:
+                in_string = False
+                out.append('"')
+            elif c == '"':
+                out.append('\\"')          # “...” の中の " はエスケープする
+            elif c == '\n':
+                out.append('\\n')
+            elif c == '\r':
+                pass
+            else:
+                out.append(c)
+        elif c == '"' or c in _SMART_OPEN:
+            in_string = True
+            closer = '"' if c == '"' else _SMART_CLOSE
+            out.append('"')
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+            out.append(c)
+        elif c in '}]':
+            if not stack:
+                break
+            while out and out[-1] in ' \t\r\n':
+                out.pop()
+            if out and out[-1] == ',':      # 末尾のカンマ
+                out.pop()
+                commas.pop()
+            out.append(stack.pop())
+            if not stack:
+                complete = True
+                break                       # 閉じた後ろの文章は捨てる
+        elif c == ',':
+            commas.append((len(out), list(stack)))
+            out.append(c)
+        elif c in _BARE_CHARS:
+            out.append(c)
+        # それ以外（文字列の外に混ざった説明文など）は捨てる
+
+    if not complete:
+        # 途中で切れている: 文字列を閉じてから括弧を閉じる
+        if in_string:
+            if escape:
+                out.pop()
+            out.append('"')
+        candidates = [_close(out, stack)]
+        # それでも壊れていれば、最後の完全な要素まで戻して閉じ直す
+        for position, open_stack in reversed(commas):
+            candidates.append(_close(out[:position], open_stack))
+    else:
+        candidates = [''.join(out)]
+
+    for candidate in candidates:
+        try:
+            json.loads(candidate, strict=False)
+            return candidate
+        except ValueError:
+            continue
+    raise ValueError("JSON を修復できませんでした")
+
+
+def parse_json(text):
+    """
+    モデル出力を JSON としてパースする。
+    正しい JSON なら json.loads と同じ結果、崩れていれば repair_json で直してからパースする。
+    """
+    body = extract_json(text)
+    try:
+        return json.loads(body, strict=False)
+    except ValueError:
+        pass
+    return json.loads(repair_json(text), strict=False)
+
+
+_TYPES = {
+    'object': dict, 'array': list, 'string': str,
+    'integer': int, 'number': (int, float), 'boolean': bool,
+}
+
+
+def check_schema(data, schema, path='$'):
+    """data が schema（type / properties / required / items）に合わなければ ValueError"""
+    kind = str(schema.get('type', '')).lower()
+    expected = _TYPES.get(kind)
+    if expected is not None:
+        if not isinstance(data, expected) or (kind in ('integer', 'number') and isinstance(data, bool)):
+            raise ValueError(f"{path}: {kind} ではありません")
+    if kind == 'object':
+        for key in schema.get('required', []):
+            if key not in data:
+                raise ValueError(f"{path}: {key} がありません")
+        for key, sub in schema.get('properties', {}).items():
+            if key in data:
+                check_schema(data[key], sub, f"{path}.{key}")
+    elif kind == 'array':
+        min_items = schema.get('min_items', schema.get('minItems'))
+        max_items = schema.get('max_items', schema.get('maxItems'))
+        if min_items is not None and len(data) < min_items:
+            raise ValueError(f"{path}: 要素が{min_items}個未満です")
+        if max_items is not None and len(data) > max_items:
+            raise ValueError(f"{path}: 要素が{max_items}個を超えています")
+        for i, item in enumerate(data if 'items' in schema else []):
+            check_schema(item, schema['items'], f"{path}[{i}]")
+
+
+class JsonFieldStreamer:
+    """
+    チャンク単位で JSON テキストを受け取り、対象フィールドの文字列値を逐次デコードする
+
+        streamer = JsonFieldStreamer("narrative")
+        for chunk in response_stream:
+            delta = streamer.feed(chunk.text)   # 新しく確定した文字だけが返る
+
+    ```json などのコードフェンスや前置きの文字列は無視する。
+    ネストしたオブジェクト内の同名キーや、文字列値の中に現れる "narrative" には反応しない。
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.done = False           # 対象フィールドの値が閉じたら True
+        self._depth = 0
+        self._in_string = False
+        self._capturing = False     # 現在の文字列が対象フィールドの値か
+        self._escape = False
+        self._unicode = None        # \\uXXXX の16進部分を収集中
+        self._high_surrogate = None
+        self._token = []            # キー候補の文字列
+        self._last_string = None    # 直前に閉じた文字列（次に ':' が来ればキー）
+        self._key = None
+        self._expect_value = False
+
+    def feed(self, chunk):
+        """chunk を処理し、対象フィールドに新しく追加された文字列を返す"""
+        out = []
+        for c in chunk:
+            if self.done:
+                break
+            if self._in_string:
+                self._string_char(c, out)
+            else:
+                self._structural_char(c)
+        return ''.join(out)
+
+    def _emit(self, text, out):
+        if self._capturing:
+            out.append(text)
+        else:
+            self._token.append(text)
+
+    def _string_char(self, c, out):
+        if self._unicode is not None:
+            self._unicode += c
+            if len(self._unicode) < 4:
+                return
+            try:
+                code = int(self._unicode, 16)
+            except ValueError:
+                code = 0xFFFD
+            self._unicode = None
+            if 0xD800 <= code <= 0xDBFF:
+                self._high_surrogate = code
+                return
+            if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            self._emit(chr(code), out)
+        elif self._escape:
+            self._escape = False
+            if c == 'u':
+                self._unicode = ''
+            else:
+                self._emit(_ESCAPES.get(c, c), out)
+        elif c == '\\':
+            self._escape = True
+        elif c == '"':
+            self._in_string = False
+            if self._capturing:
+                self._capturing = False
+                self.done = True
+            else:
+                self._last_string = ''.join(self._token)
+            self._token = []
+        else:
+            self._emit(c, out)
+
+    def _structural_char(self, c):
+        if c == '"':
+            self._in_string = True
+            self._capturing = (
+                self._expect_value and self._depth == 1 and self._key == self.field
+            )
+            self._expect_value = False
+            self._last_string = None
+        elif c == ':':
+            if self._last_string is not None:
+                self._key = self._last_string
+                self._expect_value = True
+            self._last_string = None
+        elif c in ' \t\r\n':
+            pass
+        else:
+            if c in '{[':
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+            self._expect_value = False
+            self._last_string = None
@@ -0,0 +1,192 @@
+"""
+echo_logging.py
+Project Echo - ログ出力（レベル・JSON・セッション相関ID・ポーリングの間引き）
+
+標準の logging の上に、このアプリで使う設定をまとめたもの。
+- レベルで出し分ける。無効なレベルの呼び出しは文字列を組み立てない
+  （log.debug("待機 %.1f秒", waited) のように % 形式の引数で渡す）
+- ECHO_LOG_FORMAT=json で1行1 JSON（Cloud Logging が severity・message を解釈する）
+- session_context(session_id) の中のログにはセッション ID が付く（contextvars）。
+  別スレッドに処理を渡すときは in_context(fn) で文脈ごと渡す
+- ポーリング用のロガー（get_logger('poll')）は同じメッセージを ECHO_LOG_POLL_INTERVAL 秒に1回だけ出す
+- 書き出しは専用スレッドで行う（リクエスト処理のスレッドが標準出力の書き込みを待たない）
+
+    log = get_logger(__name__)
+    with session_context(session_id):
+        log.info("フェーズ生成開始: %s", phase)
+
+環境変数:
+    ECHO_LOG_LEVEL          DEBUG / INFO / WARNING / ERROR（既定: INFO）
+    ECHO_LOG_FORMAT         text / json（既定: text）
+    ECHO_LOG_POLL_INTERVAL  ポーリング用ログの最短間隔（秒、既定: 30。0 で間引かない）
+    ECHO_LOG_ASYNC          "0" で書き出しスレッドを使わず呼び出し元で書く（既定: "1"）
+"""
+
+import atexit
+import contextlib
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+session_id_var = contextvars.ContextVar('echo_session_id', default=None)
+
+_LEVEL_LABELS = {'WARNING': 'WARN', 'CRITICAL': 'ERROR'}
+_configured = False
+_configure_lock = threading.Lock()
+
+
+# ========================================
+# セッション相関ID
+# ========================================
+@contextlib.contextmanager
+def session_context(session_id):
+    """このブロック内のログ（と in_context で渡した処理）にセッション ID を付ける"""
+    token = session_id_var.set(session_id)
+    try:
+        yield
+    finally:
+        session_id_var.reset(token)
+
+
+def current_session_id():
+    return session_id_var.get()
+
+
+def in_context(fn):
+    """現在の contextvars（セッション ID など）のまま fn を実行する関数を返す（スレッドに渡す用）
+
+    呼び出しごとに文脈を複製するので、executor.map のように同時に何度呼ばれてもよい。
+    """
+    ctx = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return run
+
+
+# ========================================
+# フィルタ・フォーマッタ
+# ========================================
+class ContextFilter(logging.Filter):
+    """レコードにセッション ID を付ける（呼び出し元のスレッドで実行される）"""
+
+    def filter(self, record):
+        if not hasattr(record, 'session_id'):
+            record.session_id = session_id_var.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """同じメッセージ（書式文字列）は interval 秒に1回だけ通す。間引いた件数は次の1件に付ける"""
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = {}     # msg -> (最後に出した時刻, 間引いた件数)
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._last.get(record.msg, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._last[record.msg] = (last, suppressed + 1)
+                return False
+            self._last[record.msg] = (now, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """[INFO] メッセージ (session=...) の形式"""
+
+    def format(self, record):
+        text = f"[{_LEVEL_LABELS.get(record.levelname, record.levelname)}] {record.getMessage()}"
+        if getattr(record, 'session_id', None):
+            text += f" (session={record.session_id})"
+        if getattr(record, 'suppressed', 0):
+            text += f" (+{record.suppressed}件省略)"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Cloud Logging 向けの1行 JSON"""
+
+    def format(self, record):
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "logger": record.name,
+            "thread": record.threadName,
+        }
+        if getattr(record, 'session_id', None):
+            entry["session_id"] = record.session_id
+        if getattr(record, 'suppressed', 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["message"] += "\n" + self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# ========================================
+# 設定
+# ========================================
+def setup_logging():
+    """echo.* のロガーを設定する（何度呼んでも1回だけ）"""
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+        root = logging.getLogger('echo')
+        root.setLevel(os.environ.get("ECHO_LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+
+        handler = logging.StreamHandler(sys.stdout)
+        if os.environ.get("ECHO_LOG_FORMAT", "text") == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(TextFormatter())
+
+        if os.environ.get("ECHO_LOG_ASYNC", "1") == "1":
+            # 書き出しは専用スレッドで。リクエスト処理のスレッドはキューに積むだけ
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, handler)
+            listener.start()
+            atexit.register(listener.stop)
+            handler = _QueueHandler(records)
+        handler.addFilter(ContextFilter())
+        root.addHandler(handler)
+
+        poll = logging.getLogger('echo.poll')
+        poll.addFilter(RateLimitFilter(float(os.environ.get("ECHO_LOG_POLL_INTERVAL", "30"))))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # セッション ID はフィルタで付与済み。メッセージの組み立ては書き出しスレッドで行う
+        return record
+
+
+def get_logger(name):
+    """echo.<name> のロガー（'__main__' や 'echo_xxx' は短い名前にそろえる）"""
+    setup_logging()
+    name = 'app' if name == '__main__' else name.rsplit('.', 1)[-1]
+    if name.startswith('echo_'):
+        name = name[len('echo_'):]
+    return logging.getLogger(f"echo.{name}")
@@ -0,0 +1,226 @@
+"""
+echo_metrics.py
+Project Echo - 計測値の集計と Prometheus テキスト形式での出力（/metrics）
+
+ストーリー1本の待ち時間のうち、モデルの処理時間・429 などの再試行待ち・
+固定の待機（sleep）がそれぞれどれだけかを数える。外部ライブラリは使わない。
+- model_call_seconds: 呼び出し種別（kind）ごとの1回の API 呼び出し時間（試行ごと）
+- model_request_seconds: 再試行・レート制限待ちを含めた呼び出し全体の時間
+- retries: 種別・理由（rate_limit / timeout / unavailable / error）ごとの再試行回数
+- sleep_seconds: 理由（rate_limit / priority / backoff / pacing / error）ごとの待機秒数の合計
+- ゲージは値を返す関数で登録し、/metrics の出力時に読む（アクティブセッション数など）
+
+    with metrics.model_call_seconds.time(kind='narrator', outcome='ok'):
+        ...
+    metrics.sleep(8, 'pacing')      # time.sleep(8) と同じだが待機秒数を数える
+    metrics.gauge('echo_threads', 'スレッド数', threading.active_count)
+
+値はプロセスごと。gunicorn で複数ワーカーにする場合は、ワーカーごとの値になる。
+
+環境変数:
+    ECHO_METRICS_BUCKETS   ヒストグラムの区切り（秒、カンマ区切り。既定: 0.05,0.1,0.25,0.5,1,2.5,5,10,20,30,60,120）
+"""
+
+import os
+import threading
+import time
+
+from echo_trace import tracer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ========================================
+# 計測値の種類
+# ========================================
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}   # ラベル値のタプル -> 値
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルは {self.labelnames} を指定してください（{tuple(labels)}）")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_samples(items))
+        return lines
+
+
+class Counter(_Metric):
+    """増えるだけの値（名前は _total で終える）"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    """区切り（バケット）ごとの累積件数と、値の合計・件数"""
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def time(self, **labels):
+        """with ブロックの経過時間を記録する"""
+        return _Timer(self, labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry["counts"]):
+                cumulative += count
+                le = _labels(self.labelnames, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {entry['sum']:.6f}")
+            lines.append(f"{self.name}_count{labels} {entry['count']}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Gauge(_Metric):
+    """出力時に fn() を呼んで値を読む。fn は数値か {ラベル値のタプル: 数値} を返す"""
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, fn, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def render(self):
+        value = self.fn()
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"] + [
+            f"{self.name}{_labels(self.labelnames, key)} {_number(v)}" for key, v in sorted(samples)]
+
+
+# ========================================
+# レジストリ
+# ========================================
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+        self.model_call_seconds = self.histogram(
+            "echo_model_call_seconds", "1回の API 呼び出しにかかった秒数（試行ごと）", ("kind", "outcome"))
+        self.model_request_seconds = self.histogram(
+            "echo_model_request_seconds", "再試行・レート制限待ちを含めた API 呼び出し全体の秒数", ("kind",))
+        self.retries = self.counter(
+            "echo_retries_total", "再試行の回数", ("kind", "cause"))
+        self.sleep_seconds = self.counter(
+            "echo_sleep_seconds_total", "待機した秒数の合計", ("reason",))
+
+    @classmethod
+    def from_env(cls):
+        buckets = os.environ.get("ECHO_METRICS_BUCKETS")
+        if buckets:
+            return cls(buckets=[float(b) for b in buckets.split(",") if b.strip()])
+        return cls()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        return self._register(Histogram(name, help_text, labelnames, buckets or self.buckets))
+
+    def gauge(self, name, help_text, fn, labelnames=()):
+        """同じ名前で登録し直すと置き換える"""
+        return self._register(Gauge(name, help_text, fn, labelnames))
+
+    def sleep(self, seconds, reason):
+        """time.sleep(seconds) して、待機秒数を reason ごとに数える（セッションのトレースにも残す）"""
+        if seconds <= 0:
+            return
+        self.sleep_seconds.inc(seconds, reason=reason)
+        with tracer.span('sleep', cat='sleep', reason=reason, seconds=round(seconds, 3)):
+            time.sleep(seconds)
+
+    def render(self):
+        """Prometheus テキスト形式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # ゲージの読み取り失敗で /metrics 全体を落とさない
+                lines.append(f"# {metric.name}: {type(e).__name__}: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics.from_env()
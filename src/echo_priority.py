@@ -0,0 +1,217 @@
+"""
+echo_priority.py
+Project Echo - モデル呼び出しの優先度レーン
+
+対話中のフェーズ生成・物語メモリ（要約）・方向性提案・4コマ漫画は同じ Gemini の
+クォータを使う。完了したセッションの漫画生成が、起フェーズを待っているユーザーの
+呼び出しを遅らせないよう、レートリミッタの手前で呼び出しの順番を決める。
+- レーン: interactive > summary > suggestions > comic（数字が小さいほど優先）
+- interactive 以外は、レートリミッタにすぐ使えるトークンがあるときだけ通る
+  （空きが無ければここで待ち、後から来た interactive に追い越される）
+- レーンごとに同時に実行できる呼び出し数の上限がある
+- 待った時間に応じて優先度が上がる（エージング）。ECHO_PRIORITY_AGING 秒ごとに1段上がり、
+  interactive と並んだらトークンの空きを待たずに通る（後回しの処理もいずれ終わる）
+- レーンは contextvars で渡す（echo_logging.in_context やスケジューラのジョブにも引き継がれる）
+
+    @priority.in_lane('comic')          # 関数内のモデル呼び出しをすべて comic レーンにする
+    def generate_comic(session_id):
+
+    with priority.lane('summary'):
+        call_with_retry(...)
+
+    with priority.slot(model_name, timeout=30):   # echo_retry が各試行の前に呼ぶ
+        rate_limiter.acquire(model_name)
+        ...
+
+値はプロセスごと。gunicorn で複数ワーカーにする場合も、トークンの空きは
+ECHO_RATE_LIMIT_DB で共有したレートリミッタを見て判断する。
+
+環境変数:
+    ECHO_LANE_CAPS          レーンごとの同時実行数の上限 例: "summary=4,suggestions=2,comic=2"（0 は無制限）
+    ECHO_PRIORITY_AGING     優先度が1段上がるまでの待ち時間（秒、既定: 10）
+    ECHO_MODEL_CONCURRENCY  モデルごとの同時実行数の上限（全レーン合計、既定: 0 = 無制限）
+"""
+
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+
+from echo_logging import get_logger
+from echo_metrics import metrics
+from echo_ratelimit import rate_limiter, RateLimitTimeout
+
+log = get_logger(__name__)
+
+# レーン名 -> 優先度（小さいほど優先）
+LANES = {'interactive': 0, 'summary': 1, 'suggestions': 2, 'comic': 3}
+
+DEFAULT_CAPS = {'interactive': 0, 'summary': 4, 'suggestions': 2, 'comic': 2}
+
+lane_var = contextvars.ContextVar('echo_priority_lane', default='interactive')
+
+# トークンの空きは通知されないので、待っている間はこの間隔で見直す
+_POLL_INTERVAL = 0.1
+
+
+class _Waiter:
+    def __init__(self, lane, model_name):
+        self.lane = lane
+        self.priority = LANES[lane]
+        self.model_name = model_name
+        self.enqueued = time.monotonic()
+
+
+class PriorityDispatcher:
+    def __init__(self, caps=None, aging=10.0, model_concurrency=0, limiter=None):
+        self.caps = {**DEFAULT_CAPS, **(caps or {})}
+        self.aging = aging
+        self.model_concurrency = model_concurrency
+        self.limiter = limiter or rate_limiter
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._lane_running = dict.fromkeys(LANES, 0)
+        self._model_running = {}
+        self._stats = {lane: {"granted": 0, "aged": 0, "timeouts": 0, "max_wait_seconds": 0.0} for lane in LANES}
+
+        self.wait_seconds = metrics.histogram(
+            "echo_priority_wait_seconds", "優先度レーンで呼び出しの順番を待った秒数", ("lane",))
+
+    @classmethod
+    def from_env(cls):
+        caps = {}
+        for item in os.environ.get("ECHO_LANE_CAPS", "").split(","):
+            if "=" in item:
+                name, cap = item.split("=", 1)
+                if name.strip() not in LANES:
+                    raise ValueError(f"ECHO_LANE_CAPS: 不明なレーン {name.strip()}（{', '.join(LANES)}）")
+                caps[name.strip()] = int(cap)
+        return cls(
+            caps=caps,
+            aging=float(os.environ.get("ECHO_PRIORITY_AGING", "10")),
+            model_concurrency=int(os.environ.get("ECHO_MODEL_CONCURRENCY", "0")),
+        )
+
+    # ---------- レーンの指定 ----------
+    @contextlib.contextmanager
+    def lane(self, name):
+        """このブロック内のモデル呼び出し（と in_context で渡した処理）を name レーンにする"""
+        if name not in LANES:
+            raise ValueError(f"不明なレーン: {name}")
+        token = lane_var.set(name)
+        try:
+            yield
+        finally:
+            lane_var.reset(token)
+
+    def in_lane(self, name):
+        """関数全体を name レーンで実行するデコレータ"""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.lane(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    # ---------- 順番待ち ----------
+    def _effective(self, waiter, now):
+        """待った時間を差し引いた優先度（0 以下なら interactive と同等）"""
+        if self.aging <= 0:
+            return waiter.priority
+        return waiter.priority - (now - waiter.enqueued) / self.aging
+
+    def _has_capacity(self, waiter):
+        cap = self.caps.get(waiter.lane, 0)
+        if cap > 0 and self._lane_running[waiter.lane] >= cap:
+            return False
+        if self.model_concurrency > 0 and self._model_running.get(waiter.model_name, 0) >= self.model_concurrency:
+            return False
+        return True
+
+    def _eligible(self, waiter, now, tokens):
+        if not self._has_capacity(waiter):
+            return False
+        if waiter.priority == 0 or self._effective(waiter, now) <= 0:
+            return True
+        if waiter.model_name not in tokens:
+            tokens[waiter.model_name] = self.limiter.available(waiter.model_name)
+        return tokens[waiter.model_name] >= 1
+
+    def _grantable(self, waiter):
+        """通ってよい順番の中で、同じモデルを待つ他の呼び出しより優先度が高いか"""
+        now = time.monotonic()
+        tokens = {}     # 1回の判定の中ではレートリミッタを読み直さない
+        if not self._eligible(waiter, now, tokens):
+            return False
+        mine = (self._effective(waiter, now), waiter.enqueued)
+        return not any(
+            other is not waiter and other.model_name == waiter.model_name
+            and (self._effective(other, now), other.enqueued) < mine
+            and self._eligible(other, now, tokens)
+            for other in self._waiting)
+
+    @contextlib.contextmanager
+    def slot(self, model_name, timeout=None):
+        """
+        現在のレーンで model_name を呼び出す順番を待ち、ブロックの間は実行中として数える。
+        待った秒数を返す。timeout 秒以内に順番が来なければ RateLimitTimeout を送出する。
+        """
+        waiter = _Waiter(lane_var.get(), model_name)
+        give_up = None if timeout is None else waiter.enqueued + timeout
+        with self._cond:
+            self._waiting.append(waiter)
+            try:
+                while not self._grantable(waiter):
+                    wait = _POLL_INTERVAL
+                    if give_up is not None:
+                        wait = min(wait, give_up - time.monotonic())
+                        if wait <= 0:
+                            self._stats[waiter.lane]["timeouts"] += 1
+                            raise RateLimitTimeout(
+                                f"{waiter.lane} レーンの順番待ちが {timeout:.1f}秒 を超えます ({model_name})")
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(waiter)
+                # 抜けた分、他の待機者が通れるかもしれない
+                self._cond.notify_all()
+            waited = time.monotonic() - waiter.enqueued
+            stats = self._stats[waiter.lane]
+            stats["granted"] += 1
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+            if waiter.priority > 0 and self._effective(waiter, time.monotonic()) <= 0:
+                stats["aged"] += 1
+            self._lane_running[waiter.lane] += 1
+            self._model_running[model_name] = self._model_running.get(model_name, 0) + 1
+        self.wait_seconds.observe(waited, lane=waiter.lane)
+        if waited >= 1:
+            log.debug("%s レーンの順番待ち: %.1f秒 (%s)", waiter.lane, waited, model_name)
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                self._lane_running[waiter.lane] -= 1
+                self._model_running[model_name] -= 1
+                self._cond.notify_all()
+
+    # ---------- 参照 ----------
+    def stats(self):
+        with self._cond:
+            waiting = {lane: 0 for lane in LANES}
+            for waiter in self._waiting:
+                waiting[waiter.lane] += 1
+            return {
+                lane: {
+                    "priority": LANES[lane],
+                    "cap": self.caps.get(lane, 0),
+                    "running": self._lane_running[lane],
+                    "waiting": waiting[lane],
+                    **{k: round(v, 3) if isinstance(v, float) else v for k, v in self._stats[lane].items()},
+                }
+                for lane in LANES
+            }
+
+
+priority = PriorityDispatcher.from_env()
@@ -0,0 +1,209 @@
+"""
+echo_ratelimit.py
+Project Echo - Gemini / Imagen 呼び出し用のトークンバケット型レート制限
+
+プロセス内の全スレッドで1つのバケット（モデルごと）を共有する。
+- 予算が残っていれば即座に通過（固定 sleep なし）
+- 予算が無い場合は到着順（FIFO）に予約して待機
+- ECHO_RATE_LIMIT_DB を指定すると SQLite ファイル経由で複数ワーカープロセス間でも共有
+
+環境変数:
+    ECHO_RPM               全モデル共通のデフォルト RPM（既定: 10）
+    ECHO_RPM_OVERRIDES     モデル別 RPM 例: "gemini-2.0-flash-001=60,imagen-3.0-generate-002=20"
+    ECHO_RATE_BURST        バケット容量（一度に通せる最大リクエスト数、既定: 3）
+    ECHO_RATE_LIMIT_DB     共有用 SQLite ファイルのパス（未指定ならプロセス内のみ）
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class RateLimitTimeout(Exception):
+    """待機時間が timeout を超える場合に送出"""
+
+
+# ========================================
+# バケットのバックエンド
+# ========================================
+class MemoryBucketBackend:
+    """プロセス内で共有するバケット"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, updated)
+
+    def _refill(self, key, rate, capacity, now):
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        return tokens
+
+    def reserve(self, key, rate, capacity):
+        """
+        トークンを1つ予約し、使用可能になるまでの待ち時間（秒）を返す。
+        トークンは負まで借りられるので、呼び出し順がそのまま通過順になる（FIFO）。
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens = self._refill(key, rate, capacity, now) - 1
+            self._buckets[key] = (tokens, now)
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def refund(self, key, capacity):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, time.monotonic()))
+            self._buckets[key] = (min(capacity, tokens + 1), updated)
+
+    def peek(self, key, rate, capacity):
+        with self._lock:
+            return self._refill(key, rate, capacity, time.monotonic())
+
+
+class SQLiteBucketBackend:
+    """
+    SQLite ファイルでバケットを共有するバックエンド（gunicorn の複数ワーカー向け）
+    BEGIN IMMEDIATE で書き込みロックを取るため、予約はプロセスをまたいで直列化される。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, key, capacity, update):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = update(tokens, updated, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return tokens
+
+    def reserve(self, key, rate, capacity):
+        tokens = self._transaction(
+            key, capacity,
+            lambda t, updated, now: min(capacity, t + (now - updated) * rate) - 1,
+        )
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def refund(self, key, capacity):
+        # 経過時間分の補充は次回の reserve で行うため、ここではトークンを戻すだけ
+        conn = self._connect()
+        conn.execute(
+            "UPDATE buckets SET tokens = MIN(?, tokens + 1) WHERE key = ?",
+            (capacity, key),
+        )
+
+    def peek(self, key, rate, capacity):
+        row = self._connect().execute(
+            "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return capacity
+        tokens, updated = row
+        return min(capacity, tokens + (time.time() - updated) * rate)
+
+
+# ========================================
+# レートリミッタ本体
+# ========================================
+class RateLimiter:
+    """
+    モデル名ごとの RPM に従ってリクエストを通すトークンバケット
+
+    使い方:
+        rate_limiter.acquire("gemini-2.0-flash-001")  # 必要なら待機してから戻る
+        text = model.generate_text(prompt)
+    """
+
+    def __init__(self, default_rpm=10, overrides=None, burst=3, backend=None):
+        self.default_rpm = default_rpm
+        self.overrides = dict(overrides or {})
+        self.burst = burst
+        self.backend = backend or MemoryBucketBackend()
+
+    @classmethod
+    def from_env(cls):
+        overrides = {}
+        for item in os.environ.get("ECHO_RPM_OVERRIDES", "").split(","):
+            if "=" in item:
+                name, rpm = item.split("=", 1)
+                overrides[name.strip()] = float(rpm)
+
+        db_path = os.environ.get("ECHO_RATE_LIMIT_DB")
+        backend = SQLiteBucketBackend(db_path) if db_path else MemoryBucketBackend()
+
+        return cls(
+            default_rpm=float(os.environ.get("ECHO_RPM", "10")),
+            overrides=overrides,
+            burst=float(os.environ.get("ECHO_RATE_BURST", "3")),
+            backend=backend,
+        )
+
+    def rpm_for(self, model_name):
+        return self.overrides.get(model_name, self.default_rpm)
+
+    def _params(self, model_name):
+        rpm = self.rpm_for(model_name)
+        return rpm / 60.0, max(1.0, min(self.burst, rpm))
+
+    def capacity(self, model_name):
+        """バケット容量（available() が返す最大値。無制限なら inf）"""
+        if self.rpm_for(model_name) <= 0:
+            return float('inf')
+        return self._params(model_name)[1]
+
+    def acquire(self, model_name, timeout=None):
+        """
+        model_name のトークンを1つ取得する。必要なら待機し、待機した秒数を返す。
+        RPM が 0 以下のモデルは無制限として扱う。
+        timeout 秒以上待つ必要がある場合は予約を取り消して RateLimitTimeout を送出。
+        """
+        if self.rpm_for(model_name) <= 0:
+            return 0.0
+
+        rate, capacity = self._params(model_name)
+        wait = self.backend.reserve(model_name, rate, capacity)
+        if timeout is not None and wait > timeout:
+            self.backend.refund(model_name, capacity)
+            raise RateLimitTimeout(
+                f"レート制限の待機時間 {wait:.1f}秒 が上限 {timeout:.1f}秒 を超えます ({model_name})"
+            )
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def available(self, model_name):
+        """現在すぐに使えるトークン数（負なら待ち行列がある）"""
+        if self.rpm_for(model_name) <= 0:
+            return float('inf')
+        rate, capacity = self._params(model_name)
+        return self.backend.peek(model_name, rate, capacity)
+
+
+# プロセス全体で共有するインスタンス
+rate_limiter = RateLimiter.from_env()
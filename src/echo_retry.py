@@ -0,0 +1,316 @@
+"""
+echo_retry.py
+Project Echo - API 呼び出しの再試行エンジン
+
+web_echo_interactive / web_echo_imagen_v4 / web_echo_fixed で共通に使う。
+- タイムアウトはプロセス共通の長寿命スレッドプールで実現（呼び出しごとに作らない）
+- ストリーミングは別のスレッドプールで読み、1回の呼び出しのタイムアウトと締め切りを守る
+  （止まったストリームが通常の呼び出しのスレッドを使い切らないように分ける）
+- タイムアウトは呼び出しが実際に始まってから数える（プールの空き待ちは締め切りの範囲で待つ）
+- 指数バックオフ + ジッター（429 はサーバーの再試行ヒントがあればそれに従う）
+- 1回の呼び出しのタイムアウトと、フェーズ全体の締め切り（Deadline）の両方を守る
+- 再試行のたびに理由（rate_limit / timeout / unavailable / error）を通知する
+- 各試行の前に優先度レーン（echo_priority）の順番を待ち、共有レートリミッタからトークンを取得する
+- 呼び出し種別（kind）ごとに試行時間・全体時間・再試行回数・待機秒数を echo_metrics に記録する
+- 呼び出し全体と各試行をセッションのトレース（echo_trace）にスパンとして残す
+
+環境変数:
+    ECHO_CALL_TIMEOUT      1回の API 呼び出しのタイムアウト（秒、既定: 60）
+    ECHO_CALL_WORKERS      タイムアウト監視用スレッドプールの大きさ（既定: 32）
+    ECHO_STREAM_WORKERS    ストリーミング読み出し用スレッドプールの大きさ（既定: 16）
+"""
+
+import concurrent.futures
+import contextlib
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+from echo_logging import get_logger, in_context
+from echo_metrics import metrics
+from echo_priority import priority, lane_var
+from echo_ratelimit import rate_limiter, RateLimitTimeout
+from echo_trace import tracer
+
+log = get_logger(__name__)
+
+
+class RetryError(Exception):
+    """再試行しても成功しなかった（cause は最後の失敗理由）"""
+
+    def __init__(self, message, cause=None, attempts=0):
+        super().__init__(message)
+        self.cause = cause
+        self.attempts = attempts
+
+
+class DeadlineExceeded(RetryError):
+    """フェーズ全体の締め切りを過ぎた"""
+
+
+class Deadline:
+    """
+    複数の API 呼び出しにまたがる締め切り
+        deadline = Deadline(300)   # このフェーズは最大300秒
+        call_with_retry(model, prompt, deadline=deadline)
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class RetryPolicy:
+    """再試行の設定"""
+
+    def __init__(self, max_attempts=5, call_timeout=None, base_delay=2.0,
+                 rate_limit_base_delay=10.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.call_timeout = call_timeout if call_timeout is not None else float(
+            os.environ.get("ECHO_CALL_TIMEOUT", "60"))
+        self.base_delay = base_delay
+        self.rate_limit_base_delay = rate_limit_base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt, cause):
+        """attempt 回目（1始まり）の失敗後の待機秒数（equal jitter）"""
+        base = self.rate_limit_base_delay if cause == 'rate_limit' else self.base_delay
+        delay = min(self.max_delay, base * (2 ** (attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+# タイムアウト監視用の共有スレッドプール
+_call_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ECHO_CALL_WORKERS", "32")),
+    thread_name_prefix="api-call"
+)
+
+# ストリーミング読み出し用（止まったストリームは打ち切った後もスレッドを持ち続けるため分ける）
+_stream_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ECHO_STREAM_WORKERS", "16")),
+    thread_name_prefix="api-stream"
+)
+
+_RETRY_HINT_PATTERNS = [
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.I),
+    re.compile(r"retry[- ]after[:\s]+(\d+(?:\.\d+)?)", re.I),
+    re.compile(r"retry in (\d+(?:\.\d+)?)\s*s", re.I),
+]
+
+
+def classify_error(error):
+    """例外を再試行の理由に分類する。None は再試行しても無駄なエラー"""
+    if isinstance(error, concurrent.futures.TimeoutError):
+        return 'timeout'
+    name = type(error).__name__
+    msg = str(error)
+    if "429" in msg or "Resource exhausted" in msg or name in ("ResourceExhausted", "TooManyRequests"):
+        return 'rate_limit'
+    if name in ("InvalidArgument", "PermissionDenied", "Unauthenticated", "NotFound", "BadRequest") \
+            or msg.startswith(("400", "401", "403", "404")):
+        return None
+    if name in ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout") \
+            or msg.startswith(("500", "502", "503", "504")):
+        return 'unavailable'
+    return 'error'
+
+
+def retry_hint(error):
+    """サーバーが指定した再試行までの秒数（無ければ None）"""
+    hint = getattr(error, 'retry_after', None)
+    if hint is not None:
+        return float(hint)
+    msg = str(error)
+    for pattern in _RETRY_HINT_PATTERNS:
+        m = pattern.search(msg)
+        if m:
+            return float(m.group(1))
+    return None
+
+
+def model_name_of(model):
+    """TextModel / ImageModel などからレート制限用のモデル名を取り出す"""
+    return getattr(model, '_model_name', 'default').rsplit('/', 1)[-1]
+
+
+def retry_call(fn, model_name, policy=None, deadline=None, on_retry=None,
+               timeout=True, label="API", kind="other", prompt_size=None):
+    """
+    fn() を再試行付きで呼び出して結果を返す。
+
+    timeout=True なら policy.call_timeout 秒（と deadline の残り時間の短い方）で打ち切る。
+    ストリーミングのように呼び出し側で時間管理する場合は timeout=False。
+    on_retry(attempt, cause, wait, error) は再試行の直前に呼ばれる。
+    kind は計測用の呼び出し種別（narrator / inner_thought / imagen など）、
+    prompt_size はトレースに残すプロンプトの文字数。
+    """
+    with metrics.model_request_seconds.time(kind=kind), \
+            tracer.span(kind, cat='model', model=model_name, prompt_size=prompt_size) as span:
+        result = _retry_call(fn, model_name, policy or DEFAULT_POLICY, deadline, on_retry, timeout, label, kind)
+        span.set(response_size=len(result) if isinstance(result, (str, bytes)) else None)
+        return result
+
+
+def _retry_call(fn, model_name, policy, deadline, on_retry, timeout, label, kind):
+    last_cause = None
+
+    for attempt in range(1, policy.max_attempts + 1):
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(
+                f"{label}: 締め切り（{deadline.seconds:.0f}秒）を過ぎました", last_cause, attempt - 1)
+
+        with tracer.span('attempt', cat='model', attempt=attempt, lane=lane_var.get()) as span, \
+                contextlib.ExitStack() as slot:
+            try:
+                # 優先度の順番が来てから、試行が終わるまでレーンの実行数に数える
+                queued = slot.enter_context(
+                    priority.slot(model_name, timeout=deadline.remaining() if deadline is not None else None))
+                waited = rate_limiter.acquire(
+                    model_name, timeout=deadline.remaining() if deadline is not None else None)
+            except RateLimitTimeout as e:
+                raise DeadlineExceeded(f"{label}: {e}", 'rate_limit', attempt - 1)
+            if queued > 0.001:
+                metrics.sleep_seconds.inc(queued, reason='priority')
+                span.set(priority_wait=round(queued, 3))
+            if waited > 0:
+                metrics.sleep_seconds.inc(waited, reason='rate_limit')
+                span.set(rate_limit_wait=round(waited, 3))
+                log.debug("レート制限待機: %.1f秒 (%s)", waited, model_name)
+
+            started = time.monotonic()
+            try:
+                if not timeout:
+                    result = fn()
+                else:
+                    result = _call_with_timeout(fn, policy.call_timeout, deadline)
+                metrics.model_call_seconds.observe(time.monotonic() - started, kind=kind, outcome='ok')
+                return result
+
+            except Exception as e:
+                error = e   # except を抜けると e は消えるので、待機の判定用に残す
+                cause = classify_error(error)
+                metrics.model_call_seconds.observe(time.monotonic() - started, kind=kind, outcome=cause or 'fatal')
+                span.set(outcome=cause or 'fatal', error=f"{type(error).__name__}: {str(error)[:200]}")
+                if cause is None:
+                    raise
+                if attempt == policy.max_attempts:
+                    raise RetryError(
+                        f"{label}呼び出し失敗（{attempt}回試行、理由={cause}）: {type(error).__name__}: {error}",
+                        cause, attempt) from error
+        last_cause = cause
+
+        wait = policy.backoff(attempt, cause)
+        hint = retry_hint(error) if cause == 'rate_limit' else None
+        if hint is not None:
+            wait = max(wait, hint)
+        if deadline is not None and wait >= deadline.remaining():
+            raise DeadlineExceeded(
+                f"{label}: 再試行の待機（{wait:.1f}秒）が締め切りを超えます ({cause}: {error})",
+                cause, attempt) from error
+
+        log.warning("%s再試行: 理由=%s 待機=%.1f秒 (試行 %s/%s) %s: %s",
+                    label, cause, wait, attempt, policy.max_attempts, type(error).__name__, str(error)[:200])
+        metrics.retries.inc(kind=kind, cause=cause)
+        tracer.instant('retry', cat='model', cause=cause, wait=round(wait, 3))
+        if on_retry:
+            on_retry(attempt, cause, wait, error)
+        metrics.sleep(wait, 'backoff')
+
+    raise RetryError(f"{label}呼び出し失敗", last_cause, policy.max_attempts)
+
+
+_STREAM_START = object()
+_STREAM_END = object()
+
+
+def stream_with_timeout(open_stream, call_timeout=None, deadline=None):
+    """
+    open_stream() が返すイテレータをストリーミング用のスレッドプールで読み、チャンクを順に返すジェネレータ。
+    読み始め（プールの空き待ちの後）から call_timeout 秒（既定は DEFAULT_POLICY.call_timeout。deadline の残り時間の
+    短い方）を過ぎても終わらなければ concurrent.futures.TimeoutError を送出する
+    （retry_call では理由 timeout として再試行される）。ストリームが途中で止まっても戻ってくる。
+    """
+    limit = DEFAULT_POLICY.call_timeout if call_timeout is None else call_timeout
+    chunks = queue.Queue()
+    abandoned = threading.Event()
+
+    def pump():
+        if abandoned.is_set():
+            return
+        chunks.put((_STREAM_START, None))
+        try:
+            for chunk in open_stream():
+                if abandoned.is_set():
+                    return
+                chunks.put((chunk, None))
+            chunks.put((_STREAM_END, None))
+        except Exception as e:
+            chunks.put((None, e))
+
+    future = _stream_executor.submit(in_context(pump))
+    # 読み始めるまでは締め切りだけを見る。始まったら call_timeout を数え始める
+    ends = deadline.expires_at if deadline is not None else None
+    try:
+        while True:
+            try:
+                chunk, error = chunks.get(timeout=None if ends is None else max(0.0, ends - time.monotonic()))
+            except queue.Empty:
+                raise concurrent.futures.TimeoutError(
+                    f"ストリーミングが {limit:.0f}秒 以内に終わりませんでした") from None
+            if error is not None:
+                raise error
+            if chunk is _STREAM_START:
+                ends = time.monotonic() + limit if ends is None else min(ends, time.monotonic() + limit)
+                continue
+            if chunk is _STREAM_END:
+                return
+            yield chunk
+    finally:
+        # まだ始まっていなければ取り消し、打ち切った後に届いたチャンクは読み捨てる
+        # （止まったままのストリームはストリーミング用のスレッドに残る）
+        future.cancel()
+        abandoned.set()
+
+
+def _call_with_timeout(fn, call_timeout, deadline):
+    """
+    fn() をスレッドプールで実行し、始まってから call_timeout 秒（と deadline の残り）で打ち切る。
+    プールが埋まっていて始まらない間は締め切りまで待ち、打ち切るときは Future を取り消す
+    （実行中のスレッドは止められないが、まだ始まっていない呼び出しは実行しない）。
+    """
+    started = threading.Event()
+
+    def run():
+        started.set()
+        return fn()
+
+    future = _call_executor.submit(run)
+    try:
+        if not started.wait(deadline.remaining() if deadline is not None else None):
+            raise concurrent.futures.TimeoutError("スレッドプールの空き待ちで締め切りを過ぎました")
+        if deadline is not None:
+            call_timeout = min(call_timeout, deadline.remaining())
+        return future.result(timeout=call_timeout)
+    finally:
+        future.cancel()
+
+
+def call_with_retry(model, prompt, policy=None, deadline=None, on_retry=None, kind="other", **kwargs):
+    """model.generate_text(prompt) を再試行付きで呼び出し、テキストを返す（model は echo_backend.TextModel）"""
+    return retry_call(
+        lambda: model.generate_text(prompt, **kwargs).strip(),
+        model_name_of(model), policy=policy, deadline=deadline, on_retry=on_retry, kind=kind,
+        prompt_size=len(prompt),
+    )
@@ -0,0 +1,305 @@
+"""
+echo_scheduler.py
+Project Echo - バックグラウンド処理のスケジューラ（名前付きキュー + 固定数のワーカー）
+
+リクエストごとに threading.Thread を立てる代わりに、用途ごとの名前付きキューに積み、
+キューごとに決まった数のワーカースレッドで処理する。
+- 同時に動く処理の数はワーカー数までで、アクセスが集中してもスレッドは増えない
+- キューが一杯のまま空かなければ submit() が QueueFull を送出する（呼び出し側で 503 などにする）
+- ジョブごとに状態（queued / running / done / failed / cancelled）と時刻を記録し、
+  snapshot() でキューの深さと最近のジョブを確認できる（ECHO_DEBUG_ROUTES=1 なら /debug/jobs）
+- 処理は投入した側の文脈（ログのセッション ID・トレースの親スパン）のまま実行される
+- drain() で受付を止め、実行中・待機中のジョブが終わるのを待つ（SIGTERM で呼ぶ）。
+  実行中のジョブが続きとして積むジョブ（フェーズ完了後の要約など）は停止処理中も受け付ける
+
+    phase_jobs = scheduler.queue('phase', workers=16)
+    future = phase_jobs.submit(run_phase, session_id, phase, label=session_id)
+
+環境変数:
+    ECHO_JOB_HISTORY     snapshot() に残す終了済みジョブの件数（既定: 500）
+    ECHO_DRAIN_TIMEOUT   終了時にジョブの完了を待つ最大秒数（既定: 25）
+"""
+
+import atexit
+import collections
+import concurrent.futures
+import itertools
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from echo_logging import get_logger, in_context, current_session_id
+
+log = get_logger(__name__)
+
+# ワーカースレッドの印（実行中のジョブからの追加投入は停止処理中でも受け付ける）
+_worker_local = threading.local()
+
+
+class QueueFull(Exception):
+    """キューが一杯（または停止中）でジョブを受け付けられない"""
+
+
+class Job:
+    """1件のジョブの状態と時刻（時刻は UNIX 時刻）"""
+
+    def __init__(self, job_id, queue_name, label, session_id):
+        self.id = job_id
+        self.queue = queue_name
+        self.label = label
+        self.session_id = session_id
+        self.state = 'queued'
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+    def to_dict(self):
+        now = time.time()
+        started = self.started_at or now
+        return {
+            "id": self.id,
+            "queue": self.queue,
+            "label": self.label,
+            "session_id": self.session_id,
+            "state": self.state,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_wait_seconds": round(started - self.submitted_at, 3),
+            "run_seconds": round((self.finished_at or now) - started, 3) if self.started_at else None,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """名前付きキュー1つ分（ワーカーは最初の submit() で起動する）"""
+
+    def __init__(self, scheduler, name, workers=4, max_queued=200, put_timeout=5.0):
+        self.scheduler = scheduler
+        self.name = name
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self._max_wait = 0.0
+
+    def _ensure_workers(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True, name=f"{self.name}-worker-{i}")
+                thread.start()
+                self._threads.append(thread)
+
+    def _reject(self, message):
+        with self._lock:
+            self._stats["rejected"] += 1
+        raise QueueFull(message)
+
+    def submit(self, fn, *args, label=None, timeout=None, **kwargs):
+        """
+        fn(*args, **kwargs) をキューに積み、concurrent.futures.Future を返す。
+        timeout はキューに空きを待つ秒数（既定は put_timeout。リクエスト処理中なら 0 にする）
+        """
+        if self.scheduler.closed and not getattr(_worker_local, 'in_job', False):
+            self._reject(f"停止処理中のため {self.name} ジョブを受け付けません")
+        self._ensure_workers()
+        future = concurrent.futures.Future()
+        job = self.scheduler._new_job(self.name, label)
+        try:
+            self._queue.put((job, future, in_context(fn), args, kwargs),
+                            timeout=self.put_timeout if timeout is None else timeout)
+        except queue.Full:
+            self.scheduler._finish(job, 'rejected')
+            self._reject(f"{self.name} キューが一杯です（{self._queue.maxsize}件）")
+        with self._lock:
+            self._stats["submitted"] += 1
+        return future
+
+    def _work(self):
+        _worker_local.in_job = True
+        while True:
+            job, future, fn, args, kwargs = self._queue.get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    with self._lock:
+                        self._stats["cancelled"] += 1
+                    self.scheduler._finish(job, 'cancelled')
+                    continue
+                job.state = 'running'
+                job.started_at = time.time()
+                waited = job.started_at - job.submitted_at
+                with self._lock:
+                    self._running += 1
+                    self._max_wait = max(self._max_wait, waited)
+                if waited >= 1:
+                    log.debug("%sジョブ開始 (%s): キュー待ち %.1f秒", self.name, job.label, waited)
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    log.error("%sジョブ失敗 (%s): %s", self.name, job.label, e)
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    job.error = f"{type(e).__name__}: {str(e)[:200]}"
+                    self.scheduler._finish(job, 'failed')
+                    future.set_exception(e)
+                else:
+                    with self._lock:
+                        self._stats["completed"] += 1
+                    self.scheduler._finish(job, 'done')
+                    future.set_result(result)
+                finally:
+                    with self._lock:
+                        self._running -= 1
+            finally:
+                self._queue.task_done()
+
+    def cancel_pending(self):
+        """待機中のジョブをすべて取り消す（実行中のものはそのまま）。取り消した件数を返す"""
+        count = 0
+        while True:
+            try:
+                job, future, *_ = self._queue.get_nowait()
+            except queue.Empty:
+                return count
+            if future.cancel():
+                count += 1
+                with self._lock:
+                    self._stats["cancelled"] += 1
+                self.scheduler._finish(job, 'cancelled')
+            self._queue.task_done()
+
+    def busy(self):
+        with self._lock:
+            return self._running + self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self._queue.qsize(),
+                "running": self._running,
+                "max_queue_wait_seconds": round(self._max_wait, 3),
+                **self._stats,
+            }
+
+
+class Scheduler:
+    def __init__(self, history=500, drain_timeout=25.0):
+        self.drain_timeout = drain_timeout
+        self.closed = False
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._active = {}                                   # job_id -> Job（待機中・実行中）
+        self._history = collections.deque(maxlen=history)   # 終了済みの Job（新しいものが右）
+        self._ids = itertools.count(1)
+        self._handlers_installed = False
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            history=int(os.environ.get("ECHO_JOB_HISTORY", "500")),
+            drain_timeout=float(os.environ.get("ECHO_DRAIN_TIMEOUT", "25")),
+        )
+
+    def queue(self, name, workers=4, max_queued=200, put_timeout=5.0):
+        """名前付きキューを作る（同じ名前なら既存のものを返す）"""
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = JobQueue(self, name, workers, max_queued, put_timeout)
+            return self._queues[name]
+
+    # ---------- ジョブの記録 ----------
+    def _new_job(self, queue_name, label):
+        job = Job(next(self._ids), queue_name, label, current_session_id())
+        with self._lock:
+            self._active[job.id] = job
+        return job
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        with self._lock:
+            self._active.pop(job.id, None)
+            self._history.append(job)
+
+    def snapshot(self, session_id=None, limit=100):
+        """キューごとの統計と、待機中・実行中・最近終了したジョブ（新しい順）"""
+        with self._lock:
+            queues = list(self._queues.values())
+            jobs = list(self._active.values()) + list(self._history)
+        if session_id is not None:
+            jobs = [job for job in jobs if job.session_id == session_id]
+        jobs.sort(key=lambda job: job.id, reverse=True)
+        return {
+            "closed": self.closed,
+            "queues": {q.name: q.stats() for q in queues},
+            "jobs": [job.to_dict() for job in jobs[:limit]],
+        }
+
+    def stats(self):
+        with self._lock:
+            queues = list(self._queues.values())
+        return {q.name: q.stats() for q in queues}
+
+    # ---------- 停止 ----------
+    def drain(self, timeout=None):
+        """
+        新しいジョブの受付を止め、待機中・実行中のジョブが終わるまで最大 timeout 秒待つ。
+        時間内に始まらなかったジョブは取り消す。終わらなかったジョブ数を返す。
+        """
+        timeout = self.drain_timeout if timeout is None else timeout
+        self.closed = True
+        with self._lock:
+            queues = list(self._queues.values())
+        pending = sum(q.busy() for q in queues)
+        if pending:
+            log.info("停止前にジョブの完了を待機: %s件（最大 %.0f秒）", pending, timeout)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(q.busy() for q in queues):
+            time.sleep(0.2)
+        cancelled = sum(q.cancel_pending() for q in queues)
+        remaining = sum(q.busy() for q in queues)
+        if cancelled or remaining:
+            log.warning("停止時に未完了のジョブ: 取り消し %s件 / 実行中 %s件", cancelled, remaining)
+        return cancelled + remaining
+
+    def install_shutdown_handlers(self):
+        """
+        SIGTERM で受付を止め、プロセス終了時に drain() する。
+        既存の SIGTERM ハンドラ（gunicorn のワーカーなど）があればその後に呼ぶ。
+        メインスレッドからだけ呼べる。
+        """
+        if self._handlers_installed:
+            return
+        self._handlers_installed = True
+        # ジョブ内の呼び出し（echo_retry のタイムアウト用 executor など）が使えるうちに待つため、
+        # concurrent.futures の終了処理より先に動く threading の終了フックに登録する
+        register = getattr(threading, '_register_atexit', atexit.register)
+        register(self.drain)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            log.info("SIGTERM を受信。新しいジョブの受付を停止します")
+            self.closed = True
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                sys.exit(0)     # 終了フックの drain() を通して終了する
+
+        try:
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            # メインスレッド以外（テストランナーなど）では atexit の drain() だけを使う
+            log.debug("SIGTERM ハンドラを設定できません（メインスレッド以外）")
+
+
+scheduler = Scheduler.from_env()
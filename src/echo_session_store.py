@@ -0,0 +1,491 @@
+"""
+echo_session_store.py
+Project Echo - セッションストア
+
+セッションは JSON にできる値（dict / list / str / 数値）だけを持つ。
+全ての変更は update() を通し、version が1つずつ進む。
+
+- MemorySessionStore: プロセス内 LRU（上限件数を超えたら古いものから破棄）
+- SQLiteSessionStore: SQLite に保存。インスタンス再起動後もセッションが残り、
+  同じファイルを開く複数のワーカープロセスで共有できる
+- RedisSessionStore: Redis（Redis プロトコル互換のサーバー）に保存。複数インスタンスで共有できる
+
+いずれもセッションごとの TTL を持ち、start_sweeper() で起動するバックグラウンド
+スレッドが期限切れのセッションを削除する。
+update() はセッション単位で原子的（読み込み〜書き込みの間に他の更新が割り込まない）。
+expect を渡すと、そのフィールドが一致するときだけ更新する（状態の取り合いに使う）。
+
+    session_store.update(session_id, {'status': 'generating'}, expect={'status': 'continue'})
+
+複数プロセスで共有するストア（shared = True）は、ワーカーの生存確認（heartbeat /
+worker_alive）も同じ場所に記録する。生成途中のまま止まったセッションの持ち主が
+生きているかどうかの判定に使う。
+
+環境変数:
+    ECHO_SESSION_DB              SQLite ファイルのパス（未指定ならメモリ）
+    ECHO_SESSION_DB_JOURNAL      SQLite のジャーナルモード（既定: WAL。ネットワーク
+                                 ファイルシステム上では WAL が使えないので DELETE にする）
+    ECHO_SESSION_REDIS_URL       Redis の URL 例: redis://localhost:6379/0（ECHO_SESSION_DB より優先）
+    ECHO_SESSION_REDIS_PREFIX    Redis のキーの接頭辞（既定: "echo:"）
+    ECHO_SESSION_TTL             セッションの有効期限（秒、最終更新から。既定: 21600）
+    ECHO_SESSION_MAX             メモリストアの最大セッション数（既定: 1000）
+    ECHO_SESSION_SWEEP_INTERVAL  期限切れチェックの間隔（秒、既定: 60）
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:     # Redis ストアを使わないなら不要
+    redis = None
+
+from echo_logging import get_logger
+
+log = get_logger(__name__)
+
+
+class SessionStore:
+    """セッションストアのインターフェース"""
+
+    # 他のプロセスと共有するストアか（True なら他のワーカーの更新はポーリングで知る）
+    shared = False
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._sweeper = None
+
+    def get(self, session_id):
+        """セッションの dict を返す（無ければ None）。返り値を直接書き換えないこと"""
+        raise NotImplementedError
+
+    def put(self, session_id, session, ttl=None):
+        """セッションを新規作成（または丸ごと置き換え）する"""
+        raise NotImplementedError
+
+    def update(self, session_id, fields, ttl=None, expect=None):
+        """
+        fields をマージして version を進め、更新後のセッションを返す。
+        セッションが無いか、expect のフィールドが現在の値と一致しなければ更新せず None。
+        """
+        raise NotImplementedError
+
+    def version(self, session_id):
+        """セッションの version（無ければ None）"""
+        session = self.get(session_id)
+        return session.get('version', 0) if session else None
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def items(self):
+        """(session_id, session) を全件列挙する"""
+        raise NotImplementedError
+
+    def expire(self, now=None):
+        """期限切れのセッションを削除し、削除した session_id のリストを返す"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def heartbeat(self, worker_id, timeout):
+        """worker_id のワーカーが timeout 秒後まで生きていると記録する（timeout <= 0 なら記録を消す）"""
+        raise NotImplementedError
+
+    def worker_alive(self, worker_id):
+        raise NotImplementedError
+
+    def start_sweeper(self, interval=60, on_expire=None):
+        """期限切れセッションを定期的に削除するデーモンスレッドを起動する"""
+        if self._sweeper is not None:
+            return
+
+        def sweep():
+            while True:
+                time.sleep(interval)
+                try:
+                    expired = self.expire()
+                except Exception as e:
+                    log.warning("セッション掃除エラー: %s", e)
+                    continue
+                if expired:
+                    log.info("期限切れセッションを削除: %s件", len(expired))
+                for session_id in expired:
+                    if on_expire:
+                        on_expire(session_id)
+
+        self._sweeper = threading.Thread(target=sweep, daemon=True, name="session-sweeper")
+        self._sweeper.start()
+
+    @staticmethod
+    def _matches(session, expect):
+        return all(session.get(key) == value for key, value in (expect or {}).items())
+
+    @staticmethod
+    def _merge(session, fields):
+        merged = dict(session)
+        merged.update(fields)
+        merged['version'] = session.get('version', 0) + 1
+        return merged
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内の LRU ストア
+    update() は新しい dict に差し替える（copy-on-write）ので、get() で取得した dict は
+    他スレッドの更新中でも一貫した状態のまま読める。
+    """
+
+    def __init__(self, ttl=21600, max_sessions=1000):
+        super().__init__(ttl)
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._data = OrderedDict()   # session_id -> (session, ttl, expires_at)
+        self._evicted = []           # 上限超過・get() 時の期限切れで破棄した session_id（次の expire() で通知）
+        self._workers = {}           # worker_id -> 生存期限
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                # 掃除を待たずに消すが、後始末（on_expire）は次の expire() で通知する
+                del self._data[session_id]
+                self._evicted.append(session_id)
+                return None
+            self._data.move_to_end(session_id)
+            return entry[0]
+
+    def put(self, session_id, session, ttl=None):
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._data[session_id] = (session, ttl, time.time() + ttl)
+            self._data.move_to_end(session_id)
+            while len(self._data) > self.max_sessions:
+                evicted, _ = self._data.popitem(last=False)
+                self._evicted.append(evicted)
+                log.warning("セッション上限のため破棄: %s", evicted)
+
+    def update(self, session_id, fields, ttl=None, expect=None):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None or not self._matches(entry[0], expect):
+                return None
+            ttl = ttl or entry[1]
+            session = self._merge(entry[0], fields)
+            self._data[session_id] = (session, ttl, time.time() + ttl)
+            self._data.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def items(self):
+        with self._lock:
+            return [(sid, entry[0]) for sid, entry in self._data.items()]
+
+    def expire(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            expired = [sid for sid, entry in self._data.items() if entry[2] <= now]
+            for sid in expired:
+                del self._data[sid]
+            expired += self._evicted
+            self._evicted = []
+        return expired
+
+    def __len__(self):
+        return len(self._data)
+
+    def heartbeat(self, worker_id, timeout):
+        with self._lock:
+            if timeout <= 0:
+                self._workers.pop(worker_id, None)
+            else:
+                self._workers[worker_id] = time.time() + timeout
+
+    def worker_alive(self, worker_id):
+        with self._lock:
+            return self._workers.get(worker_id, 0) > time.time()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite に JSON として保存するストア
+    同じファイルを開けば複数のワーカープロセスで共有できる（書き込みは BEGIN IMMEDIATE で直列化）。
+    WAL は同じホストのプロセス間でしか使えないため、共有ボリューム越しに複数インスタンスから
+    開く場合は journal_mode='DELETE' にする。
+    """
+
+    shared = True
+
+    def __init__(self, path, ttl=21600, journal_mode='WAL'):
+        super().__init__(ttl)
+        self.path = path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, data TEXT NOT NULL,"
+            " ttl REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _dumps(session):
+        return json.dumps(session, ensure_ascii=False)
+
+    def get(self, session_id):
+        row = self._connect().execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+            (session_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id, session, ttl=None):
+        ttl = ttl or self.ttl
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sessions (id, data, ttl, expires_at) VALUES (?, ?, ?, ?)",
+            (session_id, self._dumps(session), ttl, time.time() + ttl)
+        )
+
+    def update(self, session_id, fields, ttl=None, expect=None):
+        conn = self._connect()
+        # 読み込み〜書き込みを1トランザクションにして、同じセッションへの更新を直列化する
+        # （別プロセスからの更新も含む）
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data, ttl FROM sessions WHERE id = ? AND expires_at > ?",
+                (session_id, time.time())
+            ).fetchone()
+            current = json.loads(row[0]) if row else None
+            if current is None or not self._matches(current, expect):
+                conn.execute("ROLLBACK")
+                return None
+            ttl = ttl or row[1]
+            session = self._merge(current, fields)
+            conn.execute(
+                "UPDATE sessions SET data = ?, ttl = ?, expires_at = ? WHERE id = ?",
+                (self._dumps(session), ttl, time.time() + ttl, session_id)
+            )
+            conn.execute("COMMIT")
+            return session
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def version(self, session_id):
+        # 変更待ちのポーリング用。JSON 全体をパースせずに version だけ読む
+        row = self._connect().execute(
+            "SELECT json_extract(data, '$.version') FROM sessions WHERE id = ? AND expires_at > ?",
+            (session_id, time.time())
+        ).fetchone()
+        return (row[0] or 0) if row else None
+
+    def delete(self, session_id):
+        self._connect().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def items(self):
+        rows = self._connect().execute(
+            "SELECT id, data FROM sessions WHERE expires_at > ?", (time.time(),)
+        ).fetchall()
+        return [(sid, json.loads(data)) for sid, data in rows]
+
+    def expire(self, now=None):
+        now = now or time.time()
+        conn = self._connect()
+        # 複数のワーカーが同時に掃除しても、期限切れの通知はどれか1つにだけ返る
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = [row[0] for row in conn.execute(
+                "SELECT id FROM sessions WHERE expires_at <= ?", (now,)
+            )]
+            if expired:
+                conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM workers WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return expired
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+        ).fetchone()[0]
+
+    def heartbeat(self, worker_id, timeout):
+        if timeout <= 0:
+            self._connect().execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+            return
+        self._connect().execute(
+            "INSERT OR REPLACE INTO workers (id, expires_at) VALUES (?, ?)",
+            (worker_id, time.time() + timeout)
+        )
+
+    def worker_alive(self, worker_id):
+        row = self._connect().execute(
+            "SELECT 1 FROM workers WHERE id = ? AND expires_at > ?", (worker_id, time.time())
+        ).fetchone()
+        return row is not None
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis に保存するストア（複数インスタンスで共有する場合）
+    キー:
+        <prefix>session:<id>    {"ttl": 秒, "session": {...}}（キー自体にも有効期限を付ける）
+        <prefix>session-expiry  sorted set（id -> 期限の UNIX 時刻。期限切れの通知と件数に使う）
+        <prefix>worker:<id>     ワーカーの生存確認（有効期限付き）
+    update() は WATCH / MULTI による楽観ロックで、競合したら読み込みからやり直す。
+    """
+
+    shared = True
+
+    def __init__(self, client, ttl=21600, prefix='echo:'):
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+        self._expiry_key = f"{prefix}session-expiry"
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError("ECHO_SESSION_REDIS_URL を使うには redis パッケージが必要です（pip install redis）")
+        return cls(redis.Redis.from_url(url, decode_responses=True), **kwargs)
+
+    def _key(self, session_id):
+        return f"{self.prefix}session:{session_id}"
+
+    @staticmethod
+    def _dumps(session, ttl):
+        return json.dumps({"ttl": ttl, "session": session}, ensure_ascii=False)
+
+    def _write(self, pipe, session_id, session, ttl):
+        pipe.set(self._key(session_id), self._dumps(session, ttl), px=int(ttl * 1000))
+        pipe.zadd(self._expiry_key, {session_id: time.time() + ttl})
+
+    def get(self, session_id):
+        raw = self.client.get(self._key(session_id))
+        return json.loads(raw)["session"] if raw else None
+
+    def put(self, session_id, session, ttl=None):
+        with self.client.pipeline() as pipe:
+            self._write(pipe, session_id, session, ttl or self.ttl)
+            pipe.execute()
+
+    def update(self, session_id, fields, ttl=None, expect=None):
+        key = self._key(session_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    entry = json.loads(raw) if raw else None
+                    if entry is None or not self._matches(entry["session"], expect):
+                        pipe.unwatch()
+                        return None
+                    session = self._merge(entry["session"], fields)
+                    pipe.multi()
+                    self._write(pipe, session_id, session, ttl or entry["ttl"])
+                    pipe.execute()
+                    return session
+                except redis.WatchError:
+                    # 読み込み後に他のプロセスが更新した。最新の値でやり直す
+                    continue
+
+    def delete(self, session_id):
+        with self.client.pipeline() as pipe:
+            pipe.delete(self._key(session_id))
+            pipe.zrem(self._expiry_key, session_id)
+            pipe.execute()
+
+    def items(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}session:*", count=500))
+        if not keys:
+            return []
+        start = len(f"{self.prefix}session:")
+        return [(key[start:], json.loads(raw)["session"])
+                for key, raw in zip(keys, self.client.mget(keys)) if raw]
+
+    def expire(self, now=None):
+        now = now or time.time()
+        expired = []
+        for session_id in self.client.zrangebyscore(self._expiry_key, "-inf", now):
+            if self._expire_one(session_id, now):
+                expired.append(session_id)
+        return expired
+
+    def _expire_one(self, session_id, now):
+        """
+        期限を確かめてから ZREM + DEL する（WATCH / MULTI）。確かめた後に他のプロセスが
+        update / put で期限を延ばすとセッションのキーが書き換わり、EXEC が失敗するので消さない
+        """
+        key = self._key(session_id)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                score = pipe.zscore(self._expiry_key, session_id)
+                if score is None or score > now:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.zrem(self._expiry_key, session_id)
+                pipe.delete(key)
+                removed, _ = pipe.execute()
+            except redis.WatchError:
+                return False
+        # ZREM できたプロセスだけが期限切れを通知する（複数ワーカーでの重複を防ぐ）
+        return bool(removed)
+
+    def __len__(self):
+        return self.client.zcount(self._expiry_key, f"({time.time()}", "+inf")
+
+    def heartbeat(self, worker_id, timeout):
+        key = f"{self.prefix}worker:{worker_id}"
+        # SET の PX は 1 以上でなければ Redis がエラーにする
+        px = int(timeout * 1000)
+        if px <= 0:
+            self.client.delete(key)
+            return
+        self.client.set(key, time.time(), px=px)
+
+    def worker_alive(self, worker_id):
+        return bool(self.client.exists(f"{self.prefix}worker:{worker_id}"))
+
+
+def session_store_from_env():
+    ttl = float(os.environ.get("ECHO_SESSION_TTL", "21600"))
+    redis_url = os.environ.get("ECHO_SESSION_REDIS_URL")
+    if redis_url:
+        return RedisSessionStore.from_url(
+            redis_url, ttl=ttl, prefix=os.environ.get("ECHO_SESSION_REDIS_PREFIX", "echo:"))
+    db_path = os.environ.get("ECHO_SESSION_DB")
+    if db_path:
+        return SQLiteSessionStore(
+            db_path, ttl=ttl, journal_mode=os.environ.get("ECHO_SESSION_DB_JOURNAL", "WAL"))
+    return MemorySessionStore(ttl=ttl, max_sessions=int(os.environ.get("ECHO_SESSION_MAX", "1000")))
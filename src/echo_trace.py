@@ -0,0 +1,204 @@
+"""
+echo_trace.py
+Project Echo - セッション単位のスパン記録（Chrome trace event 形式で出力）
+
+1本の物語は /start・/continue・提案・物語メモリ・画像生成と、別々のスレッドで進む。
+ログのセッション ID（echo_logging.session_id_var）をキーに、各処理の開始・終了時刻と
+付帯情報（プロンプト・応答の大きさ、結果など）をセッションごとに記録する。
+- セッション ID の無い文脈（起動処理など）では何も記録しない
+- 別スレッドへは echo_logging.in_context で渡せば、セッション ID と親スパンが引き継がれる
+- セッションごとの件数とセッション数に上限があり、古いものから捨てる
+- export(session_id) は chrome://tracing や Perfetto でそのまま開ける JSON を返す
+
+    with tracer.span('narrator', cat='model', prompt_size=len(prompt)) as span:
+        text = ...
+        span.set(response_size=len(text))
+    tracer.instant('retry', cause='rate_limit')
+
+    @tracer.traced(cat='phase', fields=('phase',))   # 関数全体を1つのスパンにする
+    def generate_phase(session_id, phase, ...):
+
+値はプロセスごと。gunicorn で複数ワーカーにする場合は、そのセッションを処理したワーカーにだけ残る。
+
+環境変数:
+    ECHO_TRACE               "0" で記録しない（既定: "1"）
+    ECHO_TRACE_MAX_SPANS     1セッションで保持するイベント数の上限（既定: 5000）
+    ECHO_TRACE_MAX_SESSIONS  記録を保持するセッション数の上限（既定: 200）
+"""
+
+import collections
+import contextvars
+import functools
+import inspect
+import itertools
+import os
+import threading
+import time
+
+from echo_logging import session_id_var
+
+_current_span = contextvars.ContextVar('echo_trace_span', default=None)
+
+# スレッドの ident は終了後に再利用されるので、トレース用にはスレッドごとに連番を振る
+_thread_ids = itertools.count(1)
+_thread_local = threading.local()
+
+
+def _thread_id():
+    tid = getattr(_thread_local, 'tid', None)
+    if tid is None:
+        tid = _thread_local.tid = next(_thread_ids)
+    return tid
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+class Span:
+    """記録中のスパン。set() で付帯情報を追加できる"""
+
+    def __init__(self, tracer, session_id, name, cat, args):
+        self.tracer = tracer
+        self.session_id = session_id
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.id = next(tracer._ids)
+        self.parent = _current_span.get()
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.started = _now_us()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.args.setdefault('outcome', 'error')
+            self.args['error'] = f"{type(exc).__name__}: {str(exc)[:200]}"
+        else:
+            self.args.setdefault('outcome', 'ok')
+        if self.parent is not None:
+            self.args['parent'] = f"{self.parent.name}#{self.parent.id}"
+        self.tracer._record(self.session_id, {
+            "name": self.name, "cat": self.cat, "ph": "X",
+            "ts": self.started, "dur": _now_us() - self.started,
+            "id": self.id, "args": self.args,
+        })
+        return False
+
+
+class _NullSpan:
+    """記録しないときのスパン（呼び出し側は区別せずに使える）"""
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    def __init__(self, enabled=True, max_spans=5000, max_sessions=200):
+        self.enabled = enabled
+        self.max_spans = max_spans
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()  # session_id -> {"events": deque, "threads": {tid: name}}
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("ECHO_TRACE", "1") == "1",
+            max_spans=int(os.environ.get("ECHO_TRACE_MAX_SPANS", "5000")),
+            max_sessions=int(os.environ.get("ECHO_TRACE_MAX_SESSIONS", "200")),
+        )
+
+    # ---------- 記録 ----------
+    def span(self, name, cat='app', **args):
+        """with ブロックの区間を現在のセッションに記録する"""
+        session_id = session_id_var.get()
+        if not self.enabled or session_id is None:
+            return _NULL_SPAN
+        return Span(self, session_id, name, cat, args)
+
+    def traced(self, name=None, cat='app', fields=()):
+        """関数呼び出し全体を記録するデコレータ。fields に挙げた引数はスパンの付帯情報になる"""
+        def decorate(fn):
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or session_id_var.get() is None:
+                    return fn(*args, **kwargs)
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                with self.span(name or fn.__name__, cat, **{f: bound[f] for f in fields if f in bound}):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def instant(self, name, cat='app', **args):
+        """時刻だけのイベント（再試行の発生など）"""
+        session_id = session_id_var.get()
+        if not self.enabled or session_id is None:
+            return
+        parent = _current_span.get()
+        if parent is not None:
+            args['parent'] = f"{parent.name}#{parent.id}"
+        self._record(session_id, {"name": name, "cat": cat, "ph": "i", "s": "t", "ts": _now_us(), "args": args})
+
+    def _record(self, session_id, event):
+        tid = _thread_id()
+        event["pid"] = 1
+        event["tid"] = tid
+        with self._lock:
+            trace = self._sessions.get(session_id)
+            if trace is None:
+                trace = self._sessions[session_id] = {
+                    "events": collections.deque(maxlen=self.max_spans), "threads": {}}
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            trace["events"].append(event)
+            trace["threads"][tid] = threading.current_thread().name
+
+    # ---------- 参照 ----------
+    def export(self, session_id):
+        """Chrome trace event 形式の dict（記録が無ければ None）"""
+        with self._lock:
+            trace = self._sessions.get(session_id)
+            if trace is None:
+                return None
+            events = list(trace["events"])
+            threads = dict(trace["threads"])
+        metadata = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"session {session_id}"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+                     for tid, name in threads.items()]
+        return {"traceEvents": metadata + sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sessions": len(self._sessions),
+                "events": sum(len(t["events"]) for t in self._sessions.values()),
+            }
+
+
+tracer = Tracer.from_env()
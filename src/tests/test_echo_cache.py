@@ -0,0 +1,132 @@
+"""
+echo_cache の単体テスト。ヒット・TTL・LRU・ディスク層・バリエーションと、
+validate に通った応答だけを保存することを確かめる。
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from echo_cache import InvalidResponse, ResponseCache, cache_key  # noqa: E402
+
+
+class Model:
+    """呼ばれた回数を数え、replies を順に返す"""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.replies[min(self.calls, len(self.replies)) - 1]
+
+
+def make_cache(disk=False, **kwargs):
+    kwargs.setdefault('ttls', {'title': 60})
+    cache_dir = tempfile.mkdtemp(prefix="echo-test-cache-") if disk else None
+    return ResponseCache(enabled=True, cache_dir=cache_dir, **kwargs)
+
+
+def test_second_call_is_a_hit():
+    cache, model = make_cache(), Model("題名")
+    assert cache.get_or_call('title', 'm', 'p', model) == "題名"
+    assert cache.get_or_call('title', 'm', 'p', model) == "題名"
+    assert model.calls == 1
+    assert cache.stats()['kinds']['title']['hits'] == 1
+
+
+def test_key_depends_on_model_prompt_and_config():
+    keys = {cache_key('m', 'p'), cache_key('m2', 'p'), cache_key('m', 'p2'),
+            cache_key('m', 'p', {'temperature': 1.0})}
+    assert len(keys) == 4
+    assert cache_key('m', 'p', {'a': 1, 'b': 2}) == cache_key('m', 'p', {'b': 2, 'a': 1})
+
+
+def test_kind_without_ttl_is_not_cached():
+    cache, model = make_cache(), Model("x")
+    cache.get_or_call('narrator', 'm', 'p', model)
+    cache.get_or_call('narrator', 'm', 'p', model)
+    assert model.calls == 2
+
+
+def test_disabled_cache_always_calls():
+    cache, model = ResponseCache(enabled=False), Model("x")
+    cache.get_or_call('title', 'm', 'p', model)
+    cache.get_or_call('title', 'm', 'p', model)
+    assert model.calls == 2
+
+
+def test_expired_entry_is_refetched():
+    cache, model = make_cache(ttls={'title': 0.05}), Model("古い", "新しい")
+    cache.get_or_call('title', 'm', 'p', model)
+    time.sleep(0.1)
+    assert cache.get_or_call('title', 'm', 'p', model) == "新しい"
+
+
+def test_lru_evicts_oldest_key():
+    cache = make_cache(max_entries=2)
+    for prompt in ('a', 'b', 'c'):
+        cache.get_or_call('title', 'm', prompt, Model(prompt))
+    model = Model("a2")
+    assert cache.get_or_call('title', 'm', 'a', model) == "a2"
+    assert cache.stats()['kinds']['title']['evictions'] >= 1
+
+
+def test_disk_tier_survives_a_new_instance():
+    cache = make_cache(disk=True)
+    cache.get_or_call('title', 'm', 'p', Model("保存"))
+    reopened = ResponseCache(enabled=True, cache_dir=cache.cache_dir, ttls={'title': 60})
+    model = Model("別")
+    assert reopened.get_or_call('title', 'm', 'p', model) == "保存"
+    assert model.calls == 0
+    assert reopened.stats()['kinds']['title']['disk_hits'] == 1
+
+
+def test_variants_fill_up_before_hits():
+    cache, model = make_cache(variants=3), Model("1", "2", "3", "4")
+    for _ in range(3):
+        cache.get_or_call('title', 'm', 'p', model)
+    assert model.calls == 3
+    assert {cache.get_or_call('title', 'm', 'p', model) for _ in range(20)} <= {"1", "2", "3"}
+    assert model.calls == 3
+
+
+def test_invalid_response_is_not_stored():
+    cache, model = make_cache(ttls={'setup': 60}), Model('{"a": ', '{"a": 1}')
+    with pytest.raises(InvalidResponse) as info:
+        cache.get_or_call('setup', 'm', 'p', model, validate=json.loads)
+    assert info.value.text == '{"a": '
+    assert isinstance(info.value, ValueError)
+    assert cache.get_or_call('setup', 'm', 'p', model, validate=json.loads) == {"a": 1}
+    assert cache.get_or_call('setup', 'm', 'p', model, validate=json.loads) == {"a": 1}
+    assert model.calls == 2
+    assert cache.stats()['kinds']['setup']['invalid'] == 1
+
+
+def test_cached_response_failing_validation_is_discarded():
+    cache = make_cache(disk=True)
+    cache.get_or_call('title', 'm', 'p', Model(""))
+
+    def nonempty(text):
+        if not text:
+            raise ValueError("空")
+        return text
+    model = Model("題名")
+    assert cache.get_or_call('title', 'm', 'p', model, validate=nonempty) == "題名"
+    assert model.calls == 1
+    assert cache.stats()['kinds']['title']['discarded'] == 1
+    reopened = ResponseCache(enabled=True, cache_dir=cache.cache_dir, ttls={'title': 60})
+    assert reopened.get_or_call('title', 'm', 'p', Model("別"), validate=nonempty) == "題名"
+
+
+def test_validate_applies_when_cache_is_off():
+    cache = ResponseCache(enabled=False)
+    with pytest.raises(InvalidResponse):
+        cache.get_or_call('setup', 'm', 'p', Model("x"), validate=json.loads)
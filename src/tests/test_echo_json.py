@@ -0,0 +1,145 @@
+"""
+echo_json の単体テスト。モデル出力によくある崩れ（コードフェンス・末尾のカンマ・
+スマートクォート・途中で切れた出力・前置きの説明文）の修復と、
+ストリーミング中の不完全な JSON からのフィールド抽出を確かめる。
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from echo_json import JsonFieldStreamer, check_schema, parse_json, repair_json  # noqa: E402
+
+
+# ========================================
+# parse_json / repair_json
+# ========================================
+def test_valid_json_is_parsed_as_is():
+    assert parse_json('{"a": 1, "b": [true, null]}') == {"a": 1, "b": [True, None]}
+
+
+def test_code_fence_is_stripped():
+    text = 'はい、どうぞ。\n```json\n{"narrative": "雨が降る"}\n```\n以上です。'
+    assert parse_json(text) == {"narrative": "雨が降る"}
+
+
+def test_plain_code_fence_is_stripped():
+    assert parse_json('```\n["a", "b"]\n```') == ["a", "b"]
+
+
+def test_trailing_commas_are_removed():
+    assert parse_json('{"items": [1, 2, 3,], "name": "x",}') == {"items": [1, 2, 3], "name": "x"}
+
+
+def test_smart_quotes_as_delimiters():
+    assert parse_json('{“summary”: “彼は"秘密"を隠した”, “age”: 17}') == {"summary": '彼は"秘密"を隠した', "age": 17}
+
+
+def test_raw_newline_in_string():
+    assert parse_json('{"narrative": "一行目\n二行目"}') == {"narrative": "一行目\n二行目"}
+
+
+def test_prose_before_and_after_json():
+    text = '以下が結果です: {"suggestions": ["雨", "傘"]} 参考になれば幸いです。'
+    assert parse_json(text) == {"suggestions": ["雨", "傘"]}
+
+
+def test_truncated_string_and_brackets_are_closed():
+    assert parse_json('{"summary": "二人は出会') == {"summary": "二人は出会"}
+    assert parse_json('{"key_facts": ["約束", "秘密"') == {"key_facts": ["約束", "秘密"]}
+
+
+def test_truncated_object_is_closed():
+    data = parse_json('{"characters": [{"name": "佐藤花子", "age": 17}, {"name": "鈴木')
+    assert data == {"characters": [{"name": "佐藤花子", "age": 17}, {"name": "鈴木"}]}
+
+
+def test_truncated_broken_last_element_is_dropped():
+    assert parse_json('{"a": [1, {"b": tru') == {"a": [1]}
+
+
+def test_truncated_after_colon():
+    assert parse_json('{"summary": "x", "key_facts":') == {"summary": "x", "key_facts": None}
+
+
+def test_repair_result_is_loadable_json():
+    import json
+    assert json.loads(repair_json('{"a": [1, 2,')) == {"a": [1, 2]}
+
+
+def test_no_json_raises_value_error():
+    with pytest.raises(ValueError):
+        parse_json("申し訳ありませんが、お答えできません。")
+
+
+def test_unrepairable_raises_value_error():
+    with pytest.raises(ValueError):
+        parse_json('{"a": tru e}')
+
+
+# ========================================
+# check_schema
+# ========================================
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "key_facts": {"type": "array", "items": {"type": "string"}, "max_items": 2},
+        "age": {"type": "integer"},
+    },
+    "required": ["summary", "key_facts"],
+}
+
+
+def test_check_schema_accepts_valid_data():
+    check_schema({"summary": "s", "key_facts": ["a"], "age": 3}, SCHEMA)
+
+
+@pytest.mark.parametrize("data", [
+    [],
+    {"key_facts": []},
+    {"summary": 1, "key_facts": []},
+    {"summary": "s", "key_facts": ["a", 2]},
+    {"summary": "s", "key_facts": ["a", "b", "c"]},
+    {"summary": "s", "key_facts": [], "age": True},
+])
+def test_check_schema_rejects_invalid_data(data):
+    with pytest.raises(ValueError):
+        check_schema(data, SCHEMA)
+
+
+# ========================================
+# JsonFieldStreamer
+# ========================================
+def feed_all(streamer, chunks):
+    return [streamer.feed(chunk) for chunk in chunks]
+
+
+def test_streamer_yields_partial_field_before_object_closes():
+    streamer = JsonFieldStreamer("narrative")
+    deltas = feed_all(streamer, ['{"narr', 'ative": "その日、', 'カフェで', '二人は'])
+    assert ''.join(deltas) == "その日、カフェで二人は"
+    assert not streamer.done
+    assert streamer.feed('出会った。", "other": "x"}') == "出会った。"
+    assert streamer.done
+
+
+def test_streamer_ignores_fence_prefix_and_other_fields():
+    streamer = JsonFieldStreamer("narrative")
+    text = '```json\n{"title": "narrative", "meta": {"narrative": "入れ子"}, "narrative": "本文"}\n```'
+    assert ''.join(feed_all(streamer, list(text))) == "本文"
+
+
+def test_streamer_decodes_escapes_split_across_chunks():
+    streamer = JsonFieldStreamer("narrative")
+    chunks = ['{"narrative": "a\\', 'nb\\"c\\u30', 'a2\\ud83d', '\\ude00"}']
+    assert ''.join(feed_all(streamer, chunks)) == 'a\nb"cア\U0001F600'
+
+
+def test_streamer_without_field_yields_nothing():
+    streamer = JsonFieldStreamer("narrative")
+    assert ''.join(feed_all(streamer, ['{"summary": "x"}'])) == ""
+    assert not streamer.done
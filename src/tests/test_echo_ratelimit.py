@@ -0,0 +1,85 @@
+"""
+echo_ratelimit の単体テスト。バケット容量までは待たずに通り、それを超えると
+RPM に従って待つこと・timeout を超える予約は取り消されること・SQLite で共有できることを確かめる。
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from echo_ratelimit import RateLimiter, RateLimitTimeout, SQLiteBucketBackend  # noqa: E402
+
+MODEL = "gemini-test"
+
+
+def test_burst_passes_without_waiting():
+    limiter = RateLimiter(default_rpm=60, burst=3)
+    assert [limiter.acquire(MODEL) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.available(MODEL) < 1
+
+
+def test_waits_for_refill_after_burst():
+    limiter = RateLimiter(default_rpm=600, burst=2)     # 0.1秒に1トークン
+    limiter.acquire(MODEL)
+    limiter.acquire(MODEL)
+    started = time.monotonic()
+    waited = limiter.acquire(MODEL)
+    assert 0.05 < waited <= 0.1
+    assert time.monotonic() - started >= 0.05
+
+
+def test_reservations_are_fifo():
+    limiter = RateLimiter(default_rpm=600, burst=1)
+    limiter.acquire(MODEL)
+    rate, capacity = limiter._params(MODEL)
+    waits = [limiter.backend.reserve(MODEL, rate, capacity) for _ in range(3)]
+    assert waits == sorted(waits) and waits[0] > 0
+
+
+def test_timeout_raises_and_refunds_the_token():
+    limiter = RateLimiter(default_rpm=6, burst=1)       # 10秒に1トークン
+    limiter.acquire(MODEL)
+    before = limiter.available(MODEL)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(MODEL, timeout=0.5)
+    assert limiter.available(MODEL) == pytest.approx(before, abs=0.01)
+
+
+def test_zero_rpm_is_unlimited():
+    limiter = RateLimiter(default_rpm=0)
+    assert all(limiter.acquire(MODEL) == 0.0 for _ in range(100))
+    assert limiter.available(MODEL) == float('inf')
+    assert limiter.capacity(MODEL) == float('inf')
+
+
+def test_capacity_is_smaller_of_burst_and_rpm():
+    limiter = RateLimiter(default_rpm=10, overrides={"slow": 2}, burst=3)
+    assert limiter.capacity(MODEL) == 3
+    assert limiter.capacity("slow") == 2
+    assert limiter.rpm_for("slow") == 2
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("ECHO_RPM", "30")
+    monkeypatch.setenv("ECHO_RPM_OVERRIDES", "a=60, b=5")
+    monkeypatch.setenv("ECHO_RATE_BURST", "4")
+    monkeypatch.delenv("ECHO_RATE_LIMIT_DB", raising=False)
+    limiter = RateLimiter.from_env()
+    assert (limiter.rpm_for("x"), limiter.rpm_for("a"), limiter.rpm_for("b")) == (30, 60, 5)
+    assert limiter.burst == 4
+
+
+def test_sqlite_backend_is_shared_between_limiters():
+    path = os.path.join(tempfile.mkdtemp(prefix="echo-test-ratelimit-"), "buckets.db")
+    first = RateLimiter(default_rpm=6, burst=2, backend=SQLiteBucketBackend(path))
+    second = RateLimiter(default_rpm=6, burst=2, backend=SQLiteBucketBackend(path))
+    first.acquire(MODEL)
+    second.acquire(MODEL)
+    assert first.available(MODEL) < 1
+    with pytest.raises(RateLimitTimeout):
+        second.acquire(MODEL, timeout=0.5)
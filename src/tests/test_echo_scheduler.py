@@ -0,0 +1,115 @@
+"""
+echo_scheduler の単体テスト。ワーカー数の上限・QueueFull・ジョブの状態記録・
+投入した側の文脈の引き継ぎ・drain() による停止を確かめる。
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from echo_logging import session_context, current_session_id  # noqa: E402
+from echo_scheduler import QueueFull, Scheduler  # noqa: E402
+
+
+def test_submit_returns_future_with_result():
+    jobs = Scheduler().queue('t', workers=2)
+    assert jobs.submit(lambda a, b=0: a + b, 1, b=2).result(timeout=5) == 3
+
+
+def test_same_name_returns_same_queue():
+    scheduler = Scheduler()
+    assert scheduler.queue('t') is scheduler.queue('t', workers=9)
+
+
+def test_concurrency_is_bounded_by_workers():
+    jobs = Scheduler().queue('t', workers=2)
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+    futures = [jobs.submit(work) for _ in range(6)]
+    for future in futures:
+        future.result(timeout=5)
+    assert peak[0] == 2
+    assert jobs.stats()['completed'] == 6
+
+
+def test_full_queue_raises_queue_full():
+    jobs = Scheduler().queue('t', workers=1, max_queued=1)
+    release = threading.Event()
+    jobs.submit(release.wait)
+    time.sleep(0.05)                    # ワーカーが1件目を取り出すのを待つ
+    jobs.submit(release.wait)
+    with pytest.raises(QueueFull):
+        jobs.submit(release.wait, timeout=0)
+    release.set()
+    assert jobs.stats()['rejected'] == 1
+
+
+def test_failed_job_sets_exception_and_is_recorded():
+    scheduler = Scheduler()
+    future = scheduler.queue('t').submit(lambda: 1 / 0, label='boom')
+    with pytest.raises(ZeroDivisionError):
+        future.result(timeout=5)
+    job = scheduler.snapshot()['jobs'][0]
+    assert (job['label'], job['state']) == ('boom', 'failed')
+    assert job['error'].startswith('ZeroDivisionError')
+
+
+def test_job_runs_in_submitter_context_and_snapshot_filters_by_session():
+    scheduler = Scheduler()
+    jobs = scheduler.queue('t')
+    with session_context('s1'):
+        assert jobs.submit(current_session_id).result(timeout=5) == 's1'
+    jobs.submit(lambda: None).result(timeout=5)
+    snapshot = scheduler.snapshot(session_id='s1')
+    assert [job['session_id'] for job in snapshot['jobs']] == ['s1']
+    assert snapshot['queues']['t']['completed'] == 2
+
+
+def test_drain_waits_for_jobs_and_rejects_new_ones():
+    scheduler = Scheduler()
+    jobs = scheduler.queue('t', workers=1)
+    done = []
+    jobs.submit(lambda: (time.sleep(0.1), done.append(1)))
+    assert scheduler.drain(timeout=5) == 0
+    assert done == [1]
+    with pytest.raises(QueueFull):
+        jobs.submit(lambda: None)
+
+
+def test_jobs_can_queue_follow_ups_while_draining():
+    scheduler = Scheduler()
+    jobs = scheduler.queue('t', workers=1)
+    follow_up = []
+
+    def first():
+        time.sleep(0.1)
+        follow_up.append(jobs.submit(lambda: 'next'))
+    jobs.submit(first)
+    time.sleep(0.02)
+    assert scheduler.drain(timeout=5) == 0
+    assert follow_up[0].result(timeout=1) == 'next'
+
+
+def test_drain_cancels_jobs_that_did_not_start():
+    scheduler = Scheduler()
+    jobs = scheduler.queue('t', workers=1)
+    release = threading.Event()
+    jobs.submit(release.wait)
+    pending = jobs.submit(lambda: None)
+    time.sleep(0.05)
+    assert scheduler.drain(timeout=0.2) == 2    # 1件取り消し + 1件実行中
+    assert pending.cancelled()
+    release.set()
@@ -0,0 +1,130 @@
+"""
+echo_session_store の単体テスト。メモリ・SQLite の両ストアで、version の進み方・
+expect による compare-and-set・TTL での期限切れ・ワーカーの生存確認を確かめる。
+Redis ストアは ECHO_TEST_REDIS_URL を指定したときだけ試す。
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from echo_session_store import MemorySessionStore, RedisSessionStore, SQLiteSessionStore  # noqa: E402
+
+BACKENDS = ['memory', 'sqlite'] + (['redis'] if os.environ.get("ECHO_TEST_REDIS_URL") else [])
+
+
+def make_store(kind, ttl=60):
+    if kind == 'memory':
+        return MemorySessionStore(ttl=ttl)
+    if kind == 'sqlite':
+        return SQLiteSessionStore(os.path.join(tempfile.mkdtemp(prefix="echo-test-sessions-"), "s.db"), ttl=ttl)
+    prefix = f"echo-test-{time.time_ns()}:"
+    return RedisSessionStore.from_url(os.environ["ECHO_TEST_REDIS_URL"], ttl=ttl, prefix=prefix)
+
+
+@pytest.fixture(params=BACKENDS)
+def store(request):
+    return make_store(request.param)
+
+
+def test_put_get_and_missing(store):
+    store.put('s', {'theme': '雨', 'version': 0})
+    assert store.get('s') == {'theme': '雨', 'version': 0}
+    assert store.get('none') is None
+    assert 's' in store and 'none' not in store
+    assert len(store) == 1
+
+
+def test_update_merges_and_bumps_version(store):
+    store.put('s', {'status': 'ready', 'version': 0})
+    updated = store.update('s', {'status': 'generating'})
+    assert updated == {'status': 'generating', 'version': 1}
+    assert store.version('s') == 1
+    assert store.update('none', {'status': 'x'}) is None
+
+
+def test_update_with_expect_is_compare_and_set(store):
+    store.put('s', {'status': 'continue', 'version': 0})
+    assert store.update('s', {'status': 'generating'}, expect={'status': 'continue'}) is not None
+    assert store.update('s', {'status': 'generating'}, expect={'status': 'continue'}) is None
+    assert store.get('s')['version'] == 1
+
+
+def test_concurrent_updates_are_not_lost(store):
+    store.put('s', {'version': 0})
+
+    def bump():
+        for _ in range(25):
+            store.update('s', {'x': 1})
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.version('s') == 100
+
+
+def test_delete_and_items(store):
+    store.put('a', {'version': 0})
+    store.put('b', {'version': 0})
+    store.delete('a')
+    assert [sid for sid, _ in store.items()] == ['b']
+
+
+def test_expire_removes_only_expired_sessions(store):
+    store.put('old', {'version': 0}, ttl=0.05)
+    store.put('new', {'version': 0})
+    time.sleep(0.1)
+    assert store.expire() == ['old']
+    assert store.get('new') is not None
+    assert store.expire() == []
+
+
+def test_update_extends_ttl(store):
+    store.put('s', {'version': 0}, ttl=0.3)
+    time.sleep(0.2)
+    store.update('s', {'x': 1})
+    time.sleep(0.2)
+    assert store.get('s') is not None
+
+
+def test_heartbeat_and_clearing_it(store):
+    store.heartbeat('w1', 10)
+    assert store.worker_alive('w1')
+    assert not store.worker_alive('w2')
+    store.heartbeat('w1', 0)
+    assert not store.worker_alive('w1')
+
+
+def test_memory_store_evicts_lru_and_reports_it():
+    store = MemorySessionStore(max_sessions=2)
+    store.put('a', {'version': 0})
+    store.put('b', {'version': 0})
+    store.get('a')                      # a を最近使ったことにする
+    store.put('c', {'version': 0})
+    assert store.get('b') is None
+    assert store.expire() == ['b']
+
+
+def test_memory_store_reports_sessions_expired_in_get():
+    store = MemorySessionStore()
+    store.put('s', {'version': 0}, ttl=0.05)
+    time.sleep(0.1)
+    assert store.get('s') is None
+    assert store.expire() == ['s']
+
+
+def test_sqlite_store_is_shared_between_instances():
+    path = os.path.join(tempfile.mkdtemp(prefix="echo-test-sessions-"), "s.db")
+    first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+    first.put('s', {'status': 'continue', 'version': 0})
+    assert second.update('s', {'status': 'generating'}, expect={'status': 'continue'}) is not None
+    assert first.update('s', {'status': 'generating'}, expect={'status': 'continue'}) is None
+    first.heartbeat('w', 10)
+    assert second.worker_alive('w')
@@ -0,0 +1,70 @@
+"""
+投機的生成（ECHO_SPECULATIVE=1）が既定のレート制限（ECHO_RPM=10, ECHO_RATE_BURST=3）でも
+動き、方向性なしで /continue したときに結果が採用されることを確かめる。
+フェーズ生成の直後はバケットが空なので、投機はトークンが戻るのを待ってから始まる。
+
+偽バックエンド（ECHO_BACKEND=fake）で動かすので、ネットワークは使わない。
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name in ("ECHO_RPM", "ECHO_RPM_OVERRIDES", "ECHO_RATE_BURST", "ECHO_RATE_LIMIT_DB",
+             "ECHO_SPECULATIVE_HEADROOM", "ECHO_SESSION_DB", "ECHO_SESSION_REDIS_URL"):
+    os.environ.pop(name, None)
+os.environ.update(
+    ECHO_BACKEND="fake",
+    ECHO_FAKE_TEXT_LATENCY="const:0.01",
+    ECHO_FAKE_IMAGE_LATENCY="const:0.01",
+    ECHO_IMAGE_DIR=tempfile.mkdtemp(prefix="echo-test-images-"),
+    ECHO_SPECULATIVE="1",
+)
+
+import web_echo_interactive as app_module  # noqa: E402
+from echo_ratelimit import rate_limiter  # noqa: E402
+
+TEXT_MODEL = app_module.TEXT_MODEL
+
+
+def wait_for(predicate, timeout, interval=0.05):
+    ends = time.monotonic() + timeout
+    while time.monotonic() < ends:
+        value = predicate()
+        if value:
+            return value
+        time.sleep(interval)
+    raise AssertionError(f"{timeout}秒待っても条件を満たしませんでした")
+
+
+def test_speculation_hit_with_default_rate_limit():
+    assert rate_limiter.rpm_for(TEXT_MODEL) == 10 and rate_limiter.capacity(TEXT_MODEL) == 3
+    client = app_module.app.test_client()
+    session_id = client.post('/start', json={'theme': '雨の日の喫茶店'}).json['session_id']
+    status = lambda: client.get(f'/status/{session_id}').json
+    wait_for(lambda: status()['status'] == 'ready', 60)
+
+    # /start の完了後に積まれた起フェーズの投機が、トークンの回復を待って生成し終えるまで待つ
+    # （終わっていない投機は採用されず、/continue で生成し直す）
+    def speculation():
+        with app_module.speculations_lock:
+            return app_module.speculations.get(session_id)
+    future = wait_for(speculation, 10)['future']
+    wait_for(future.done, 90)
+    assert future.result(), "投機がトークン待ちのまま諦めました"
+    assert app_module.speculation_stats['skipped_quota'] == 0
+
+    hits = app_module.speculation_stats['hits']
+    assert client.post('/continue', json={'session_id': session_id, 'direction': ''}).status_code == 200
+    result = wait_for(lambda: (lambda s: s if s['status'] in ('continue', 'error') else None)(status()), 120)
+    assert result['status'] == 'continue'
+    assert app_module.speculation_stats['hits'] == hits + 1
+    assert [m['phase'] for m in result['conversation']] == ['ki']
+
+
+def teardown_module():
+    # 残りのジョブ（要約・提案など）をここで待ち、終了時の drain が閉じた出力にログを書かないようにする
+    app_module.scheduler.drain(timeout=60)
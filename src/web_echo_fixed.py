@@ -4,7 +4,7 @@ Project Echo - Webブラウザ版（完全修正版）
 
 【修正内容】
 1. レート制限エラーへの対応強化
-   - 待機時間: 60秒 → 120秒 → 180秒 → 240秒 → 300秒
+   - 待機時間: 指数バックオフ + ジッター（サーバーの再試行ヒントを優先、echo_retry）
    - リトライ回数: 5回
    - ターン間待機: 6秒
 
@@ -16,12 +16,14 @@ Project Echo - Webブラウザ版（完全修正版）
 
 import os
 from flask import Flask, render_template, request, jsonify, Response
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel
 import json
 import time
 import threading
 
+import echo_retry
+from echo_backend import backend_from_env
+from echo_retry import DEFAULT_POLICY
+
 # ========================================
 # 設定
 # ========================================
@@ -29,7 +31,7 @@ PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT") or "YOUR_PROJECT_ID"
 LOCATION = "us-central1"
 
 app = Flask(__name__)
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+backend = backend_from_env(project=PROJECT_ID, location=LOCATION)
 
 progress_data = {
     "status": "waiting",
@@ -41,25 +43,16 @@ progress_data = {
 # ========================================
 # ユーティリティ
 # ========================================
-def call_with_retry(model, prompt, max_retries=5, initial_wait=60):
+def call_with_retry(model, prompt):
     """
-    レート制限に強いAPI呼び出し
-    60秒 → 120秒 → 180秒 → 240秒 → 300秒
+    レート制限に強いAPI呼び出し（echo_retry の共通エンジンを使用）
+    429 の待機中はその旨を進捗に表示する
     """
-    for attempt in range(max_retries):
-        try:
-            response = model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as e:
-            if "429" in str(e) or "Resource exhausted" in str(e):
-                wait_time = initial_wait * (attempt + 1)
-                update_progress("generating", f"レート制限。{wait_time}秒待機... ({attempt+1}/{max_retries})")
-                time.sleep(wait_time)
-            else:
-                if attempt == max_retries - 1:
-                    raise
-                time.sleep(10)
-    raise Exception("API呼び出し失敗")
+    def on_retry(attempt, cause, wait, error):
+        if cause == 'rate_limit':
+            update_progress("generating", f"レート制限。{wait:.0f}秒待機... ({attempt}/{DEFAULT_POLICY.max_attempts})")
+
+    return echo_retry.call_with_retry(model, prompt, on_retry=on_retry)
 
 def extract_json(text):
     if "```json" in text:
@@ -86,7 +79,7 @@ def generate_story(theme):
         # ========== Step 1: キャラクター生成 ==========
         update_progress("generating", "キャラクター生成中...", "1/4")
         
-        generator = GenerativeModel("gemini-2.0-flash-exp")
+        generator = backend.text_model("gemini-2.0-flash-exp")
         
         text = call_with_retry(generator, f"""
 {theme}で2人のキャラクターを生成。
@@ -134,7 +127,7 @@ JSON形式:
 """
             agents.append({
                 "name": char['name'],
-                "model": GenerativeModel("gemini-2.0-flash-exp"),
+                "model": backend.text_model("gemini-2.0-flash-exp"),
                 "instruction": instruction
             })
             time.sleep(3)
@@ -5,16 +5,23 @@ Project Echo - インタラクティブ版 (安全策・順次実行版)
 ユーザーが各フェーズ（起承転結）で方向性を指示できる
 """
 
-from flask import Flask, render_template, request, jsonify
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel
-from vertexai.preview.vision_models import ImageGenerationModel
+from flask import Flask, render_template, request, jsonify, send_file, Response
 import json
 import time
 import threading
 import os
 import base64
 
+from echo_backend import backend_from_env
+from echo_json import check_schema, parse_json
+from echo_image_jobs import image_jobs, ImageQueueFull
+from echo_image_store import ImageStore
+from echo_logging import get_logger
+from echo_metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from echo_priority import priority
+from echo_retry import call_with_retry, retry_call, RetryPolicy
+from echo_scheduler import scheduler, QueueFull
+
 # ========================================
 # 設定
 # ========================================
@@ -22,11 +29,25 @@ PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT") or "YOUR_PROJECT_ID"
 LOCATION = "us-central1"
 
 app = Flask(__name__)
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+log = get_logger(__name__)
+backend = backend_from_env(project=PROJECT_ID, location=LOCATION)
+
+# フェーズ生成（/start の初期化・/continue）はスケジューラの 'phase' キューで動かす
+phase_jobs = scheduler.queue('phase', workers=int(os.environ.get("ECHO_PHASE_WORKERS", "16")))
+scheduler.install_shutdown_handlers()
+
+# Imagen モデル（レート制限のキーにも使用）
+IMAGEN_MODEL = "imagen-3.0-generate-002"
 
-# 画像保存ディレクトリ
+# Imagen は1回の生成に時間がかかるため、タイムアウトを長めに・試行回数は少なめに
+IMAGEN_RETRY_POLICY = RetryPolicy(max_attempts=3, call_timeout=120, base_delay=5.0)
+
+# 画像ストア（内容のハッシュで保存し /images/<hash>.<ext> で配信する）
 IMAGE_DIR = os.path.join(os.path.dirname(__file__), 'static', 'images')
-os.makedirs(IMAGE_DIR, exist_ok=True)
+image_store = ImageStore.from_env(IMAGE_DIR)
+IMAGE_MAX_AGE = 365 * 24 * 3600
+image_store.collect()
+image_store.start_collector(interval=float(os.environ.get("ECHO_IMAGE_GC_INTERVAL", "60")))
 
 # セッションデータ
 sessions = {}
@@ -34,43 +55,6 @@ sessions = {}
 # ========================================
 # ユーティリティ
 # ========================================
-def call_with_retry(model, prompt, max_retries=5, initial_wait=60):
-    """レート制限対策付きAPI呼び出し（タイムアウト付き）"""
-    import concurrent.futures
-    
-    for attempt in range(max_retries):
-        try:
-            print(f"[DEBUG] API呼び出し開始 (試行 {attempt+1}/{max_retries})")
-            
-            # 60秒タイムアウト付きで実行
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(model.generate_content, prompt)
-                try:
-                    response = future.result(timeout=60)
-                    print(f"[DEBUG] API呼び出し成功")
-                    return response.text.strip()
-                except concurrent.futures.TimeoutError:
-                    print(f"[ERROR] タイムアウト（60秒）- 試行 {attempt+1}/{max_retries}")
-                    if attempt == max_retries - 1:
-                        raise Exception("APIタイムアウト：60秒以内に応答がありませんでした")
-                    time.sleep(10)
-                    continue
-
-        except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "Resource exhausted" in error_msg:
-                wait_time = initial_wait * (attempt + 1)
-                print(f"[WARN] レート制限検知。{wait_time}秒待機... (試行 {attempt+1}/{max_retries})")
-                time.sleep(wait_time)
-            elif "タイムアウト" in error_msg:
-                raise
-            else:
-                if attempt == max_retries - 1:
-                    raise
-                print(f"[WARN] エラー: {error_msg} - 10秒後に再試行")
-                time.sleep(10)
-    raise Exception("API呼び出し失敗")
-
 def extract_json(text):
     if "```json" in text:
         text = text.split("```json")[1].split("```")[0].strip()
@@ -81,51 +65,88 @@ def extract_json(text):
 # ========================================
 # 4コマ漫画生成
 # ========================================
-def generate_comic(session_id):
-    """
-    起承転結の各フェーズから1枚ずつ、計4枚の画像を生成する
-    結フェーズ完了後に呼び出される
-    """
-    session = sessions.get(session_id)
-    if not session:
-        return
+COMIC_PHASES = [
+    ('ki',    '起'),
+    ('sho',   '承'),
+    ('ten',   '転'),
+    ('ketsu', '結'),
+]
 
-    print(f"[INFO] 4コマ漫画生成開始: {session_id}")
-    session['comic_status'] = 'generating'
-    session['comic_images'] = []
+# パネルの状態更新（複数ワーカーから同じセッションを書き換えるため）
+comic_lock = threading.Lock()
+
+def set_panel(session, index, **fields):
+    with comic_lock:
+        panels = list(session['comic_images'])
+        panels[index] = {**panels[index], **fields}
+        session['comic_images'] = panels
+
+def finish_comic_if_done(session, session_id):
+    """全パネルが done / failed になっていれば comic_status を complete にする"""
+    with comic_lock:
+        finished = (session.get('comic_status') != 'complete'
+                    and all(p['status'] in ('done', 'failed') for p in session['comic_images']))
+        if finished:
+            session['comic_status'] = 'complete'
+    if finished:
+        log.info("4コマ漫画生成完了: %s", session_id)
+
+def comic_prompts_schema(panel_count):
+    """一括プロンプト生成の出力スキーマ（prompts は場面と同じ順・同じ数）"""
+    return {
+        "type": "object",
+        "properties": {
+            "character_appearance": {"type": "string"},
+            "prompts": {
+                "type": "array",
+                "items": {"type": "string"},
+                "min_items": panel_count,
+                "max_items": panel_count,
+            },
+        },
+        "required": ["character_appearance", "prompts"],
+    }
 
-    generator = GenerativeModel("gemini-2.0-flash-001")
-    imagen = ImageGenerationModel.from_pretrained("imagen-3.0-generate-002")
+def build_comic_prompts(generator, narratives, characters):
+    """
+    全パネルの英語プロンプトを1回の Gemini 呼び出しで生成する。
+    narratives: [(phase_key, narrative), ...]
+    返り値: (キャラクターの外見の共通記述, {phase_key: プロンプト})
+    """
+    char_desc = "、".join([f"{c['name']}({c['public_persona']})" for c in characters])
+    scenes = "\n\n".join([f"{i + 1}コマ目:\n{narrative}" for i, (_, narrative) in enumerate(narratives)])
+    schema = comic_prompts_schema(len(narratives))
 
-    phases = [
-        ('ki',    '起'),
-        ('sho',   '承'),
-        ('ten',   '転'),
-        ('ketsu', '結'),
-    ]
+    text = call_with_retry(generator, f"""
+以下の日本語の場面描写（4コマ漫画の各コマ）を、Imagen画像生成用の英語プロンプトに変換してください。
 
-    comic_images = []
+登場人物: {char_desc}
 
-    for phase_key, phase_label in phases:
-        # そのフェーズの会話を取得
-        phase_msgs = [m for m in session.get('conversation', []) if m.get('phase') == phase_key]
-        if not phase_msgs:
-            print(f"[WARN] {phase_label}フェーズの会話が見つかりません")
-            comic_images.append({
-                "phase": phase_label,
-                "image_url": None,
-                "error": "会話なし"
-            })
-            continue
+場面:
+{scenes}
 
-        narrative = phase_msgs[0]['narrative']
-        characters = session.get('characters', [])
-        char_desc = "、".join([f"{c['name']}({c['public_persona']})" for c in characters])
+条件:
+- character_appearance: 2人のキャラクターの外見（髪型・髪色・服装など）を英語で30語以内。全コマで共通に使う
+- prompts: 各コマの英語プロンプト（30語以内）を場面と同じ順に{len(narratives)}個
+- アニメ風カラーイラストのスタイル
+- 2人のキャラクターが登場する
+- 感情や雰囲気を視覚的に表現する
+- 外見の説明は character_appearance にまとめ、prompt には場面・動作・表情だけを書く
+""", kind='image_prompt', generation_config={"response_mime_type": "application/json", "response_schema": schema})
+
+    data = parse_json(text)
+    check_schema(data, schema)
+    prompts = [p.strip() for p in data['prompts']]
+    if not all(prompts):
+        raise ValueError("空のプロンプトがあります")
+    return data['character_appearance'].strip(), {
+        phase_key: prompt for (phase_key, _), prompt in zip(narratives, prompts)
+    }
 
-        # Step1: Geminiで英語プロンプト生成
-        print(f"[INFO] {phase_label}フェーズのプロンプト生成中...")
-        try:
-            prompt_text = call_with_retry(generator, f"""
+def build_panel_prompt(generator, narrative, characters):
+    """1パネル分の英語プロンプト（一括生成に失敗したときのフォールバック）"""
+    char_desc = "、".join([f"{c['name']}({c['public_persona']})" for c in characters])
+    return call_with_retry(generator, f"""
 以下の日本語の場面描写を、Imagen画像生成用の英語プロンプトに変換してください。
 
 場面:
@@ -139,48 +160,142 @@ def generate_comic(session_id):
 - 感情や雰囲気を視覚的に表現する
 - 30語以内の英語で出力
 - プロンプト文のみ出力（説明不要）
-""")
-            time.sleep(8)  # Gemini レート制限対策
-        except Exception as e:
-            print(f"[ERROR] {phase_label}プロンプト生成失敗: {e}")
-            comic_images.append({"phase": phase_label, "image_url": None, "error": str(e)})
-            continue
+""", kind='image_prompt')
 
-        # Step2: Imagenで画像生成
-        print(f"[INFO] {phase_label}フェーズの画像生成中... プロンプト: {prompt_text[:60]}...")
-        try:
-            full_prompt = f"anime style, colorful illustration, {prompt_text}, 2 characters, detailed background, manga panel"
-
-            images = imagen.generate_images(
-                prompt=full_prompt,
-                number_of_images=1,
-                aspect_ratio="1:1",
-                safety_filter_level="block_some",
-                person_generation="allow_adult",
-            )
-
-            # 画像をファイルに保存
-            filename = f"{session_id}_{phase_key}.png"
-            filepath = os.path.join(IMAGE_DIR, filename)
-            images[0].save(location=filepath, include_generation_parameters=False)
-
-            image_url = f"/static/images/{filename}"
-            comic_images.append({
-                "phase": phase_label,
-                "image_url": image_url,
-                "prompt": prompt_text
-            })
-            print(f"[OK] {phase_label}フェーズの画像生成完了: {image_url}")
-            # Imagenはレート制限なし → sleepなし
+@priority.in_lane('comic')
+def generate_comic(session_id):
+    """
+    起承転結の各フェーズから1枚ずつ、計4枚の画像を生成する
+    結フェーズ完了後に呼び出され、画像ジョブキューにジョブを積んで戻る。
+    /comic/<session_id> では完成したパネルから順に表示できる。
+    """
+    session = sessions.get(session_id)
+    if not session:
+        return
+
+    log.info("4コマ漫画生成開始: %s", session_id)
+    session['comic_status'] = 'generating'
+    session['comic_images'] = [
+        {"phase": phase_label, "status": "pending", "image_url": None}
+        for _, phase_label in COMIC_PHASES
+    ]
+    submitted = set()   # 画像ジョブを積んだパネル（そのジョブが結果を書く）
+
+    def fail_rest(error):
+        """まだジョブに渡していないパネルだけを失敗にする（生成済みの画像は残す）"""
+        with comic_lock:
+            session['comic_images'] = [
+                panel if panel['status'] in ('done', 'failed') or index in submitted
+                else {**panel, "status": "failed", "error": str(error)}
+                for index, panel in enumerate(session['comic_images'])
+            ]
+        finish_comic_if_done(session, session_id)
+
+    try:
+        future = image_jobs.submit(render_comic, session, session_id, submitted, label=f"{session_id}_prompts")
+    except ImageQueueFull as e:
+        log.warning("4コマ漫画のジョブを登録できません: %s", e)
+        fail_rest(e)
+        return
+
+    def render_done(future):
+        if future.cancelled():
+            fail_rest("取り消されました")
+        elif future.exception() is not None:
+            fail_rest(future.exception())
+    future.add_done_callback(render_done)
 
+def render_comic(session, session_id, submitted):
+    """
+    全パネルのプロンプトを一括生成し、パネルごとの画像ジョブを積む。
+    ジョブを積んだパネルの番号を submitted に加える
+    """
+    generator = backend.text_model("gemini-2.0-flash-001")
+    imagen = backend.image_model(IMAGEN_MODEL)
+    characters = session.get('characters', [])
+
+    narratives = []
+    for index, (phase_key, phase_label) in enumerate(COMIC_PHASES):
+        # そのフェーズの会話を取得
+        phase_msgs = [m for m in session.get('conversation', []) if m.get('phase') == phase_key]
+        if phase_msgs:
+            narratives.append((phase_key, phase_msgs[0]['narrative']))
+        else:
+            log.warning("%sフェーズの会話が見つかりません", phase_label)
+            set_panel(session, index, status='failed', error="会話なし")
+
+    # Step1: Geminiで全パネルの英語プロンプトを一括生成（外見の記述を共有して絵柄を揃える）
+    log.info("全パネルのプロンプトを一括生成中...")
+    appearance, prompts = "", {}
+    if narratives:
+        try:
+            appearance, prompts = build_comic_prompts(generator, narratives, characters)
         except Exception as e:
-            print(f"[ERROR] {phase_label}画像生成失敗: {e}")
-            comic_images.append({"phase": phase_label, "image_url": None, "error": str(e)})
+            log.warning("プロンプトの一括生成に失敗。パネルごとに生成します: %s", e)
+
+    def panel_done(future, index):
+        # generate_panel は失敗もパネルに書くが、ジョブ自体が落ちた・取り消された場合はここで書く
+        if future.cancelled() or future.exception() is not None:
+            set_panel(session, index, status='failed',
+                      error="取り消されました" if future.cancelled() else str(future.exception()))
+        finish_comic_if_done(session, session_id)
+
+    narrative_of = dict(narratives)
+    for index, (phase_key, phase_label) in enumerate(COMIC_PHASES):
+        if phase_key not in narrative_of:
             continue
+        try:
+            future = image_jobs.submit(
+                generate_panel, session, session_id, index, phase_key, phase_label,
+                generator, imagen, narrative_of[phase_key], prompts.get(phase_key), appearance,
+                label=f"{session_id}_{phase_key}")
+        except ImageQueueFull as e:
+            log.warning("%sパネルのジョブを登録できません: %s", phase_label, e)
+            set_panel(session, index, status='failed', error=str(e))
+            continue
+        submitted.add(index)
+        future.add_done_callback(lambda f, index=index: panel_done(f, index))
+    finish_comic_if_done(session, session_id)
+
+def generate_panel(session, session_id, index, phase_key, phase_label,
+                   generator, imagen, narrative, prompt_text=None, appearance=""):
+    """1パネル分の画像生成。画像ジョブキューのワーカーで実行される"""
+    set_panel(session, index, status='generating')
 
-    session['comic_images'] = comic_images
-    session['comic_status'] = 'complete'
-    print(f"[INFO] 4コマ漫画生成完了: {session_id}")
+    if not prompt_text:
+        log.info("%sフェーズのプロンプト生成中...", phase_label)
+        try:
+            prompt_text = build_panel_prompt(generator, narrative, session.get('characters', []))
+        except Exception as e:
+            log.error("%sプロンプト生成失敗: %s", phase_label, e)
+            set_panel(session, index, status='failed', error=str(e))
+            return
+
+    # Step2: Imagenで画像生成（Imagen のクォータは共有レートリミッタで守る）
+    log.info("%sフェーズの画像生成中... プロンプト: %s...", phase_label, prompt_text[:60])
+    try:
+        appearance_text = f"{appearance}, " if appearance else ""
+        full_prompt = (f"anime style, colorful illustration, {appearance_text}{prompt_text}, "
+                       f"2 characters, detailed background, manga panel")
+
+        image_options = dict(aspect_ratio="1:1", safety_filter_level="block_some",
+                             person_generation="allow_adult")
+
+        # 同じプロンプトで生成済みの画像があれば Imagen を呼ばずに再利用する
+        prompt_key = image_store.prompt_key(IMAGEN_MODEL, full_prompt, **image_options)
+        image = image_store.lookup(prompt_key, session_id=session_id)
+        if not image:
+            image_bytes = retry_call(lambda: imagen.generate_image(full_prompt, **image_options),
+                                     IMAGEN_MODEL, policy=IMAGEN_RETRY_POLICY, label="画像生成", kind='imagen')
+            image = image_store.save(image_bytes, prompt_key=prompt_key, session_id=session_id)
+
+        set_panel(session, index, status='done', image_url=image['image_url'],
+                  png_url=image['png_url'], thumb_url=image['thumb_url'], prompt=prompt_text)
+        log.info("%sフェーズの画像生成完了: %s", phase_label, image['image_url'])
+
+    except Exception as e:
+        log.error("%s画像生成失敗: %s", phase_label, e)
+        set_panel(session, index, status='failed', error=str(e))
 
 # ========================================
 # フェーズ別生成
@@ -191,11 +306,11 @@ def generate_phase(session_id, phase, user_direction=""):
         return {"error": "セッションが見つかりません"}
     
     # モデル設定 
-    generator = GenerativeModel("gemini-2.0-flash-001")
+    generator = backend.text_model("gemini-2.0-flash-001")
     
     # ========== start: 初期設定 ==========
     if phase == 'start':
-        print(f"[DEBUG] セッション {session_id}: キャラクター生成開始")
+        log.debug("セッション %s: キャラクター生成開始", session_id)
         session['progress'] = 'キャラクター生成中...'
         
         # 1. キャラクター生成
@@ -206,10 +321,10 @@ JSON形式:
 [
   {{"name": "3文字", "age": 17, "public_persona": "表(1文)", "secret_goal": "裏(1文)", "speech_style": "話し方"}}
 ]
-""")
-        time.sleep(8)  # ★安全のための待機 (10 RPM対策)
+""", kind='characters')
+        metrics.sleep(8, 'pacing')  # ★安全のための待機 (10 RPM対策)
 
-        print(f"[DEBUG] セッション {session_id}: キャラクター生成完了")
+        log.debug("セッション %s: キャラクター生成完了", session_id)
         characters = json.loads(extract_json(text))
         session['characters'] = characters
         session['progress'] = '初期状況を生成中...'
@@ -220,9 +335,9 @@ JSON形式:
 {session['theme']}で以下のキャラクターが出会う初期状況を1文で。
 
 {char_info}
-""")
+""", kind='situation')
         session['initial_situation'] = initial_situation
-        time.sleep(8)  # ★安全のための待機
+        metrics.sleep(8, 'pacing')  # ★安全のための待機
         
         # 3. 語り手モデル作成 (APIコールなし)
         # 一人称視点ではなく、両キャラクターが登場する第三者視点に変更
@@ -254,7 +369,7 @@ JSON形式:
 """
         
         session['narrator'] = {
-            "model": GenerativeModel("gemini-2.0-flash-001"),
+            "model": backend.text_model("gemini-2.0-flash-001"),
             "instruction": narrator_instruction,
             "char_names": char_names,
             "char_profiles": char_profiles
@@ -264,7 +379,7 @@ JSON形式:
         for char in characters:
             agents.append({
                 "name": char['name'],
-                "model": GenerativeModel("gemini-2.0-flash-001"),
+                "model": backend.text_model("gemini-2.0-flash-001"),
                 "instruction": ""
             })
         session['agents'] = agents
@@ -298,7 +413,7 @@ JSON形式:
     
     for turn in range(config['turns']):
         progress_msg = f"{config['label']} ({turn+1}/{config['turns']}ターン目)"
-        print(f"[INFO] {progress_msg}")
+        log.info("%s", progress_msg)
         
         # プロンプト作成（第三者視点）
         phase_titles = {
@@ -338,7 +453,7 @@ JSON形式:
         try:
             # 語り手モデルで第三者視点の場面生成
             full_prompt = f"{narrator['instruction']}\n\n{prompt}"
-            text = call_with_retry(narrator['model'], full_prompt)
+            text = call_with_retry(narrator['model'], full_prompt, kind='narrator')
             data = json.loads(extract_json(text))
             
             msg = {
@@ -348,13 +463,13 @@ JSON形式:
                 "phase": phase
             }
             
-            time.sleep(8)  # ★安全のための待機 (ここが重要)
+            metrics.sleep(8, 'pacing')  # ★安全のための待機 (ここが重要)
             
             # 2. 全キャラクターの内心を順次生成（並列処理から変更）
             all_inner_thoughts = []
             
             for agent in agents:
-                print(f"[DEBUG] {agent['name']}の内心を生成中...")
+                log.debug("%sの内心を生成中...", agent['name'])
                 inner_prompt = f"""
 以下の場面における{agent['name']}の内心を1文で表現してください。
 
@@ -368,17 +483,17 @@ JSON形式で出力:
 {{"inner_thought": "内心の考え（1文）"}}
 """
                 try:
-                    inner_text = call_with_retry(agent['model'], inner_prompt)
+                    inner_text = call_with_retry(agent['model'], inner_prompt, kind='inner_thought')
                     inner_data = json.loads(extract_json(inner_text))
                     all_inner_thoughts.append({
                         "character": agent['name'],
                         "thought": inner_data.get('inner_thought', '')
                     })
                     
-                    time.sleep(8)  # ★各APIコールの後に必ず待機
+                    metrics.sleep(8, 'pacing')  # ★各APIコールの後に必ず待機
                     
                 except Exception as e:
-                    print(f"内心生成エラー ({agent['name']}): {e}")
+                    log.warning("内心生成エラー (%s): %s", agent['name'], e)
                     all_inner_thoughts.append({
                         "character": agent['name'],
                         "thought": "..."
@@ -389,8 +504,8 @@ JSON形式で出力:
             phase_conversations.append(msg)
             
         except Exception as e:
-            print(f"エラー: {e}")
-            time.sleep(10)
+            log.warning("エラー: %s", e)
+            metrics.sleep(10, 'error')
             continue
     
     session['conversation'] = conversation
@@ -405,7 +520,7 @@ JSON形式で出力:
 
 会話:
 {all_text}
-""")
+""", kind='summary')
         session['summary'] = summary
         
         story = {
@@ -415,16 +530,8 @@ JSON形式で出力:
             'ketsu': [m for m in conversation if m.get('phase') == 'ketsu']
         }
 
-        # ★ 4コマ漫画生成を非同期で開始（物語表示をブロックしない）
-        session['comic_status'] = 'generating'
-        session['comic_images'] = []
-        comic_thread = threading.Thread(
-            target=generate_comic,
-            args=(session_id,),
-            daemon=True
-        )
-        comic_thread.start()
-        print(f"[INFO] 4コマ漫画生成スレッド起動")
+        # ★ 4コマ漫画のパネルを画像ジョブキューに積む（物語表示をブロックしない）
+        generate_comic(session_id)
         
         return {
             "status": "complete",
@@ -462,18 +569,22 @@ def start():
     
     def init_session():
         try:
-            print(f"[DEBUG] セッション {session_id} 開始")
+            log.debug("セッション %s 開始", session_id)
             result = generate_phase(session_id, 'start')
             sessions[session_id].update(result)
             sessions[session_id]['current_phase'] = 'ki'
             sessions[session_id]['status'] = 'ready'
         except Exception as e:
-            print(f"[ERROR] 初期化失敗: {e}")
+            log.error("初期化失敗: %s", e)
             sessions[session_id]['status'] = 'error'
             sessions[session_id]['error'] = str(e)
     
-    thread = threading.Thread(target=init_session, daemon=True)
-    thread.start()
+    try:
+        phase_jobs.submit(init_session, label=f"{session_id}_start", timeout=0)
+    except QueueFull as e:
+        log.warning("初期化ジョブを登録できません: %s", e)
+        sessions.pop(session_id, None)
+        return jsonify({"error": "混み合っています"}), 503
     return jsonify({"session_id": session_id, "status": "initializing"})
 
 @app.route('/status/<session_id>')
@@ -502,6 +613,7 @@ def continue_story():
         return jsonify({"error": "セッションなし"}), 404
     
     current_phase = session.get('current_phase')
+    previous = {'status': session.get('status'), 'progress': session.get('progress', '')}
     session['status'] = 'generating'
     session['progress'] = f'{current_phase}フェーズを生成中...'
     
@@ -517,12 +629,16 @@ def continue_story():
             else:
                 session['status'] = 'continue'
         except Exception as e:
-            print(f"[ERROR] 生成失敗: {e}")
+            log.error("生成失敗: %s", e)
             session['status'] = 'error'
             session['error'] = str(e)
             
-    thread = threading.Thread(target=generate, daemon=True)
-    thread.start()
+    try:
+        phase_jobs.submit(generate, label=f"{session_id}_{current_phase}", timeout=0)
+    except QueueFull as e:
+        log.warning("フェーズ生成ジョブを登録できません: %s", e)
+        session.update(previous)
+        return jsonify({"error": "混み合っています"}), 503
     return jsonify({"status": "generating"})
 
 @app.route('/result/<session_id>')
@@ -548,5 +664,34 @@ def comic(session_id):
         "comic_images": session.get('comic_images', [])
     })
 
+@app.route('/images/<name>')
+def image_file(name):
+    """生成画像の配信（内容のハッシュがファイル名なので immutable キャッシュ + ETag）"""
+    resolved = image_store.resolve(name)
+    if not resolved:
+        return jsonify({"error": "画像が見つかりません"}), 404
+    path, mimetype, etag = resolved
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=IMAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    return response
+
+# ========================================
+# メトリクス（Prometheus テキスト形式）
+# ========================================
+metrics.gauge("echo_active_sessions", "保持しているセッション数", lambda: len(sessions))
+metrics.gauge("echo_threads", "プロセス内のスレッド数", threading.active_count)
+metrics.gauge("echo_image_dir_bytes", "画像ディレクトリの合計バイト数", image_store.total_bytes)
+metrics.gauge("echo_jobs", "スケジューラのキューごとの待機中・実行中ジョブ数", lambda: {
+    (name, state): count for name, stats in scheduler.stats().items()
+    for state, count in stats.items() if state in ('queued', 'running')}, ("queue", "state"))
+metrics.gauge("echo_lane_calls", "優先度レーンごとの実行中・順番待ちのモデル呼び出し数", lambda: {
+    (lane, state): stats[state] for lane, stats in priority.stats().items()
+    for state in ('running', 'waiting')}, ("lane", "state"))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """モデル呼び出し・再試行・待機・キューの計測値"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -5,15 +5,32 @@ Project Echo - AI自律対話型ドラマ生成システム
 ユーザーが各フェーズ（起承転結）で方向性を指示できる
 """
 
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel
-from vertexai.preview.vision_models import ImageGenerationModel
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, Response, stream_with_context, g
 import json
 import time
 import threading
+import atexit
 import base64
+import concurrent.futures
+import functools
 import os
+import queue
+import socket
+import uuid
+
+from echo_backend import backend_from_env
+from echo_cache import cached_call_with_retry, response_cache, InvalidResponse
+from echo_image_jobs import image_jobs
+from echo_image_store import ImageStore
+from echo_json import JsonFieldStreamer, check_schema, parse_json
+from echo_logging import get_logger, session_context, session_id_var
+from echo_metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from echo_priority import priority
+from echo_ratelimit import rate_limiter
+from echo_retry import call_with_retry, retry_call, stream_with_timeout, model_name_of, Deadline, RetryPolicy
+from echo_scheduler import scheduler, QueueFull
+from echo_session_store import session_store_from_env
+from echo_trace import tracer
 
 # ========================================
 # 設定
@@ -24,6 +41,25 @@ LOCATION = "us-central1"
 
 app = Flask(__name__)
 
+log = get_logger(__name__)
+# ポーリング（/status）由来のログ。同じメッセージは ECHO_LOG_POLL_INTERVAL 秒に1回だけ出る
+poll_log = get_logger('poll')
+
+# リクエスト中のログにセッション ID を付ける（URL の session_id か JSON 本文の session_id）
+@app.before_request
+def bind_session_id():
+    session_id = (request.view_args or {}).get('session_id')
+    if session_id is None and request.is_json:
+        session_id = (request.get_json(silent=True) or {}).get('session_id')
+    if session_id:
+        g.log_session_token = session_id_var.set(str(session_id))
+
+@app.teardown_request
+def unbind_session_id(exc=None):
+    token = g.pop('log_session_token', None)
+    if token is not None:
+        session_id_var.reset(token)
+
 # CORS対応（開発環境用）
 @app.after_request
 def after_request(response):
@@ -32,84 +68,337 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     return response
 
-try:
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-    print(f"[INFO] Vertex AI 初期化完了: project={PROJECT_ID}, location={LOCATION}")
-except Exception as e:
-    print(f"[WARN] Vertex AI 初期化エラー: {e}")
-    print("[WARN] Google Cloud認証が必要かもしれません: gcloud auth application-default login")
+# テキスト・画像生成のバックエンド（ECHO_BACKEND=fake でネットワーク不要の負荷試験用）
+backend = backend_from_env(project=PROJECT_ID, location=LOCATION)
 
-# 画像保存ディレクトリ
+# 画像ストア（内容のハッシュで保存し /images/<hash>.<ext> で配信する）
 IMAGE_DIR = os.path.join(os.path.dirname(__file__), 'static', 'images')
-os.makedirs(IMAGE_DIR, exist_ok=True)
+image_store = ImageStore.from_env(IMAGE_DIR)
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# バックグラウンド処理はすべてスケジューラ（echo_scheduler）の名前付きキューで動かす
+# フェーズ生成（/start の初期化・/continue）の同時実行数。埋まっていれば後続はキューで待つ
+PHASE_WORKERS = int(os.environ.get("ECHO_PHASE_WORKERS", "16"))
+PHASE_QUEUE_SIZE = int(os.environ.get("ECHO_PHASE_QUEUE_SIZE", "100"))
+phase_jobs = scheduler.queue('phase', workers=PHASE_WORKERS, max_queued=PHASE_QUEUE_SIZE)
+
+# 内心生成の同時実行数（全セッションで共有する上限）
+INNER_THOUGHT_WORKERS = int(os.environ.get("ECHO_INNER_THOUGHT_WORKERS", "4"))
+inner_thought_jobs = scheduler.queue('inner_thought', workers=INNER_THOUGHT_WORKERS)
+
+# 方向性提案の先読み（低優先度：同時実行数を小さく抑え、フェーズ生成の後ろで動かす）
+SUGGESTION_WORKERS = int(os.environ.get("ECHO_SUGGESTION_WORKERS", "2"))
+SUGGESTION_WAIT = float(os.environ.get("ECHO_SUGGESTION_WAIT", "10"))
+suggestion_jobs = scheduler.queue('suggestions', workers=SUGGESTION_WORKERS)
+suggestion_inflight = {}    # (session_id, phase) -> Future（同じキーの生成は1つだけ）
+suggestion_inflight_lock = threading.Lock()
+
+# /debug/*（セッションのトレース・ジョブ一覧）を有効にする（"1" で有効）。
+# 認証なしでセッション ID や処理の中身が見えるため、既定では 404 を返す
+DEBUG_ROUTES = os.environ.get("ECHO_DEBUG_ROUTES", "0") == "1"
+
+# Imagen モデル（レート制限のキーにも使用）
+IMAGEN_MODEL = "imagen-3.0-generate-001"
+
+# Imagen は1回の生成に時間がかかるため、タイムアウトを長めに・試行回数は少なめに
+IMAGEN_RETRY_POLICY = RetryPolicy(max_attempts=3, call_timeout=120, base_delay=5.0)
+
+# 1フェーズ（語り手 + 内心）にかけてよい最大時間（秒）。再試行の待機もここに含まれる
+PHASE_DEADLINE = float(os.environ.get("ECHO_PHASE_DEADLINE", "300"))
+
+# start フェーズでキャラクター・初期状況・題名を1回の呼び出しで生成する（"0" で従来の3ステップ）
+FUSED_SETUP = os.environ.get("ECHO_FUSED_SETUP", "1") == "1"
+
+# 次フェーズの投機的生成（"1" で有効）。フェーズ完了後、方向性なしで次のフェーズを先に生成しておき、
+# ユーザーが方向性を入力せずに進んだらその結果を即座に採用する
+SPECULATIVE = os.environ.get("ECHO_SPECULATIVE", "0") == "1"
+SPECULATIVE_WORKERS = int(os.environ.get("ECHO_SPECULATIVE_WORKERS", "2"))
+# 投機ジョブは、レートリミッタの残りトークンがこれ以上になるまで待ってから生成を始める
+# （本番の呼び出しを待たせない）。バケット容量（ECHO_RATE_BURST と RPM の小さい方）を超える値は容量に切り詰める
+SPECULATIVE_HEADROOM = float(os.environ.get("ECHO_SPECULATIVE_HEADROOM", "2"))
+# 残りトークンが増えるのを待つ最大秒数（過ぎたら投機をやめる）と、見直す間隔
+SPECULATIVE_MAX_WAIT = float(os.environ.get("ECHO_SPECULATIVE_MAX_WAIT", "120"))
+SPECULATIVE_POLL_INTERVAL = 0.5
+
+# 物語メモリ（要約 + 重要事実）の更新をバックグラウンドで行うスレッド数
+MEMORY_WORKERS = int(os.environ.get("ECHO_MEMORY_WORKERS", "2"))
+# 物語メモリに残す重要事実の最大数
+MEMORY_MAX_FACTS = 8
+
+# テキスト生成モデル
+TEXT_MODEL = "gemini-2.0-flash-001"
+
+# セッションデータ（JSON にできる値のみ保持。ECHO_SESSION_DB で SQLite、ECHO_SESSION_REDIS_URL で
+# Redis に置くと、複数のワーカー・インスタンスで共有できる）
+session_store = session_store_from_env()
+
+# このプロセスの ID。生成中のセッションには持ち主として記録する（gunicorn の --preload は使わないこと）
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# この秒数ハートビートが途絶えたワーカーは落ちたとみなし、生成途中のセッションを引き取る
+WORKER_TIMEOUT = float(os.environ.get("ECHO_WORKER_TIMEOUT", "60"))
+# 共有ストアで他のワーカーの更新を待つときのポーリング間隔（秒）
+SESSION_POLL_INTERVAL = float(os.environ.get("ECHO_SESSION_POLL_INTERVAL", "0.5"))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("ECHO_SESSION_SWEEP_INTERVAL", "60"))
 
-# セッションデータ
-sessions = {}
+# ========================================
+# セッション更新通知
+# ========================================
+# セッションは変更のたびに version を1つ進め、待機中のクライアント（SSE / ロングポーリング）を起こす
+# 同じプロセス内の更新は Condition で即座に、共有ストアでの他のワーカーの更新はポーリングで検知する
+session_conditions = {}
+session_conditions_lock = threading.Lock()
+
+def session_condition(session_id):
+    with session_conditions_lock:
+        cond = session_conditions.get(session_id)
+        if cond is None:
+            cond = session_conditions[session_id] = threading.Condition()
+        return cond
+
+def update_session(session_id, expect=None, **fields):
+    """
+    セッションを更新して version を進め、変更待ちのクライアントに通知する。
+    expect を渡すと、そのフィールドが一致するときだけ更新する（一致しなければ None）。
+    """
+    cond = session_condition(session_id)
+    with cond:
+        session = session_store.update(session_id, fields, expect=expect)
+        cond.notify_all()
+    return session
+
+def forget_session(session_id):
+    """期限切れで削除されたセッションの後始末（画像の削除・待機中のクライアントを起こす・ロックの破棄）"""
+    image_store.release_session(session_id)
+    cancel_speculation(session_id)
+    tracer.discard(session_id)
+    with memory_locks_lock:
+        memory_locks.pop(session_id, None)
+    with session_conditions_lock:
+        cond = session_conditions.pop(session_id, None)
+    if cond is not None:
+        with cond:
+            cond.notify_all()
+
+def wait_for_session_change(session_id, since_version, timeout):
+    """version が since_version より進むまで待つ（変更がなければ timeout 秒で False）"""
+    cond = session_condition(session_id)
+    changed = lambda: (session_store.version(session_id) or 0) > since_version
+    if not session_store.shared:
+        with cond:
+            return cond.wait_for(changed, timeout)
+    deadline = time.monotonic() + timeout
+    with cond:
+        while not changed():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            cond.wait(min(remaining, SESSION_POLL_INTERVAL))
+        return True
 
 # ========================================
-# ユーティリティ
+# ワーカーの生存確認・中断されたセッションの復旧
 # ========================================
-def call_with_retry(model, prompt, max_retries=5, initial_wait=60):
-    """レート制限対策付きAPI呼び出し（タイムアウト付き）"""
-    import concurrent.futures
+def is_orphaned(session):
+    """生成途中のセッションの持ち主（ワーカー）が既にいないか"""
+    owner = session.get('owner')
+    if owner == WORKER_ID:
+        return False
+    return owner is None or not session_store.worker_alive(owner)
+
+def recover_interrupted_sessions():
+    """
+    落ちた（再起動した）ワーカーが生成途中のまま残したセッションを、ユーザーが再実行できる状態に戻す。
+    他の生きているワーカーが生成中のセッションには触れない。
+    """
+    for session_id, session in session_store.items():
+        if not is_orphaned(session):
+            continue
+        fields = {}
+        if session.get('status') == 'initializing':
+            fields.update(status='error', error='サーバー再起動により初期化が中断されました。もう一度お試しください。')
+        elif session.get('status') == 'generating':
+            fields['status'] = 'continue' if session.get('conversation') else 'ready'
+        if session.get('comic_status') == 'generating':
+            fields['comic_status'] = 'error'
+        if fields:
+            # 読んでから今までに他のワーカーが引き取っていれば何もしない
+            if update_session(session_id, expect={'version': session.get('version', 0)}, **fields):
+                log.info("中断されたセッションを復旧: %s -> %s", session_id, fields)
+
+def start_worker_monitor():
+    """
+    ハートビートを書き続けるデーモンスレッドを起動する。共有ストアでは、他のワーカーが
+    落ちて残したセッションの復旧もセッション掃除の間隔ごとに行う。
+    """
+    def monitor():
+        next_recovery = time.monotonic() + SESSION_SWEEP_INTERVAL
+        while True:
+            time.sleep(WORKER_TIMEOUT / 3)
+            try:
+                session_store.heartbeat(WORKER_ID, WORKER_TIMEOUT)
+                if session_store.shared and time.monotonic() >= next_recovery:
+                    next_recovery = time.monotonic() + SESSION_SWEEP_INTERVAL
+                    recover_interrupted_sessions()
+                    resume_pending_summaries()
+            except Exception as e:
+                log.warning("ワーカー監視エラー: %s", e)
+
+    threading.Thread(target=monitor, daemon=True, name="worker-monitor").start()
+
+session_store.start_sweeper(interval=SESSION_SWEEP_INTERVAL, on_expire=forget_session)
+session_store.heartbeat(WORKER_ID, WORKER_TIMEOUT)
+# 正常終了時はすぐに「落ちた」扱いにして、残したセッションを他のワーカーが引き取れるようにする
+atexit.register(lambda: session_store.heartbeat(WORKER_ID, 0))
+# SIGTERM では新しいジョブの受付を止め、終了前に実行中のジョブを待つ
+# （drain はスレッドの終了処理で動くので、atexit でハートビートを消すより先に終わる）
+scheduler.install_shutdown_handlers()
+recover_interrupted_sessions()
 
-    for attempt in range(max_retries):
+# 画像ディレクトリの上限・保持期間（起動時の走査で索引は作り直し済み）
+image_store.collect()
+image_store.start_collector(interval=float(os.environ.get("ECHO_IMAGE_GC_INTERVAL", "60")))
+
+# ========================================
+# ユーティリティ
+# ========================================
+def stream_with_retry(model, prompt, on_text, on_reset=None, deadline=None, generation_config=None, kind="other"):
+    """
+    ストリーミング版の call_with_retry。
+    チャンクが届くたびに on_text(chunk_text) を呼び、最後に全文を返す。
+    途中で失敗して再試行する場合は on_reset() を呼ぶ（クライアント側の表示をやり直すため）。
+    1回の読み出しは ECHO_CALL_TIMEOUT 秒と deadline の残り時間で打ち切る（止まったストリームで待ち続けない）。
+    """
+    def stream_once():
+        chunks = []
         try:
-            print(f"[DEBUG] API呼び出し開始 (試行 {attempt+1}/{max_retries})")
-
-            # 60秒タイムアウト付きで実行
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(model.generate_content, prompt)
-                try:
-                    response = future.result(timeout=60)
-                    print(f"[DEBUG] API呼び出し成功")
-                    return response.text.strip()
-                except concurrent.futures.TimeoutError:
-                    print(f"[ERROR] タイムアウト（60秒）- 試行 {attempt+1}/{max_retries}")
-                    if attempt == max_retries - 1:
-                        raise Exception("APIタイムアウト：60秒以内に応答がありませんでした")
-                    time.sleep(10)
-                    continue
+            for text in stream_with_timeout(lambda: model.stream_text(prompt, generation_config),
+                                            deadline=deadline):
+                if text:
+                    chunks.append(text)
+                    on_text(text)
+        except Exception:
+            if chunks and on_reset:
+                on_reset()
+            raise
+        return "".join(chunks).strip()
+
+    return retry_call(stream_once, model_name_of(model), deadline=deadline,
+                      timeout=False, label="ストリーミングAPI", kind=kind, prompt_size=len(prompt))
 
-        except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "Resource exhausted" in error_msg:
-                wait_time = initial_wait * (attempt + 1)
-                print(f"[WARN] レート制限検知。{wait_time}秒待機... (試行 {attempt+1}/{max_retries})")
-                time.sleep(wait_time)
-            elif "タイムアウト" in error_msg:
-                raise
-            else:
-                if attempt == max_retries - 1:
-                    raise
-                print(f"[WARN] エラー: {error_msg} - 10秒後に再試行")
-                time.sleep(10)
-    raise Exception("API呼び出し失敗")
-
-def extract_json(text):
-    if "```json" in text:
-        text = text.split("```json")[1].split("```")[0].strip()
-    elif "```" in text:
-        text = text.split("```")[1].split("```")[0].strip()
+# ========================================
+# JSON 出力（JSON モード + 寛容なパース + 修復のみの再試行）
+# ========================================
+CHARACTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "public_persona": {"type": "string"},
+        "secret_goal": {"type": "string"},
+        "speech_style": {"type": "string"},
+    },
+    "required": ["name", "age", "public_persona", "secret_goal", "speech_style"],
+}
+
+CHARACTERS_SCHEMA = {"type": "array", "items": CHARACTER_SCHEMA}
+
+NARRATIVE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "narrative": {"type": "string"},
+        "inner_thought": {"type": "string"},
+    },
+    "required": ["narrative", "inner_thought"],
+}
+
+INNER_THOUGHT_SCHEMA = {
+    "type": "object",
+    "properties": {"inner_thought": {"type": "string"}},
+    "required": ["inner_thought"],
+}
+
+STORY_MEMORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "key_facts": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["summary", "key_facts"],
+}
+
+SUGGESTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {"suggestions": {"type": "array", "items": {"type": "string"}}},
+    "required": ["suggestions"],
+}
+
+def json_config(schema):
+    """JSON モード（スキーマ指定）の generation_config"""
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+def json_validator(schema):
+    """
+    モデルを呼ばずにパースとスキーマ検査だけを行う関数を返す（キャッシュの validate 用）。
+    通らなければ ValueError
+    """
+    def validate(text):
+        data = parse_json(text)
+        check_schema(data, schema)
+        return data
+    return validate
+
+def nonempty_text(text):
+    """前後の空白を除いた応答を返す（空なら ValueError。キャッシュの validate 用）"""
+    text = text.strip()
+    if not text:
+        raise ValueError("応答が空です")
     return text
 
+def parse_model_json(model, text, schema, deadline=None):
+    """
+    モデル出力を寛容にパースしてスキーマを検査する。
+    それでも不正なら、壊れた出力の修復だけをモデルに依頼する（フェーズ全体は生成し直さない）。
+    """
+    with tracer.span('json_parse', cat='json', size=len(text)) as span:
+        try:
+            return json_validator(schema)(text)
+        except ValueError as e:
+            span.set(outcome='invalid', error=str(e)[:200])
+            log.warning("JSON 出力が不正なため修復のみ再試行: %s", e)
+
+    fixed = call_with_retry(model, f"""
+以下はJSONで出力されるはずだったテキストですが、形式が壊れています。
+内容は変えずに、スキーマに合う正しいJSONだけを出力してください。
+
+スキーマ:
+{json.dumps(schema, ensure_ascii=False)}
+
+テキスト:
+{text}
+""", deadline=deadline, kind='json_repair', generation_config=json_config(schema))
+    with tracer.span('json_parse', cat='json', size=len(fixed), repaired=True):
+        data = parse_json(fixed)
+        check_schema(data, schema)
+    return data
+
 # ========================================
 # 4コマ漫画生成
 # ========================================
+@tracer.traced(cat='phase')
+@priority.in_lane('comic')
 def generate_comic(session_id):
     """
     ストーリー全体の重要なシーンを1枚のイメージイラストとして生成
     結フェーズ完了後に呼び出される
     """
-    session = sessions.get(session_id)
+    session = session_store.get(session_id)
     if not session:
         return
 
-    print(f"[INFO] ストーリーイメージ生成開始: {session_id}")
-    session['comic_status'] = 'generating'
-    session['comic_images'] = []
+    log.info("ストーリーイメージ生成開始: %s", session_id)
+    update_session(session_id, comic_status='generating', comic_images=[])
 
-    generator = GenerativeModel("gemini-2.0-flash-001")
+    generator = backend.text_model(TEXT_MODEL)
 
     phases = [
         ('ki',    '起'),
@@ -134,13 +423,13 @@ def generate_comic(session_id):
         else:
             full_story[phase_key] = ""
 
-    print(f"[INFO] 全4フェーズのストーリー取得完了")
+    log.info("全4フェーズのストーリー取得完了")
 
     try:
-        imagen = ImageGenerationModel.from_pretrained("imagen-3.0-generate-001")
+        imagen = backend.image_model(IMAGEN_MODEL)
 
         # 1枚のイメージイラストを生成（起承転結の最も重要なシーン）
-        print(f"[INFO] ストーリーイメージ生成中...")
+        log.info("ストーリーイメージ生成中...")
 
         # Geminiでストーリー全体を短く要約（画像生成用に最適化）
         summary_prompt = f"""
@@ -155,137 +444,515 @@ def generate_comic(session_id):
 英語30語以内で出力:"""
 
         try:
-            scene_summary = call_with_retry(generator, summary_prompt)
-            print(f"[DEBUG] Scene summary: {scene_summary}")
+            scene_summary = call_with_retry(generator, summary_prompt, kind='image_prompt')
+            log.debug("Scene summary: %s", scene_summary)
 
             # シンプルなプロンプト（要約版）
             image_prompt = f"Anime style illustration: {scene_summary}. No text, no speech bubbles."
-            print(f"[DEBUG] Final prompt: {image_prompt}")
+            log.debug("Final prompt: %s", image_prompt)
 
         except Exception as summary_error:
-            print(f"[WARN] 要約生成エラー、フォールバック使用: {str(summary_error)}")
+            log.warning("要約生成エラー、フォールバック使用: %s", summary_error)
             # 要約失敗時のフォールバック
             story_brief = story_text[:150]
             image_prompt = f"Anime style: {story_brief}. No text."
 
-        retry_count = 0
-        max_retries = 3
-        image_url = None
-
-        while retry_count < max_retries:
-            try:
-                time.sleep(5)  # Rate limit対策
-
-                images = imagen.generate_images(
-                    prompt=image_prompt,
-                    number_of_images=1,
-                )
-
-                if not images:
-                    raise Exception("画像生成APIが空のレスポンスを返しました")
-
-                # 画像をファイルに保存
-                filename = f"{session_id}_story.png"
-                filepath = os.path.join(IMAGE_DIR, filename)
-
-                # imagesはリストなので[0]でアクセス
-                images[0].save(location=filepath, include_generation_parameters=False)
-
-                image_url = f"/static/images/{filename}"
-                print(f"[OK] ストーリーイメージ生成完了: {image_url}")
-                break
-
-            except Exception as img_error:
-                retry_count += 1
-                wait_time = retry_count * 5
-                print(f"[WARN] 画像生成エラー (試行 {retry_count}/{max_retries}): {str(img_error)}")
-                if retry_count < max_retries:
-                    time.sleep(wait_time)
-
-        if image_url:
+        image = None
+        try:
+            # 同じプロンプトで生成済みの画像があれば Imagen を呼ばずに再利用する
+            prompt_key = image_store.prompt_key(IMAGEN_MODEL, image_prompt)
+            image = image_store.lookup(prompt_key, session_id=session_id)
+            if image:
+                log.info("生成済みの画像を再利用: %s", image['image_url'])
+            else:
+                image_bytes = retry_call(lambda: imagen.generate_image(image_prompt), IMAGEN_MODEL,
+                                         policy=IMAGEN_RETRY_POLICY, label="画像生成", kind='imagen',
+                                         prompt_size=len(image_prompt))
+                image = image_store.save(image_bytes, prompt_key=prompt_key, session_id=session_id)
+                log.info("ストーリーイメージ生成完了: %s", image['image_url'])
+        except Exception as img_error:
+            log.warning("画像生成エラー: %s", img_error)
+
+        if image:
             # 1枚の画像のみ
-            session['comic_images'] = [{
+            comic_images = [{
                 "phase": "story",
-                "image_url": image_url,
+                "image_url": image['image_url'],
+                "png_url": image['png_url'],
+                "thumb_url": image['thumb_url'],
                 "prompt": image_prompt
             }]
         else:
-            print(f"[ERROR] ストーリーイメージ生成に失敗しました")
-            session['comic_images'] = []
+            log.error("ストーリーイメージ生成に失敗しました")
+            comic_images = []
 
-        session['comic_status'] = 'complete'
+        update_session(session_id, comic_status='complete', comic_images=comic_images)
 
-        print(f"[OK] ストーリーイメージ生成完了: 1枚")
+        log.info("ストーリーイメージ生成完了: 1枚")
 
     except Exception as e:
         error_msg = str(e)
-        print(f"[ERROR] 4コマ漫画生成失敗: {error_msg}")
-        print(f"[ERROR] Full error traceback:")
-        import traceback
-        traceback.print_exc()
+        log.exception("4コマ漫画生成失敗: %s", error_msg)
 
-        session['comic_images'] = []
-        session['comic_status'] = 'error'
+        update_session(session_id, comic_status='error', comic_images=[])
 
-    print(f"[INFO] 4コマ漫画生成処理完了: {session_id}")
+    log.info("4コマ漫画生成処理完了: %s", session_id)
 
 # ========================================
-# フェーズ別生成
+# 初期設定（キャラクター・初期状況・題名）
 # ========================================
-def generate_phase(session_id, phase, user_direction=""):
-    session = sessions.get(session_id)
-    if not session:
-        return {"error": "セッションが見つかりません"}
-    
-    # モデル設定 
-    generator = GenerativeModel("gemini-2.0-flash-001")
-    
-    # ========== start: 初期設定 ==========
-    if phase == 'start':
-        print(f"[DEBUG] セッション {session_id}: キャラクター生成開始")
-        session['progress'] = 'キャラクター生成中...'
-        
-        # 1. キャラクター生成
-        text = call_with_retry(generator, f"""
-{session['theme']}で2人のキャラクターを生成。
+SETUP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "characters": CHARACTERS_SCHEMA,
+        "initial_situation": {"type": "string"},
+        "story_title": {"type": "string"},
+    },
+    "required": ["characters", "initial_situation", "story_title"],
+}
+
+def validate_setup(data):
+    """一括生成の結果を検証して (characters, initial_situation, story_title) を返す"""
+    if not isinstance(data, dict):
+        raise ValueError("オブジェクトではありません")
+    characters = data.get('characters')
+    if not isinstance(characters, list) or len(characters) != 2:
+        raise ValueError("キャラクターが2人ではありません")
+    for c in characters:
+        for field in CHARACTER_SCHEMA['required']:
+            if not isinstance(c, dict) or c.get(field) in (None, ''):
+                raise ValueError(f"キャラクターの {field} がありません")
+        try:
+            c['age'] = int(c['age'])
+        except (TypeError, ValueError):
+            raise ValueError("キャラクターの age が数値ではありません")
+    if characters[0]['name'] == characters[1]['name']:
+        raise ValueError("キャラクター名が重複しています")
+    initial_situation = str(data.get('initial_situation') or '').strip()
+    story_title = str(data.get('story_title') or '').strip()
+    if not initial_situation or not story_title:
+        raise ValueError("初期状況または題名がありません")
+    return characters, initial_situation, story_title
+
+def generate_setup_fused(generator, theme, deadline=None):
+    """
+    キャラクター2人・初期状況・題名を JSON スキーマ指定の1回の呼び出しで生成する。
+    validate_setup に通った応答だけをキャッシュする（通らなければ InvalidResponse）
+    """
+    return cached_call_with_retry('setup', generator, f"""
+{theme}で物語の初期設定を生成してください。
+
+- characters: 2人のキャラクター
+  name: 3文字 / age: 年齢 / public_persona: 表の性格(1文) / secret_goal: 裏の目的(1文) / speech_style: 話し方
+- initial_situation: 2人が出会う初期状況を1文で
+- story_title: 物語の題名（10文字以内、物語の雰囲気を表現）
+""", deadline=deadline, generation_config=json_config(SETUP_SCHEMA),
+        validate=lambda text: validate_setup(parse_json(text)))
+
+def generate_setup_stepwise(session_id, generator, theme, deadline=None):
+    """従来の3ステップ（キャラクター → 初期状況 → 題名）で初期設定を生成する"""
+    log.debug("セッション %s: キャラクター生成開始", session_id)
+    update_session(session_id, progress='キャラクター生成中...')
+
+    # 1. キャラクター生成（壊れた JSON はキャッシュせず、修復だけ依頼する）
+    try:
+        characters = cached_call_with_retry('characters', generator, f"""
+{theme}で2人のキャラクターを生成。
 
 JSON形式:
 [
   {{"name": "3文字", "age": 17, "public_persona": "表(1文)", "secret_goal": "裏(1文)", "speech_style": "話し方"}}
 ]
-""")
-        time.sleep(8)  # ★安全のための待機 (10 RPM対策)
+""", deadline=deadline, generation_config=json_config(CHARACTERS_SCHEMA),
+            validate=json_validator(CHARACTERS_SCHEMA))
+    except InvalidResponse as e:
+        characters = parse_model_json(generator, e.text, CHARACTERS_SCHEMA, deadline)
 
-        print(f"[DEBUG] セッション {session_id}: キャラクター生成完了")
-        characters = json.loads(extract_json(text))
-        session['characters'] = characters
-        session['progress'] = '初期状況を生成中...'
-        
-        # 2. 初期状況生成
-        char_info = "\n".join([f"{c['name']}: {c['secret_goal']}" for c in characters])
-        initial_situation = call_with_retry(generator, f"""
-{session['theme']}で以下のキャラクターが出会う初期状況を1文で。
+    log.debug("セッション %s: キャラクター生成完了", session_id)
+    update_session(session_id, characters=characters, progress='初期状況を生成中...')
+
+    # 2. 初期状況生成
+    char_info = "\n".join([f"{c['name']}: {c['secret_goal']}" for c in characters])
+    try:
+        initial_situation = cached_call_with_retry('situation', generator, f"""
+{theme}で以下のキャラクターが出会う初期状況を1文で。
 
 {char_info}
-""")
-        session['initial_situation'] = initial_situation
-        time.sleep(8)  # ★安全のための待機
+""", deadline=deadline, validate=nonempty_text)
+    except InvalidResponse as e:
+        initial_situation = e.text      # 空の応答はキャッシュしない
+    update_session(session_id, initial_situation=initial_situation)
 
-        # 3. 物語の題名生成
-        session['progress'] = '物語の題名を生成中...'
-        story_title = call_with_retry(generator, f"""
+    # 3. 物語の題名生成
+    update_session(session_id, progress='物語の題名を生成中...')
+    try:
+        story_title = cached_call_with_retry('title', generator, f"""
 以下のテーマとキャラクターから、物語の題名を生成してください。
 
-テーマ: {session['theme']}
+テーマ: {theme}
 登場人物: {char_info}
 
 【題名の条件】
 - 10文字以内
 - 物語の雰囲気を表現
 - 題名のみ出力（説明不要）
-""")
-        session['story_title'] = story_title.strip()
-        time.sleep(8)  # ★安全のための待機
+""", deadline=deadline, validate=nonempty_text)
+    except InvalidResponse as e:
+        story_title = e.text.strip()
+    update_session(session_id, story_title=story_title)
+
+    return characters, initial_situation, story_title
+
+# ========================================
+# 内心生成
+# ========================================
+def generate_inner_thought(session, agent, narrative, deadline=None):
+    """1キャラクターの内心を生成する。失敗時は "..." を返す"""
+    log.debug("%sの内心を生成中...", agent['name'])
+    character = [c for c in session['characters'] if c['name'] == agent['name']][0]
+    inner_prompt = f"""
+以下の場面における{agent['name']}の内心を1文で表現してください。
+
+場面: {narrative}
+
+あなたは{agent['name']}です。
+性格: {character['public_persona']}
+目的: {character['secret_goal']}
+
+JSON形式で出力:
+{{"inner_thought": "内心の考え（1文）"}}
+"""
+    try:
+        model = backend.text_model(TEXT_MODEL)
+        inner_text = call_with_retry(model, inner_prompt, deadline=deadline, kind='inner_thought',
+                                     generation_config=json_config(INNER_THOUGHT_SCHEMA))
+        inner_data = parse_model_json(model, inner_text, INNER_THOUGHT_SCHEMA, deadline)
+        return {
+            "character": agent['name'],
+            "thought": inner_data.get('inner_thought', '')
+        }
+    except Exception as e:
+        log.warning("内心生成エラー (%s): %s", agent['name'], e)
+        return {
+            "character": agent['name'],
+            "thought": "..."
+        }
+
+# ========================================
+# 語り手プロンプト
+# ========================================
+# フェーズ名のマッピング
+PHASE_TITLES = {
+    'ki': '起（状況設定・出会い）',
+    'sho': '承（展開・関係の深まり）',
+    'ten': '転（転換・意外な展開）',
+    'ketsu': '結（結末・変化）'
+}
+
+def build_phase_prompt(narrator, initial_situation, conversation, phase, user_direction="", memory=None):
+    """
+    語り手に渡すプロンプト（指示 + 初期状況 + 物語メモリ + 直近の物語 + ユーザーの希望）を組み立てる
+    物語メモリに反映済みの場面は要約で渡し、本文はメモリ未反映の場面（最低でも直前の1場面、最大4場面）だけにする
+    """
+    direction_text = f"\n\n【ユーザーの希望】\n{user_direction}" if user_direction else ""
+    phase_title = PHASE_TITLES.get(phase, phase)
+
+    if len(conversation) == 0:
+        prompt = f"""
+初期状況: {initial_situation}
+{direction_text}
+
+これは物語の「{phase_title}」の場面です。
+{narrator['char_names'][0]}と{narrator['char_names'][1]}が登場する場面を描写してください。
+
+必ずJSON形式のみで出力してください。
+"""
+    else:
+        memory_text = ""
+        covered = 0
+        if memory and memory.get('summary'):
+            facts = "\n".join(f"- {fact}" for fact in memory.get('key_facts', []))
+            memory_text = f"\n【これまでのあらすじ】\n{memory['summary']}\n"
+            if facts:
+                memory_text += f"\n【重要な事実】\n{facts}\n"
+            covered = min(memory.get('length', 0), len(conversation) - 1)
+        recent = conversation[covered:][-4:]
+        story_so_far = "\n\n".join([m['narrative'] for m in recent])
+        prompt = f"""
+初期状況: {initial_situation}
+{memory_text}
+【これまでの物語】
+{story_so_far}
+{direction_text}
+
+これは物語の「{phase_title}」の場面です。
+上記の流れを受けて、{narrator['char_names'][0]}と{narrator['char_names'][1]}が登場する続きの場面を描写してください。
+
+必ずJSON形式のみで出力してください。
+"""
+
+    return f"{narrator['instruction']}\n\n{prompt}"
+
+# ========================================
+# 物語メモリ（要約 + 重要事実）
+# ========================================
+# フェーズごとに、まだ反映していない場面だけを読んで要約と重要事実を更新する。
+# 語り手のプロンプトは全文ではなくこのメモリを使うので、物語が長くなってもプロンプトが伸びない。
+# 結の後の最終要約もメモリの更新として作るため、全文を読み直す呼び出しが要らない。
+memory_jobs = scheduler.queue('memory', workers=MEMORY_WORKERS)
+memory_locks = {}   # session_id -> Lock（同じセッションの更新は順番に）
+memory_locks_lock = threading.Lock()
+
+def memory_lock(session_id):
+    with memory_locks_lock:
+        lock = memory_locks.get(session_id)
+        if lock is None:
+            lock = memory_locks[session_id] = threading.Lock()
+        return lock
+
+def build_memory_prompt(theme, memory, new_messages, final):
+    previous = memory.get('summary') or "（まだありません）"
+    facts = "\n".join(f"- {fact}" for fact in memory.get('key_facts', [])) or "（まだありません）"
+    new_text = "\n\n".join(
+        f"[{PHASE_TITLES.get(m.get('phase'), m.get('phase'))}] {m['narrative']}" for m in new_messages
+    ) or "（新しい場面はありません）"
+    if final:
+        summary_rule = "250文字～300文字で、起承転結の流れを含め、物語の核心と結末を明確に"
+    else:
+        summary_rule = "200文字以内で、続きの場面を書くのに必要な流れが分かるように"
+    return f"""
+これまでの物語の要約と重要な事実に、新しい場面の内容を反映して更新してください。
+
+テーマ: {theme}
+
+【これまでの要約】
+{previous}
+
+【重要な事実】
+{facts}
+
+【新しい場面】
+{new_text}
+
+【出力の条件】
+- summary: {summary_rule}、物語全体の要約を記述すること
+- key_facts: 今後の展開で矛盾させてはいけない事実（人物の関係・秘密・約束・出来事）を{MEMORY_MAX_FACTS}個以内で。古くなった事実は削除・統合すること
+- 読みやすく簡潔な文章で記述すること
+
+JSON形式で出力:
+{{"summary": "要約", "key_facts": ["事実1", "事実2"]}}
+"""
+
+@tracer.traced(cat='phase', fields=('final',))
+@priority.in_lane('summary')
+def update_story_memory(session_id, final=False):
+    """
+    メモリに未反映の場面を要約と重要事実に反映する（差分だけを読む1回の呼び出し）。
+    final=True では最終要約（250〜300文字）を作り、セッションの summary に保存する。
+    """
+    with memory_lock(session_id):
+        session = session_store.get(session_id)
+        if not session:
+            return
+        memory = session.get('memory') or {"summary": "", "key_facts": [], "length": 0}
+        conversation = session.get('conversation', [])
+        new_messages = conversation[memory['length']:]
+        if new_messages or final:
+            try:
+                generator = backend.text_model(TEXT_MODEL)
+                text = call_with_retry(generator, build_memory_prompt(session['theme'], memory, new_messages, final),
+                                       deadline=Deadline(PHASE_DEADLINE), kind='summary',
+                                       generation_config=json_config(STORY_MEMORY_SCHEMA))
+                data = parse_model_json(generator, text, STORY_MEMORY_SCHEMA)
+                memory = {
+                    "summary": data['summary'],
+                    "key_facts": data['key_facts'][:MEMORY_MAX_FACTS],
+                    "length": len(conversation),
+                }
+                # 他のワーカーが先にメモリを更新していたら、この結果は捨ててそちらを使う
+                if not update_session(session_id, expect={'memory': session.get('memory')}, memory=memory):
+                    log.debug("物語メモリは他のワーカーが更新済み: %s", session_id)
+                    memory = (session_store.get(session_id) or {}).get('memory') or memory
+                else:
+                    log.debug("物語メモリ更新: %s (%s場面, 事実%s件)",
+                              session_id, len(conversation), len(memory['key_facts']))
+            except Exception as e:
+                log.warning("物語メモリの更新に失敗: %s", e)
+
+        if final:
+            summary = memory.get('summary')
+            if memory.get('length') != len(conversation):
+                log.warning("最終要約を作れませんでした。直前のメモリを使用: %s", session_id)
+                summary = summary or "\n\n".join(m['narrative'] for m in conversation)[:300]
+            update_session(session_id, summary=summary, summary_status='complete')
+
+def schedule_memory_update(session_id, final=False):
+    """
+    物語メモリの更新をバックグラウンドに積む。キューが一杯なら、途中のフェーズは次の更新に任せ
+    （差分はその時にまとめて反映される）、最終要約はこのスレッドで作る（summary_status を pending のまま残さない）
+    """
+    try:
+        memory_jobs.submit(update_story_memory, session_id, final,
+                           label=f"{session_id}_{'final' if final else 'memory'}")
+    except QueueFull as e:
+        if not final:
+            log.warning("物語メモリの更新を登録できません。次のフェーズでまとめて反映します: %s", e)
+            return
+        log.warning("最終要約のジョブを登録できません。この場で作成します: %s", e)
+        update_story_memory(session_id, final=True)
+
+def resume_pending_summaries():
+    """落ちたワーカーが作りかけのまま残した最終要約を引き取って作り直す"""
+    for session_id, session in session_store.items():
+        if session.get('summary_status') == 'pending' and is_orphaned(session):
+            claimed = update_session(session_id, expect={'version': session.get('version', 0)}, owner=WORKER_ID)
+            if claimed:
+                log.info("中断された要約を再開: %s", session_id)
+                schedule_memory_update(session_id, final=True)
+
+resume_pending_summaries()
+start_worker_monitor()
+
+# ========================================
+# フェーズ別生成
+# ========================================
+PHASE_CONFIG = {
+    'ki': {'turns': 1, 'next': 'sho', 'title': '起（状況設定）', 'label': '【起】状況設定を生成中'},
+    'sho': {'turns': 1, 'next': 'ten', 'title': '承（展開）', 'label': '【承】物語の展開を生成中'},
+    'ten': {'turns': 1, 'next': 'ketsu', 'title': '転（転換）', 'label': '【転】転換点を生成中'},
+    'ketsu': {'turns': 1, 'next': 'complete', 'title': '結（結末）', 'label': '【結】結末を生成中'}
+}
+
+@tracer.traced(cat='phase', fields=('phase',))
+def generate_phase_turns(session, phase, user_direction, deadline, on_narrative=None, cancelled=None):
+    """
+    語り手の場面 + 全キャラクターの内心を生成し、このフェーズの会話のリストを返す。
+    セッションは書き換えない（投機的生成でも同じ関数を使う）。
+    cancelled（threading.Event）がセットされたら次の呼び出しの前に打ち切る。
+    """
+    config = PHASE_CONFIG[phase]
+    agents = session['agents']
+    narrator = session['narrator']
+    conversation = list(session['conversation'])
+    phase_conversations = []
+
+    for turn in range(config['turns']):
+        if cancelled is not None and cancelled.is_set():
+            break
+        log.info("%s (%s/%sターン目)", config['label'], turn + 1, config['turns'])
+
+        try:
+            # 1. 語り手モデルで第三者視点の場面生成
+            full_prompt = build_phase_prompt(
+                narrator, session['initial_situation'], conversation, phase, user_direction,
+                session.get('memory'))
+            model = backend.text_model(TEXT_MODEL)
+            if on_narrative:
+                streamer = JsonFieldStreamer('narrative')
+
+                def on_text(chunk):
+                    delta = streamer.feed(chunk)
+                    if delta:
+                        on_narrative(delta)
+
+                def on_reset():
+                    nonlocal streamer
+                    streamer = JsonFieldStreamer('narrative')
+                    on_narrative(None)
+
+                text = stream_with_retry(model, full_prompt, on_text, on_reset, deadline,
+                                         generation_config=json_config(NARRATIVE_SCHEMA), kind='narrator')
+            else:
+                text = call_with_retry(model, full_prompt, deadline=deadline, kind='narrator',
+                                       generation_config=json_config(NARRATIVE_SCHEMA))
+            data = parse_model_json(model, text, NARRATIVE_SCHEMA, deadline)
+
+            msg = {
+                "speaker": f"{narrator['char_names'][0]}・{narrator['char_names'][1]}",
+                "narrative": data.get('narrative', ''),
+                "inner_thought": data.get('inner_thought', ''),
+                "phase": phase
+            }
+
+            if cancelled is not None and cancelled.is_set():
+                break
+
+            # 2. 全キャラクターの内心を並列生成（レート制限は call_with_retry 内で共有）
+            # 結果の順序は agents と同じ
+            msg['all_inner_thoughts'] = generate_inner_thoughts(session, agents, msg['narrative'], deadline, phase)
+            conversation.append(msg)
+            phase_conversations.append(msg)
+            
+        except Exception as e:
+            log.warning("エラー: %s", e)
+            if cancelled is not None and cancelled.is_set():
+                break
+            metrics.sleep(10, 'error')
+            continue
+
+    return phase_conversations
+
+def generate_inner_thoughts(session, agents, narrative, deadline, phase):
+    """
+    全キャラクターの内心を内心生成キューで並列に生成する（順序は agents と同じ）。
+    キューが一杯ならこのスレッドで生成し、ジョブが失敗・取り消しになったキャラクターは
+    "..." にする（生成済みの語り手の場面は捨てない）
+    """
+    futures = []
+    for agent in agents:
+        try:
+            futures.append(inner_thought_jobs.submit(
+                generate_inner_thought, session, agent, narrative, deadline, label=f"{phase}_{agent['name']}"))
+        except QueueFull as e:
+            log.warning("内心生成ジョブを登録できません。直接生成します (%s): %s", agent['name'], e)
+            futures.append(None)
+    thoughts = []
+    for agent, future in zip(agents, futures):
+        try:
+            if future is None:
+                thoughts.append(generate_inner_thought(session, agent, narrative, deadline))
+            else:
+                thoughts.append(future.result())
+        except Exception as e:
+            log.warning("内心生成ジョブ失敗 (%s): %s", agent['name'], e)
+            thoughts.append({"character": agent['name'], "thought": "..."})
+    return thoughts
+
+@tracer.traced(cat='phase', fields=('phase', 'user_direction'))
+def generate_phase(session_id, phase, user_direction="", on_narrative=None, precomputed=None):
+    """
+    on_narrative を渡すと、語り手の "narrative" フィールドを生成途中から
+    on_narrative(delta) で逐次通知する（再試行時は on_narrative(None)）。
+    precomputed を渡すと、語り手・内心の生成を省いてその会話（投機的生成の結果）を使う。
+    """
+    session = session_store.get(session_id)
+    if not session:
+        return {"error": "セッションが見つかりません"}
+    
+    # モデル設定 
+    generator = backend.text_model(TEXT_MODEL)
+    # フェーズ全体の締め切り（各呼び出しのタイムアウト・再試行待機はこの範囲内に収める）
+    deadline = Deadline(PHASE_DEADLINE)
+    
+    # ========== start: 初期設定 ==========
+    if phase == 'start':
+        setup = None
+        if FUSED_SETUP:
+            # キャラクター・初期状況・題名を1回の構造化呼び出しで生成
+            log.debug("セッション %s: 一括設定生成開始", session_id)
+            update_session(session_id, progress='キャラクターと物語の設定を生成中...')
+            try:
+                setup = generate_setup_fused(generator, session['theme'], deadline)
+            except Exception as e:
+                log.warning("一括設定生成に失敗。3ステップ生成にフォールバック: %s", e)
+
+        if setup:
+            characters, initial_situation, story_title = setup
+            update_session(session_id, characters=characters,
+                           initial_situation=initial_situation, story_title=story_title)
+        else:
+            characters, initial_situation, story_title = generate_setup_stepwise(
+                session_id, generator, session['theme'], deadline)
 
         # 4. 語り手モデル作成（第三者視点）
         char_names = [c['name'] for c in characters]
@@ -316,8 +983,7 @@ JSON形式:
 必ずJSON形式のみで出力してください。
 """
 
-        session['narrator'] = {
-            "model": GenerativeModel("gemini-2.0-flash-001"),
+        narrator = {
             "instruction": narrator_instruction,
             "char_names": char_names,
             "char_profiles": char_profiles
@@ -328,160 +994,41 @@ JSON形式:
         for char in characters:
             agents.append({
                 "name": char['name'],
-                "model": GenerativeModel("gemini-2.0-flash-001"),
                 "instruction": ""
             })
 
-        session['agents'] = agents
-        session['conversation'] = []
+        update_session(session_id, narrator=narrator, agents=agents, conversation=[])
 
         return {
             "status": "ready",
             "characters": characters,
             "initial_situation": initial_situation,
-            "story_title": session['story_title'],
+            "story_title": story_title,
             "next_phase": "ki"
         }
     
     # ========== ki, sho, ten, ketsu: 会話生成 ==========
-    phase_config = {
-        'ki': {'turns': 1, 'next': 'sho', 'title': '起（状況設定）', 'label': '【起】状況設定を生成中'},
-        'sho': {'turns': 1, 'next': 'ten', 'title': '承（展開）', 'label': '【承】物語の展開を生成中'},
-        'ten': {'turns': 1, 'next': 'ketsu', 'title': '転（転換）', 'label': '【転】転換点を生成中'},
-        'ketsu': {'turns': 1, 'next': 'complete', 'title': '結（結末）', 'label': '【結】結末を生成中'}
-    }
-    
-    config = phase_config.get(phase)
+    config = PHASE_CONFIG.get(phase)
     if not config:
         return {"error": "無効なフェーズ"}
     
-    agents = session['agents']
-    narrator = session['narrator']
-    conversation = session['conversation']
-    initial_situation = session['initial_situation']
-    direction_text = f"\n\n【ユーザーの希望】\n{user_direction}" if user_direction else ""
-    phase_conversations = []
-
-    # フェーズ名のマッピング
-    phase_titles = {
-        'ki': '起（状況設定・出会い）',
-        'sho': '承（展開・関係の深まり）',
-        'ten': '転（転換・意外な展開）',
-        'ketsu': '結（結末・変化）'
-    }
-
-    for turn in range(config['turns']):
-        progress_msg = f"{config['label']} ({turn+1}/{config['turns']}ターン目)"
-        print(f"[INFO] {progress_msg}")
-
-        # プロンプト作成（第三者視点）
-        phase_title = phase_titles.get(phase, phase)
-
-        if len(conversation) == 0:
-            prompt = f"""
-初期状況: {initial_situation}
-{direction_text}
-
-これは物語の「{phase_title}」の場面です。
-{narrator['char_names'][0]}と{narrator['char_names'][1]}が登場する場面を描写してください。
-
-必ずJSON形式のみで出力してください。
-"""
-        else:
-            recent = conversation[-4:]
-            story_so_far = "\n\n".join([m['narrative'] for m in recent])
-            prompt = f"""
-初期状況: {initial_situation}
-
-【これまでの物語】
-{story_so_far}
-{direction_text}
-
-これは物語の「{phase_title}」の場面です。
-上記の流れを受けて、{narrator['char_names'][0]}と{narrator['char_names'][1]}が登場する続きの場面を描写してください。
-
-必ずJSON形式のみで出力してください。
-"""
-
-        try:
-            # 1. 語り手モデルで第三者視点の場面生成
-            full_prompt = f"{narrator['instruction']}\n\n{prompt}"
-            text = call_with_retry(narrator['model'], full_prompt)
-            data = json.loads(extract_json(text))
-
-            msg = {
-                "speaker": f"{narrator['char_names'][0]}・{narrator['char_names'][1]}",
-                "narrative": data.get('narrative', ''),
-                "inner_thought": data.get('inner_thought', ''),
-                "phase": phase
-            }
-            
-            time.sleep(8)  # ★安全のための待機 (ここが重要)
-            
-            # 2. 全キャラクターの内心を順次生成（並列処理から変更）
-            all_inner_thoughts = []
-            
-            for agent in agents:
-                print(f"[DEBUG] {agent['name']}の内心を生成中...")
-                inner_prompt = f"""
-以下の場面における{agent['name']}の内心を1文で表現してください。
-
-場面: {msg['narrative']}
-
-あなたは{agent['name']}です。
-性格: {[c for c in session['characters'] if c['name'] == agent['name']][0]['public_persona']}
-目的: {[c for c in session['characters'] if c['name'] == agent['name']][0]['secret_goal']}
-
-JSON形式で出力:
-{{"inner_thought": "内心の考え（1文）"}}
-"""
-                try:
-                    inner_text = call_with_retry(agent['model'], inner_prompt)
-                    inner_data = json.loads(extract_json(inner_text))
-                    all_inner_thoughts.append({
-                        "character": agent['name'],
-                        "thought": inner_data.get('inner_thought', '')
-                    })
-                    
-                    time.sleep(8)  # ★各APIコールの後に必ず待機
-                    
-                except Exception as e:
-                    print(f"内心生成エラー ({agent['name']}): {e}")
-                    all_inner_thoughts.append({
-                        "character": agent['name'],
-                        "thought": "..."
-                    })
-            
-            msg['all_inner_thoughts'] = all_inner_thoughts
-            conversation.append(msg)
-            phase_conversations.append(msg)
-            
-        except Exception as e:
-            print(f"エラー: {e}")
-            time.sleep(10)
-            continue
-    
-    session['conversation'] = conversation
-    
-    # ========== complete: 要約生成 ==========
-    if config['next'] == 'complete':
-        all_text = "\n\n".join([m['narrative'] for m in conversation])
-        summary = call_with_retry(generator, f"""
-以下の物語を250文字～300文字で要約してください。
-
-テーマ: {session['theme']}
-
-物語:
-{all_text}
-
-【要約の条件】
-- 250文字～300文字で記述
-- 起承転結の流れを含めること
-- 読みやすく簡潔な文章で記述すること
-- 物語の核心と結末を明確に
-""")
-        session['summary'] = summary
-
+    conversation = list(session['conversation'])
+    if precomputed is not None:
+        phase_conversations = precomputed
+    else:
+        phase_conversations = generate_phase_turns(session, phase, user_direction, deadline, on_narrative)
+    conversation.extend(phase_conversations)
+    final = config['next'] == 'complete'
+    if final:
+        update_session(session_id, conversation=conversation, summary=None, summary_status='pending')
+    else:
+        update_session(session_id, conversation=conversation)
+
+    # 物語メモリの更新はバックグラウンドで（結では最終要約もメモリから作る）
+    schedule_memory_update(session_id, final=final)
+
+    # ========== complete: 物語の確定（要約は物語メモリが後から保存する） ==========
+    if final:
         story = {
             'ki': [m for m in conversation if m.get('phase') == 'ki'],
             'sho': [m for m in conversation if m.get('phase') == 'sho'],
@@ -489,16 +1036,14 @@ JSON形式で出力:
             'ketsu': [m for m in conversation if m.get('phase') == 'ketsu']
         }
 
-        # ★ 4コマ漫画生成を非同期で開始（物語表示をブロックしない）
-        session['comic_status'] = 'generating'
-        session['comic_images'] = []
-        comic_thread = threading.Thread(
-            target=generate_comic,
-            args=(session_id,),
-            daemon=True
-        )
-        comic_thread.start()
-        print(f"[INFO] 4コマ漫画生成スレッド起動")
+        # ★ 4コマ漫画生成を画像ジョブキューに積む（物語表示をブロックしない）
+        update_session(session_id, comic_status='generating', comic_images=[])
+        try:
+            image_jobs.submit(generate_comic, session_id, label=f"{session_id}_story")
+            log.info("4コマ漫画生成ジョブ登録")
+        except QueueFull as e:
+            log.warning("4コマ漫画生成ジョブを登録できません: %s", e)
+            update_session(session_id, comic_status='error', comic_images=[])
 
         return {
             "status": "complete",
@@ -506,7 +1051,6 @@ JSON形式で出力:
             "conversations": phase_conversations,
             "next_phase": None,
             "story": story,
-            "summary": summary,
             "characters": session['characters']
         }
     
@@ -517,6 +1061,159 @@ JSON形式で出力:
         "next_phase": config['next']
     }
 
+# ========================================
+# 次フェーズの投機的生成（ECHO_SPECULATIVE=1）
+# ========================================
+speculative_jobs = scheduler.queue('speculative', workers=SPECULATIVE_WORKERS, max_queued=SPECULATIVE_WORKERS)
+speculations = {}   # session_id -> {"phase", "base_length", "cancelled", "future", "session"}
+speculations_lock = threading.Lock()
+speculation_stats = {
+    "started": 0, "hits": 0, "misses": 0, "discarded": 0, "failed": 0, "not_ready": 0,
+    "skipped_quota": 0, "skipped_busy": 0, "wasted_tokens": 0,
+}
+
+def count_speculation(name, amount=1):
+    with speculations_lock:
+        speculation_stats[name] += amount
+
+def estimate_phase_tokens(session, phase, messages):
+    """
+    フェーズ生成で使ったトークン数の概算（日本語は1文字≒1トークンとして文字数で数える）
+    語り手のプロンプト・出力と、内心生成の入力（場面）・出力を足す
+    """
+    tokens = len(build_phase_prompt(session['narrator'], session['initial_situation'],
+                                    session['conversation'], phase, memory=session.get('memory')))
+    for msg in messages:
+        tokens += len(msg['narrative']) + len(msg['inner_thought'])
+        for thought in msg.get('all_inner_thoughts', []):
+            tokens += len(msg['narrative']) + len(thought['thought'])
+    return tokens
+
+def run_speculation(session_id, phase, base_length, cancelled):
+    """
+    投機ジョブの本体。フェーズ生成の直後はバケットが空なので、残りトークンが
+    SPECULATIVE_HEADROOM 以上に戻るまで待ってから方向性なしで phase を生成する。
+    待つ間に中止・停止処理・物語の進行があれば何もせず None
+    """
+    headroom = min(SPECULATIVE_HEADROOM, rate_limiter.capacity(TEXT_MODEL))
+    give_up = time.monotonic() + SPECULATIVE_MAX_WAIT
+    while rate_limiter.available(TEXT_MODEL) < headroom:
+        if time.monotonic() >= give_up:
+            count_speculation('skipped_quota')
+            log.debug("残りトークンが増えないため投機を中止: %s %s", session_id, phase)
+            return None
+        if cancelled.wait(SPECULATIVE_POLL_INTERVAL) or scheduler.closed:
+            return None
+    # 待っている間に更新された物語メモリを使う
+    session = session_store.get(session_id)
+    if cancelled.is_set() or not session or len(session.get('conversation', [])) != base_length:
+        return None
+    return generate_phase_turns(session, phase, "", Deadline(PHASE_DEADLINE), cancelled=cancelled)
+
+def speculate_phase(session_id, phase):
+    """
+    方向性なしで phase を先に生成するジョブを積む（生成はレートリミッタに余裕ができてから）。
+    投機ワーカーが埋まっているときは何もしない（本番の生成を遅らせない）
+    """
+    if not SPECULATIVE or phase not in PHASE_CONFIG or scheduler.closed:
+        return
+    session = session_store.get(session_id)
+    if not session:
+        return
+    with speculations_lock:
+        running = sum(1 for s in speculations.values() if not s['future'].done())
+        if running >= SPECULATIVE_WORKERS:
+            speculation_stats['skipped_busy'] += 1
+            return
+        cancelled = threading.Event()
+        try:
+            # 先読みなので、提案と同じ低優先度のレーンで呼び出す（ジョブに文脈ごと引き継がれる）
+            with priority.lane('suggestions'):
+                future = speculative_jobs.submit(
+                    run_speculation, session_id, phase, len(session['conversation']), cancelled,
+                    label=f"{session_id}_{phase}", timeout=0)
+        except QueueFull:
+            speculation_stats['skipped_busy'] += 1
+            return
+        spec = {
+            "phase": phase,
+            "base_length": len(session['conversation']),
+            "cancelled": cancelled,
+            "session": session,
+            "future": future,
+        }
+        previous = speculations.pop(session_id, None)
+        speculations[session_id] = spec
+        speculation_stats['started'] += 1
+    if previous:
+        discard_speculation(previous)
+    log.info("投機的生成を開始: %s %s", session_id, phase)
+
+def discard_speculation(spec):
+    """投機的生成を中止し、終わった時点で使ったトークン数を無駄として数える"""
+    spec['cancelled'].set()
+    spec['future'].cancel()     # まだ始まっていなければ実行しない
+    count_speculation('discarded')
+
+    def wasted(future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            count_speculation('wasted_tokens', estimate_phase_tokens(spec['session'], spec['phase'], future.result()))
+    spec['future'].add_done_callback(wasted)
+
+def cancel_speculation(session_id):
+    with speculations_lock:
+        spec = speculations.pop(session_id, None)
+    if spec:
+        discard_speculation(spec)
+
+def take_speculation(session_id, phase, user_direction):
+    """
+    /continue 時に呼ぶ。方向性が空で、同じフェーズの投機的生成が終わっていればその会話を返す。
+    使えなければ破棄して None（呼び出し側が interactive レーンで生成し直す）。
+    生成中のものは待たない。投機は低優先度のレーンで動いているので、待つと本番の生成が
+    後回しの処理に足止めされる
+    """
+    if not SPECULATIVE:
+        return None
+    with speculations_lock:
+        spec = speculations.pop(session_id, None)
+    if spec is None:
+        if not user_direction:
+            count_speculation('misses')
+        return None
+    session = session_store.get(session_id)
+    if (user_direction or spec['phase'] != phase or not session
+            or len(session.get('conversation', [])) != spec['base_length']):
+        discard_speculation(spec)
+        return None
+    if not spec['future'].done():
+        log.info("投機的生成が終わっていないため破棄して生成: %s %s", session_id, phase)
+        count_speculation('not_ready')
+        discard_speculation(spec)
+        return None
+    try:
+        messages = spec['future'].result()
+    except Exception as e:
+        log.warning("投機的生成に失敗: %s", e)
+        count_speculation('failed')
+        return None
+    if not messages:
+        # 残りトークンが戻らずに投機をやめていた（skipped_quota で数え済み）
+        count_speculation('misses')
+        return None
+    count_speculation('hits')
+    log.info("投機的生成の結果を採用: %s %s", session_id, phase)
+    return messages
+
+def speculation_snapshot():
+    with speculations_lock:
+        stats = dict(speculation_stats)
+        stats['in_flight'] = sum(1 for s in speculations.values() if not s['future'].done())
+    decided = stats['hits'] + stats['misses'] + stats['discarded']
+    stats['enabled'] = SPECULATIVE
+    stats['hit_rate'] = round(stats['hits'] / decided, 3) if decided else None
+    return stats
+
 # ========================================
 # Webルート (変更なし)
 # ========================================
@@ -538,145 +1235,335 @@ def start():
         if not theme:
             return jsonify({"error": "テーマが必要"}), 400
         
-        print(f"[INFO] 新しいセッション開始: テーマ='{theme}'")
+        log.info("新しいセッション開始: テーマ='%s'", theme)
         
-        session_id = str(int(time.time() * 1000))
-        sessions[session_id] = {'theme': theme, 'current_phase': 'start', 'status': 'initializing'}
+        # 複数のワーカー・インスタンスで同時に作っても重ならないよう、時刻の後ろに乱数を付ける
+        session_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        session_store.put(session_id, {'theme': theme, 'current_phase': 'start', 'status': 'initializing',
+                                       'owner': WORKER_ID, 'version': 0})
         
         def init_session():
             try:
-                print(f"[DEBUG] セッション {session_id} 開始")
+                log.debug("セッション %s 開始", session_id)
                 result = generate_phase(session_id, 'start')
-                sessions[session_id].update(result)
-                sessions[session_id]['current_phase'] = 'ki'
-                sessions[session_id]['status'] = 'ready'
-                print(f"[INFO] セッション {session_id} 初期化完了")
+                update_session(session_id, **{**result, 'current_phase': 'ki', 'status': 'ready'})
+                log.info("セッション %s 初期化完了", session_id)
+                prepare_next_phase(session_id, 'ki')
             except Exception as e:
-                import traceback
-                print(f"[ERROR] 初期化失敗: {e}")
-                print(f"[ERROR] トレースバック:\n{traceback.format_exc()}")
-                sessions[session_id]['status'] = 'error'
-                sessions[session_id]['error'] = str(e)
+                log.exception("初期化失敗: %s", e)
+                update_session(session_id, status='error', error=str(e))
         
-        thread = threading.Thread(target=init_session, daemon=True)
-        thread.start()
+        try:
+            with session_context(session_id):
+                phase_jobs.submit(init_session, label=f"{session_id}_start", timeout=0)
+        except QueueFull as e:
+            log.warning("初期化ジョブを登録できません: %s", e)
+            update_session(session_id, status='error', error='混み合っています。しばらくしてからお試しください。')
+            return jsonify({"error": "混み合っています", "session_id": session_id}), 503
         
-        print(f"[INFO] セッション作成完了: session_id={session_id}")
-        print(f"[DEBUG] 返却データ: {{'session_id': '{session_id}', 'status': 'initializing'}}")
+        log.info("セッション作成完了: session_id=%s", session_id)
+        log.debug("返却データ: {'session_id': '%s', 'status': 'initializing'}", session_id)
         
         return jsonify({
             "session_id": session_id, 
             "status": "initializing"
         })
     except Exception as e:
-        import traceback
-        print(f"[ERROR] /start エンドポイントエラー: {e}")
-        print(f"[ERROR] トレースバック:\n{traceback.format_exc()}")
+        log.exception("/start エンドポイントエラー: %s", e)
         return jsonify({"error": f"サーバーエラー: {str(e)}"}), 500
 
+def build_status(session, since=None):
+    """
+    /status と /events で返すセッション状態
+    since を渡すと会話は conversation[since:] だけを返す（conversation_offset から始まる差分）。
+    その場合、差分に含まれない大きな項目（物語全体、since > 0 ならキャラクター・初期状況）は省く
+    """
+    conversation = session.get('conversation', [])
+    status_data = {
+        "version": session.get('version', 0),
+        "status": session.get('status', 'initializing'),
+        "current_phase": session.get('current_phase'),
+        "characters": session.get('characters'),
+        "initial_situation": session.get('initial_situation'),
+        "conversation": conversation,
+        "progress": session.get('progress', ''),
+        "next_phase": session.get('next_phase') or session.get('current_phase'),
+        "story": session.get('story'),
+        "summary": session.get('summary'),
+        "summary_status": session.get('summary_status'),
+        "comic_status": session.get('comic_status', 'not_started'),
+        "comic_images": session.get('comic_images', []),
+        "suggestions": session.get(f"suggestions_{session.get('current_phase')}") or []
+    }
+    if since is not None:
+        offset = max(0, min(since, len(conversation)))
+        status_data.update(conversation=conversation[offset:], conversation_offset=offset,
+                           conversation_length=len(conversation))
+        del status_data['story']
+        if offset > 0:
+            del status_data['characters'], status_data['initial_situation']
+
+    # 会話が更新された場合は、next_phaseも更新
+    if conversation:
+        # 最後の会話のフェーズを確認
+        last_conv = conversation[-1]
+        if last_conv.get('phase'):
+            current_phase = last_conv.get('phase')
+            phase_order = ['ki', 'sho', 'ten', 'ketsu']
+            try:
+                current_index = phase_order.index(current_phase)
+                if current_index < len(phase_order) - 1:
+                    status_data['next_phase'] = phase_order[current_index + 1]
+                else:
+                    status_data['next_phase'] = 'complete'
+            except ValueError:
+                pass
+
+    if session.get('error'):
+        status_data['error'] = session.get('error')
+
+    return status_data
+
+def session_etag(session_id, session, kind, since=None):
+    """セッションの version（更新のたびに進む）と表現（種類・since）から決まる強い ETag"""
+    tag = f"{kind}-{session_id}-{session.get('version', 0)}"
+    return tag if since is None else f"{tag}-{since}"
+
+def conditional_json(etag, build):
+    """If-None-Match が一致すれば本文を作らずに 304、そうでなければ build() の JSON を ETag 付きで返す"""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def is_session_settled(session):
+    """これ以上状態が変わらないセッション（エラー、または物語・要約・画像がすべて完了）"""
+    if session.get('status') == 'error':
+        return True
+    return (session.get('status') == 'complete' and session.get('summary_status') != 'pending'
+            and session.get('comic_status') in ('complete', 'error'))
+
 @app.route('/status/<session_id>')
 def status(session_id):
+    """
+    セッション状態を返す。
+    ?since_version=N を付けるとロングポーリングになり、version が N より進むまで
+    （最大 ?timeout= 秒、既定25秒）待ってから返す。変化がなければ 304。
+    ?since=K を付けると会話は K 件目以降の差分だけを返す。
+    ETag は version ごとに変わり、If-None-Match が一致すれば 304。
+    """
     try:
-        print(f"[DEBUG] ステータス取得リクエスト: session_id={session_id}")
-        print(f"[DEBUG] 現在のセッション数: {len(sessions)}")
-        print(f"[DEBUG] セッションID一覧: {list(sessions.keys())[:5]}")
-        
-        session = sessions.get(session_id)
+        session = session_store.get(session_id)
         if not session:
-            print(f"[WARN] セッションが見つかりません: {session_id}")
+            poll_log.warning("セッションが見つかりません: %s", session_id)
             return jsonify({
                 "error": "セッションが見つかりません",
                 "status": "not_found",
                 "session_id": session_id
             }), 404
-        
-        status_data = {
-            "status": session.get('status', 'initializing'),
-            "current_phase": session.get('current_phase'),
-            "characters": session.get('characters'),
-            "initial_situation": session.get('initial_situation'),
-            "conversation": session.get('conversation', []),
-            "progress": session.get('progress', ''),
-            "next_phase": session.get('next_phase') or session.get('current_phase'),
-            "story": session.get('story')
-        }
-        
-        # 会話が更新された場合は、next_phaseも更新
-        if session.get('conversation') and len(session.get('conversation', [])) > 0:
-            # 最後の会話のフェーズを確認
-            last_conv = session.get('conversation', [])[-1]
-            if last_conv.get('phase'):
-                current_phase = last_conv.get('phase')
-                phase_order = ['ki', 'sho', 'ten', 'ketsu']
-                try:
-                    current_index = phase_order.index(current_phase)
-                    if current_index < len(phase_order) - 1:
-                        status_data['next_phase'] = phase_order[current_index + 1]
-                    else:
-                        status_data['next_phase'] = 'complete'
-                except ValueError:
-                    pass
-        
-        if session.get('error'):
-            status_data['error'] = session.get('error')
-        
-        print(f"[DEBUG] ステータス返却: status={status_data.get('status')}")
-        return jsonify(status_data)
+
+        since_version = request.args.get('since_version', type=int)
+        poll_log.debug("ステータス取得: status=%s version=%s since_version=%s",
+                       session.get('status'), session.get('version'), since_version)
+        if since_version is not None:
+            timeout = min(request.args.get('timeout', 25, type=float), 60)
+            if not wait_for_session_change(session_id, since_version, timeout):
+                return '', 304
+            session = session_store.get(session_id) or session
+
+        since = request.args.get('since', type=int)
+        return conditional_json(session_etag(session_id, session, 'status', since),
+                                lambda: build_status(session, since))
     except Exception as e:
-        import traceback
-        print(f"[ERROR] /status エンドポイントエラー: {e}")
-        print(f"[ERROR] トレースバック:\n{traceback.format_exc()}")
+        log.exception("/status エンドポイントエラー: %s", e)
         return jsonify({"error": f"サーバーエラー: {str(e)}"}), 500
 
+@app.route('/events/<session_id>')
+def session_events(session_id):
+    """
+    セッション状態の変更を Server-Sent Events で配信する（event: status）
+    変更がない間はサーバー側の処理は発生しない（15秒ごとの keepalive のみ）。
+    再接続時は Last-Event-ID（= version）以降の変更から再開する。
+    ?since=K を付けると会話は差分で送る（最初は K 件目以降、以後は前回送った分の続き）。
+    """
+    if session_id not in session_store:
+        return jsonify({"error": "セッションが見つかりません", "status": "not_found"}), 404
+
+    since_version = request.headers.get('Last-Event-ID', type=int)
+    if since_version is None:
+        since_version = request.args.get('since_version', -1, type=int)
+    since = request.args.get('since', type=int)
+
+    def stream():
+        version = since_version
+        cursor = since
+        while True:
+            session = session_store.get(session_id)
+            if session is None:
+                yield sse_event('not_found', {"session_id": session_id})
+                return
+            if session.get('version', 0) > version:
+                data = build_status(session, cursor)
+                version = data['version']
+                if cursor is not None:
+                    cursor = data['conversation_length']
+                yield f"id: {version}\n" + sse_event('status', data)
+            elif is_session_settled(session):
+                # 最終状態を送信済み。クライアントに購読終了を知らせる
+                yield sse_event('end', {"version": version})
+                return
+            elif not wait_for_session_change(session_id, version, 15):
+                yield ": keepalive\n\n"
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/continue', methods=['POST'])
 def continue_story():
     data = request.json
     session_id = data.get('session_id')
     user_direction = data.get('direction', '')
-    session = sessions.get(session_id)
+    session = session_store.get(session_id)
     if not session:
         return jsonify({"error": "セッションなし"}), 404
-    
+
     current_phase = session.get('current_phase')
-    session['status'] = 'generating'
-    session['progress'] = f'{current_phase}フェーズを生成中...'
-    
-    def generate():
-        try:
-            result = generate_phase(session_id, current_phase, user_direction)
-            if result.get('next_phase'):
-                session['current_phase'] = result['next_phase']
-            if result.get('status') == 'complete':
-                session['status'] = 'complete'
-                session['story'] = result.get('story')
-                session['summary'] = result.get('summary')
-            else:
-                session['status'] = 'continue'
-        except Exception as e:
-            print(f"[ERROR] 生成失敗: {e}")
-            session['status'] = 'error'
-            session['error'] = str(e)
-            
-    thread = threading.Thread(target=generate, daemon=True)
-    thread.start()
+    if not claim_phase(session_id, session):
+        return jsonify({"error": "生成中です"}), 409
+
+    try:
+        phase_jobs.submit(run_phase, session_id, current_phase, user_direction,
+                          label=f"{session_id}_{current_phase}", timeout=0)
+    except QueueFull as e:
+        log.warning("フェーズ生成ジョブを登録できません: %s", e)
+        release_phase(session_id, session)
+        return jsonify({"error": "混み合っています"}), 503
     return jsonify({"status": "generating"})
 
+def claim_phase(session_id, session):
+    """
+    このワーカーでフェーズ生成を始める（status を generating にし、持ち主を記録する）。
+    既に生成中か、読んだ後に他のワーカーが先に始めていれば False。
+    """
+    if session.get('status') == 'generating':
+        return False
+    return update_session(
+        session_id, expect={'status': session.get('status'), 'current_phase': session.get('current_phase')},
+        status='generating', owner=WORKER_ID,
+        progress=f"{session.get('current_phase')}フェーズを生成中...") is not None
+
+def release_phase(session_id, session):
+    """claim_phase() を取り消す（ジョブを登録できなかったとき）"""
+    update_session(session_id, status=session.get('status'), owner=session.get('owner'),
+                   progress=session.get('progress', ''))
+
+def run_phase(session_id, current_phase, user_direction, on_narrative=None):
+    """/continue 系のバックグラウンド処理：フェーズを生成してセッションに反映する"""
+    try:
+        precomputed = take_speculation(session_id, current_phase, user_direction)
+        if precomputed and on_narrative:
+            for msg in precomputed:
+                on_narrative(msg['narrative'])
+        result = generate_phase(session_id, current_phase, user_direction, on_narrative, precomputed)
+        fields = {}
+        if result.get('next_phase'):
+            fields['current_phase'] = result['next_phase']
+        if result.get('status') == 'complete':
+            fields.update(status='complete', story=result.get('story'))
+        else:
+            fields['status'] = 'continue'
+        update_session(session_id, **fields)
+        if fields['status'] == 'continue' and result.get('next_phase'):
+            # 方向性の入力欄が表示される前に、次のフェーズの提案を用意しておく
+            prepare_next_phase(session_id, result['next_phase'])
+    except Exception as e:
+        log.error("生成失敗: %s", e)
+        update_session(session_id, status='error', error=str(e))
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/continue/stream/<session_id>')
+def continue_story_stream(session_id):
+    """
+    /continue のストリーミング版（Server-Sent Events）
+    語り手の narrative を生成途中から event: narrative で送り、
+    フェーズ完了時に event: done を送る。
+    クライアントが切断しても生成はバックグラウンドで続き、/status で取得できる。
+    """
+    session = session_store.get(session_id)
+    if not session:
+        return jsonify({"error": "セッションなし"}), 404
+    user_direction = request.args.get('direction', '')
+    current_phase = session.get('current_phase')
+    if not claim_phase(session_id, session):
+        return jsonify({"error": "生成中です"}), 409
+
+    events = queue.Queue()
+
+    def on_narrative(delta):
+        if delta is None:
+            events.put(('reset', {}))
+        else:
+            events.put(('narrative', {'delta': delta}))
+
+    def generate():
+        run_phase(session_id, current_phase, user_direction, on_narrative)
+        session = session_store.get(session_id) or {}
+        events.put(('done', {
+            'status': session.get('status'),
+            'current_phase': session.get('current_phase'),
+            'error': session.get('error') if session.get('status') == 'error' else None
+        }))
+
+    try:
+        phase_jobs.submit(generate, label=f"{session_id}_{current_phase}", timeout=0)
+    except QueueFull as e:
+        log.warning("フェーズ生成ジョブを登録できません: %s", e)
+        release_phase(session_id, session)
+        return jsonify({"error": "混み合っています"}), 503
+
+    def stream():
+        yield sse_event('start', {'phase': current_phase})
+        while True:
+            try:
+                event, data = events.get(timeout=15)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield sse_event(event, data)
+            if event == 'done':
+                break
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/result/<session_id>')
 def result(session_id):
-    session = sessions.get(session_id)
+    session = session_store.get(session_id)
     if not session or session.get('status') != 'complete':
         return jsonify({"error": "完了していません"}), 400
-    return jsonify({
+    return conditional_json(session_etag(session_id, session, 'result'), lambda: {
         "theme": session['theme'],
         "characters": session['characters'],
         "story": session['story'],
-        "summary": session['summary']
+        "summary": session.get('summary'),
+        "summary_status": session.get('summary_status', 'complete')
     })
 
 @app.route('/comic/<session_id>')
 def comic(session_id):
     """4コマ漫画の生成状況と画像URLを返す"""
-    session = sessions.get(session_id)
+    session = session_store.get(session_id)
     if not session:
         return jsonify({"error": "セッションが見つかりません"}), 404
     return jsonify({
@@ -684,10 +1571,24 @@ def comic(session_id):
         "comic_images": session.get('comic_images', [])
     })
 
+@app.route('/images/<name>')
+def image_file(name):
+    """
+    生成画像の配信。ファイル名が内容のハッシュなので内容は変わらない:
+    1年間の immutable キャッシュ + ETag（If-None-Match が一致すれば 304）
+    """
+    resolved = image_store.resolve(name)
+    if not resolved:
+        return jsonify({"error": "画像が見つかりません"}), 404
+    path, mimetype, etag = resolved
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=IMAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    return response
+
 @app.route('/comic/retry/<session_id>', methods=['POST'])
 def comic_retry(session_id):
     """4コマ漫画の再生成"""
-    session = sessions.get(session_id)
+    session = session_store.get(session_id)
     if not session:
         return jsonify({"error": "セッションが見つかりません"}), 404
 
@@ -702,31 +1603,26 @@ def comic_retry(session_id):
         "message": "再生成を開始しました（実装予定）"
     })
 
-@app.route('/suggestions/<session_id>')
-def suggestions(session_id):
-    """次のフェーズへの方向性提案を返す（AIで生成）"""
-    session = sessions.get(session_id)
-    if not session:
-        return jsonify({"error": "セッションが見つかりません"}), 404
-
-    # すでに提案がある場合はキャッシュを返す
-    phase = session.get('current_phase', 'ki')
+@tracer.traced(cat='phase', fields=('phase',))
+@priority.in_lane('suggestions')
+def generate_suggestions(session_id, phase):
+    """phase フェーズに加える展開の提案を生成し、セッションの suggestions_<phase> に保存する"""
     cache_key = f'suggestions_{phase}'
+    session = session_store.get(session_id)
+    if not session:
+        return []
     if session.get(cache_key):
-        return jsonify({"suggestions": session[cache_key]})
-
-    # Geminiで提案を生成
-    def generate_suggestions():
-        try:
-            generator = GenerativeModel("gemini-2.0-flash-001")
-            conversation = session.get('conversation', [])
-            recent = conversation[-2:] if conversation else []
-            story_so_far = "\n".join([m['narrative'] for m in recent]) if recent else "（まだ物語が始まっていません）"
+        return session[cache_key]
+    try:
+        generator = backend.text_model(TEXT_MODEL)
+        conversation = session.get('conversation', [])
+        recent = conversation[-2:] if conversation else []
+        story_so_far = "\n".join([m['narrative'] for m in recent]) if recent else "（まだ物語が始まっていません）"
 
-            phase_names = {'ki': '起', 'sho': '承', 'ten': '転', 'ketsu': '結'}
-            phase_label = phase_names.get(phase, phase)
+        phase_names = {'ki': '起', 'sho': '承', 'ten': '転', 'ketsu': '結'}
+        phase_label = phase_names.get(phase, phase)
 
-            text = call_with_retry(generator, f"""
+        prompt = f"""
 テーマ: {session['theme']}
 現在のフェーズ: {phase_label}
 
@@ -738,18 +1634,137 @@ def suggestions(session_id):
 
 JSON形式で出力:
 {{"suggestions": ["提案1", "提案2", "提案3"]}}
-""")
-            data = json.loads(extract_json(text))
-            session[cache_key] = data.get('suggestions', [])
-        except Exception as e:
-            print(f"[ERROR] 提案生成失敗: {e}")
-            session[cache_key] = []
+"""
+        try:
+            data = cached_call_with_retry('suggestions', generator, prompt,
+                                          generation_config=json_config(SUGGESTIONS_SCHEMA),
+                                          validate=json_validator(SUGGESTIONS_SCHEMA))
+        except InvalidResponse as e:
+            data = parse_model_json(generator, e.text, SUGGESTIONS_SCHEMA)
+        suggestions = data.get('suggestions', [])
+    except Exception as e:
+        log.error("提案生成失敗: %s", e)
+        suggestions = []
+    update_session(session_id, **{cache_key: suggestions})
+    return suggestions
+
+def prefetch_suggestions(session_id, phase):
+    """
+    提案の生成を低優先度のワーカーに積み、Future を返す。
+    同じ (セッション, フェーズ) の生成が進行中ならその Future を返す（二重に生成しない）
+    """
+    key = (session_id, phase)
+    with suggestion_inflight_lock:
+        future = suggestion_inflight.get(key)
+        if future is not None:
+            return future
+        # ロックを持ったまま待たないよう、キューに空きが無ければすぐ QueueFull にする
+        future = suggestion_inflight[key] = suggestion_jobs.submit(
+            generate_suggestions, session_id, phase, label=f"{session_id}_{phase}", timeout=0)
+
+    def done(_):
+        with suggestion_inflight_lock:
+            suggestion_inflight.pop(key, None)
+    future.add_done_callback(done)
+    return future
+
+def prepare_next_phase(session_id, phase):
+    """
+    フェーズ完了後の先読み（提案・投機的生成）。どちらも無くても困らない処理なので、
+    キューが一杯なら諦める（保存済みのフェーズを失敗扱いにしない）
+    """
+    try:
+        prefetch_suggestions(session_id, phase)
+    except QueueFull as e:
+        log.warning("提案の先読みを登録できません: %s", e)
+    speculate_phase(session_id, phase)
+
+@app.route('/suggestions/<session_id>')
+def suggestions(session_id):
+    """
+    次のフェーズへの方向性提案を返す（AIで生成）
+    通常はフェーズ完了時に先読み済み。生成中なら最大 ECHO_SUGGESTION_WAIT 秒待って返す
+    """
+    session = session_store.get(session_id)
+    if not session:
+        return jsonify({"error": "セッションが見つかりません"}), 404
 
-    # バックグラウンドで生成
-    thread = threading.Thread(target=generate_suggestions, daemon=True)
-    thread.start()
+    # すでに提案がある場合はキャッシュを返す
+    phase = session.get('current_phase', 'ki')
+    cache_key = f'suggestions_{phase}'
+    if session.get(cache_key):
+        return jsonify({"suggestions": session[cache_key]})
 
-    return jsonify({"suggestions": session.get(cache_key, [])})
+    try:
+        future = prefetch_suggestions(session_id, phase)
+    except QueueFull as e:
+        log.warning("提案の生成を登録できません: %s", e)
+        return jsonify({"suggestions": []})
+    try:
+        return jsonify({"suggestions": future.result(timeout=SUGGESTION_WAIT)})
+    except concurrent.futures.TimeoutError:
+        return jsonify({"suggestions": []})
+
+@app.route('/stats')
+def stats():
+    """チューニング用の統計（レスポンスキャッシュのヒット率など）"""
+    return jsonify({
+        "cache": response_cache.stats(),
+        "backend": backend.stats(),
+        "jobs": scheduler.stats(),
+        "priority": priority.stats(),
+        "images": image_store.stats(),
+        "speculation": speculation_snapshot(),
+        "trace": tracer.stats()
+    })
+
+def debug_only(view):
+    """ECHO_DEBUG_ROUTES=1 のときだけ応答するルートにする（無効なら 404）"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_ROUTES:
+            return jsonify({"error": "見つかりません"}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/debug/trace/<session_id>')
+@debug_only
+def debug_trace(session_id):
+    """
+    セッションのトレース（Chrome trace event 形式）。
+    chrome://tracing や https://ui.perfetto.dev に読み込むとスレッドごとのタイムラインで見られる。
+    """
+    trace = tracer.export(session_id)
+    if trace is None:
+        return jsonify({"error": "トレースがありません"}), 404
+    return jsonify(trace)
+
+@app.route('/debug/jobs')
+@debug_only
+def debug_jobs():
+    """
+    スケジューラのキューごとの統計と、待機中・実行中・最近終了したジョブ（新しい順）。
+    ?session_id= でセッションを絞り込み、?limit= で件数を指定する（既定: 100）
+    """
+    return jsonify(scheduler.snapshot(request.args.get('session_id'), request.args.get('limit', 100, type=int)))
+
+# ========================================
+# メトリクス（Prometheus テキスト形式）
+# ========================================
+metrics.gauge("echo_active_sessions", "保持しているセッション数", lambda: len(session_store))
+metrics.gauge("echo_threads", "プロセス内のスレッド数", threading.active_count)
+metrics.gauge("echo_image_dir_bytes", "画像ディレクトリの合計バイト数", image_store.total_bytes)
+metrics.gauge("echo_jobs", "スケジューラのキューごとの待機中・実行中ジョブ数", lambda: {
+    (name, state): count for name, stats in scheduler.stats().items()
+    for state, count in stats.items() if state in ('queued', 'running')}, ("queue", "state"))
+metrics.gauge("echo_lane_calls", "優先度レーンごとの実行中・順番待ちのモデル呼び出し数", lambda: {
+    (lane, state): stats[state] for lane, stats in priority.stats().items()
+    for state in ('running', 'waiting')}, ("lane", "state"))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """モデル呼び出し・再試行・待機・キューの計測値"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
 if __name__ == '__main__':
     # デバッグモード無効化（自動リロードを防ぐ）